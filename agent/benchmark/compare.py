@@ -0,0 +1,76 @@
+"""Compares two benchmark.run results.
+
+    python -m benchmark.compare base.json head.json [--threshold 0.2]
+
+Prints the change of every throughput and latency percentile and exits with 1
+if any got worse by more than the threshold.
+"""
+import argparse
+import json
+import sys
+from typing import Dict, Tuple
+
+# metric -> whether higher is better
+THROUGHPUT = {'documentsPerSecond': True, 'filesPerSecond': True, 'bytesPerSecond': True}
+LATENCY = {'p50': False, 'p95': False, 'p99': False, 'throughput': True}
+
+
+def metrics(report: dict) -> Dict[str, Tuple[float, bool]]:
+    found = {}
+
+    startup = report.get('startup', {})
+    for name in ('serving', 'ready', 'importSeconds'):
+        if startup.get(name) is not None:
+            found[f'startup {name}'] = (startup[name], False)
+
+    ingestion = report.get('ingestion', {})
+    for kind in ('link', 'code'):
+        for name, higher in THROUGHPUT.items():
+            if ingestion.get(kind, {}).get(name) is not None:
+                found[f'ingestion {kind} {name}'] = (ingestion[kind][name], higher)
+    for result in ingestion.get('text', []):
+        found[f"ingestion text@{result['corpusSize']} documentsPerSecond"] = (result['documentsPerSecond'], True)
+
+    for result in report.get('latency', []):
+        for name, higher in LATENCY.items():
+            if result.get(name) is not None:
+                key = f"{result['endpoint']}@{result['corpusSize']} x{result['concurrency']} {name}"
+                found[key] = (result[name], higher)
+
+    return found
+
+
+def main(args) -> int:
+    with open(args.base) as f:
+        base = json.load(f)
+    with open(args.head) as f:
+        head = json.load(f)
+
+    print(f"{base.get('commit')} -> {head.get('commit')}")
+
+    base_metrics, head_metrics = metrics(base), metrics(head)
+    regressions = 0
+    for key, (before, higher) in base_metrics.items():
+        if key not in head_metrics or not before:
+            continue
+
+        after = head_metrics[key][0]
+        change = (after - before) / before
+        worse = -change if higher else change
+        flag = ''
+        if worse > args.threshold:
+            regressions += 1
+            flag = '  REGRESSION'
+
+        print(f'{key:60} {before:12.4f} {after:12.4f} {change:+8.1%}{flag}')
+
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare two benchmark results')
+    parser.add_argument('base')
+    parser.add_argument('head')
+    parser.add_argument('--threshold', type=float, default=0.2, help='relative change counted as a regression')
+
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,271 @@
+"""OpenAI-compatible stand-in for benchmarks.
+
+    python -m benchmark.fake_openai [--port 8766] [--embedding-latency 0.02] [--completion-latency 0.3]
+                                    [--token-latency 0.0] [--completion-tokens 64] [--canned canned.json]
+
+Embeddings are deterministic: the sum of a seeded random vector per word,
+normalized, so texts sharing words are similar. Completions are canned text,
+or tool call arguments built from the tool's JSON schema unless the canned
+file has an entry for the tool's name. It also serves generated documents
+under /files/ for /api/agent/files/link.
+"""
+import argparse
+import asyncio
+import base64
+import functools
+import hashlib
+import json
+import mimetypes
+import os
+import random
+import re
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+WORD = re.compile(r'\w+')
+
+VOCABULARY = ('release deploy invoice meeting budget roadmap customer backend frontend database migration report '
+              'contract design review sprint incident payment schedule office hiring onboarding security audit '
+              'metrics latency cache queue worker calendar telegram message project deadline feature bug').split()
+
+# suggestions are only sent from a score of 9 and a relevance of 7
+CANNED = {
+    'Query': {'score': 9, 'relevance': 8, 'message': 'This is a canned suggestion from the benchmark server.'},
+}
+
+
+@functools.lru_cache(maxsize=65536)
+def _word_vector(word: str, dimensions: int) -> np.ndarray:
+    seed = int.from_bytes(hashlib.blake2b(word.encode(), digest_size=8).digest(), 'little')
+
+    return np.random.default_rng(seed).standard_normal(dimensions).astype(np.float32)
+
+
+def embed(text: str, dimensions: int = 1536) -> np.ndarray:
+    words = WORD.findall(text.lower()) or [text]
+    vector = np.sum([_word_vector(word, dimensions) for word in words], axis=0)
+    norm = np.linalg.norm(vector)
+
+    return vector / norm if norm else vector
+
+
+def count_tokens(text: str) -> int:
+    # close enough to tiktoken for usage reporting
+    return max(len(text) // 4, 1)
+
+
+def generate_text(seed: str, words: int) -> str:
+    return ' '.join(random.Random(seed).choices(VOCABULARY, k=words))
+
+
+def generate_document(name: str, size: int) -> str:
+    """Markdown of about `size` characters, the same for the same name."""
+    rng = random.Random(name)
+    parts = []
+    length = 0
+
+    while length < size:
+        heading = f"## {' '.join(rng.choices(VOCABULARY, k=3)).title()}\n\n"
+        paragraph = ' '.join(rng.choices(VOCABULARY, k=rng.randint(40, 120))) + '.\n\n'
+        parts.append(heading + paragraph)
+        length += len(heading) + len(paragraph)
+
+    return f"# {name}\n\n" + ''.join(parts)
+
+
+def example(schema: dict, definitions: dict) -> Any:
+    """A value valid against a pydantic generated JSON schema."""
+    if '$ref' in schema:
+        return example(definitions[schema['$ref'].split('/')[-1]], definitions)
+    for key in ('allOf', 'anyOf', 'oneOf'):
+        if key in schema:
+            options = [option for option in schema[key] if option.get('type') != 'null']
+            return example(options[0] if options else {}, definitions)
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if 'default' in schema and schema['default'] is not None:
+        return schema['default']
+
+    kind = schema.get('type')
+    if kind == 'object' or 'properties' in schema:
+        return {name: example(field, definitions) for name, field in schema.get('properties', {}).items()}
+    if kind == 'array':
+        return [example(schema.get('items', {}), definitions)]
+    if kind == 'integer':
+        return 5
+    if kind == 'number':
+        return 0.5
+    if kind == 'boolean':
+        return True
+    if schema.get('format') == 'date-time':
+        return '2024-01-01T10:00:00+00:00'
+    if schema.get('format') == 'date':
+        return '2024-01-01'
+
+    return 'benchmark'
+
+
+class FakeOpenAI:
+    def __init__(self, embedding_latency: float = 0.02, completion_latency: float = 0.3, token_latency: float = 0.0,
+                 completion_tokens: int = 64, file_size: int = 20000, canned: Optional[dict] = None):
+        self.embedding_latency = embedding_latency
+        self.completion_latency = completion_latency
+        self.token_latency = token_latency
+        self.completion_tokens = completion_tokens
+        self.file_size = file_size
+        self.canned = {**CANNED, **(canned or {})}
+        self.counts = {}
+        self.app = self.build_app()
+
+    def count(self, endpoint: str, requests: int = 1, inputs: int = 0, tokens: int = 0):
+        counts = self.counts.setdefault(endpoint, {'requests': 0, 'inputs': 0, 'tokens': 0})
+        counts['requests'] += requests
+        counts['inputs'] += inputs
+        counts['tokens'] += tokens
+
+    def completion(self, body: dict) -> dict:
+        """The assistant message for a chat completion request."""
+        tools = body.get('tools') or []
+        choice = body.get('tool_choice')
+        if isinstance(choice, dict):
+            tools = [tool for tool in tools if tool['function']['name'] == choice['function']['name']] or tools
+
+        if tools:
+            function = tools[0]['function']
+            parameters = function.get('parameters', {})
+            definitions = {**parameters.get('definitions', {}), **parameters.get('$defs', {})}
+            arguments = self.canned.get(function['name']) or example(parameters, definitions)
+
+            return {'role': 'assistant', 'content': None, 'tool_calls': [{
+                'id': 'call_benchmark',
+                'type': 'function',
+                'function': {'name': function['name'], 'arguments': json.dumps(arguments)},
+            }]}
+
+        prompt = json.dumps(body.get('messages', []))
+        text = self.canned.get('text') or generate_text(prompt, self.completion_tokens)
+
+        return {'role': 'assistant', 'content': text}
+
+    def build_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post('/v1/embeddings')
+        async def embeddings(request: Request):
+            body = await request.json()
+            inputs = body['input'] if isinstance(body['input'], list) else [body['input']]
+            # token arrays only need to map to the same vector every time
+            inputs: List[str] = [item if isinstance(item, str) else json.dumps(item) for item in inputs]
+            dimensions = body.get('dimensions') or 1536
+
+            await asyncio.sleep(self.embedding_latency)
+
+            data = []
+            for index, text in enumerate(inputs):
+                vector = embed(text, dimensions)
+                if body.get('encoding_format') == 'base64':
+                    embedding = base64.b64encode(vector.astype('<f4').tobytes()).decode()
+                else:
+                    embedding = vector.tolist()
+                data.append({'object': 'embedding', 'index': index, 'embedding': embedding})
+
+            tokens = sum(count_tokens(text) for text in inputs)
+            self.count('embeddings', inputs=len(inputs), tokens=tokens)
+
+            return {'object': 'list', 'data': data, 'model': body.get('model'),
+                    'usage': {'prompt_tokens': tokens, 'total_tokens': tokens}}
+
+        @app.post('/v1/chat/completions')
+        async def chat_completions(request: Request):
+            body = await request.json()
+            message = self.completion(body)
+            content = message['content'] or message['tool_calls'][0]['function']['arguments']
+            prompt_tokens = count_tokens(json.dumps(body.get('messages', [])))
+            completion_tokens = count_tokens(content)
+            finish_reason = 'tool_calls' if message['content'] is None else 'stop'
+            self.count('chat', inputs=1, tokens=prompt_tokens + completion_tokens)
+
+            completion_id = f"chatcmpl-{hashlib.md5(content.encode()).hexdigest()[:12]}"
+            created = int(time.time())
+
+            if not body.get('stream'):
+                await asyncio.sleep(self.completion_latency + self.token_latency * completion_tokens)
+
+                return {
+                    'id': completion_id, 'object': 'chat.completion', 'created': created, 'model': body.get('model'),
+                    'choices': [{'index': 0, 'message': message, 'finish_reason': finish_reason}],
+                    'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                              'total_tokens': prompt_tokens + completion_tokens},
+                }
+
+            def chunk(delta: dict, finish: Optional[str] = None) -> str:
+                return 'data: ' + json.dumps({
+                    'id': completion_id, 'object': 'chat.completion.chunk', 'created': created,
+                    'model': body.get('model'), 'choices': [{'index': 0, 'delta': delta, 'finish_reason': finish}],
+                }) + '\n\n'
+
+            async def events():
+                # the completion latency is the time to the first token
+                await asyncio.sleep(self.completion_latency)
+
+                if message['content'] is None:
+                    call = message['tool_calls'][0]
+                    yield chunk({'role': 'assistant', 'tool_calls': [{**call, 'index': 0}]})
+                else:
+                    words = message['content'].split(' ')
+                    for index, word in enumerate(words):
+                        yield chunk({'role': 'assistant', 'content': word if index == 0 else ' ' + word})
+                        await asyncio.sleep(self.token_latency)
+
+                yield chunk({}, finish_reason)
+                yield 'data: [DONE]\n\n'
+
+            return StreamingResponse(events(), media_type='text/event-stream')
+
+        @app.get('/files/{name}')
+        async def files(name: str, size: Optional[int] = None):
+            [mtype, _] = mimetypes.guess_type(name)
+            self.count('files')
+
+            return PlainTextResponse(generate_document(name, size or self.file_size),
+                                     media_type=mtype or 'text/plain')
+
+        @app.get('/stats')
+        async def stats():
+            return self.counts
+
+        @app.post('/stats/reset')
+        async def reset():
+            self.counts = {}
+            return JSONResponse({'status': 'ok'})
+
+        return app
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve an OpenAI-compatible stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.environ.get('FAKE_OPENAI_PORT', 8766)))
+    parser.add_argument('--embedding-latency', type=float, default=0.02, help='seconds per embeddings request')
+    parser.add_argument('--completion-latency', type=float, default=0.3,
+                        help='seconds per completion, or to the first token when streaming')
+    parser.add_argument('--token-latency', type=float, default=0.0, help='seconds per completion token')
+    parser.add_argument('--completion-tokens', type=int, default=64, help='words in generated completions')
+    parser.add_argument('--file-size', type=int, default=20000, help='characters in documents under /files/')
+    parser.add_argument('--canned', default=None,
+                        help='JSON with the completion "text" and tool call arguments by tool name')
+    args = parser.parse_args()
+
+    canned = None
+    if args.canned:
+        with open(args.canned) as f:
+            canned = json.load(f)
+
+    fake = FakeOpenAI(args.embedding_latency, args.completion_latency, args.token_latency, args.completion_tokens,
+                      args.file_size, canned)
+    uvicorn.run(fake.app, host=args.host, port=args.port, log_level='warning')
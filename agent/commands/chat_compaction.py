@@ -0,0 +1,62 @@
+"""Compaction of aged chat messages in the vector store into conversation digests.
+
+    python -m commands.chat_compaction [--company ID] [--dry-run] [--rebuild-index] [--enqueue]
+
+Runs for every company with chat messages unless --company is given, with
+each company's retention policy, and prints the index size and retrieval
+latency before and after. --enqueue leaves the work to the ingestion
+workers instead, e.g. from a daily cron.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import sys
+
+from pipelines.base.db import vector_store
+from pipelines.base.embedding import embedding_cache_store
+from pipelines.base.jobs import job_store
+from pipelines.base.llm import http_client as llm_http_client
+from pipelines.base.pool import pool
+from services.chat_compaction import chat_compactor
+
+
+async def main(args):
+    await pool.open()
+    try:
+        await vector_store.setup()
+        await embedding_cache_store.setup()
+        await job_store.setup()
+        await chat_compactor.setup()
+
+        companies = [args.company] if args.company is not None else await chat_compactor.companies()
+        results = []
+        for company_id in companies:
+            if args.enqueue:
+                # one job per company and day, however often this runs
+                job = await job_store.enqueue('chat_compaction', company_id,
+                                              {'dryRun': args.dry_run, 'rebuildIndex': args.rebuild_index},
+                                              f"chat_compaction:{datetime.date.today().isoformat()}")
+                results.append({'companyId': company_id, 'jobId': job.id, 'status': job.status})
+            else:
+                results.append(await chat_compactor.run(company_id, dry_run=args.dry_run,
+                                                        rebuild_index=args.rebuild_index))
+    finally:
+        await llm_http_client.aclose()
+        await pool.close()
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Compact aged chat messages into conversation digests')
+    parser.add_argument('--company', type=int, default=None, help='only this company')
+    parser.add_argument('--dry-run', action='store_true', help='only count the messages that would be compacted')
+    parser.add_argument('--rebuild-index', action='store_true',
+                        help='rebuild the company ANN index afterwards, it only shrinks on a rebuild')
+    parser.add_argument('--enqueue', action='store_true', help='enqueue jobs for the ingestion workers instead')
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,74 @@
+"""Worker process for the ingestion jobs enqueued by the API.
+
+    python -m commands.ingestion_worker [--concurrency N] [--metrics-port PORT]
+
+Uploaded files are read from the uploads directory, which has to be shared
+with the API.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import sys
+
+from pipelines.base.chat_messages import chat_message_store
+from pipelines.base.db import docstore_kvstore, vector_store
+from pipelines.base.embedding import embedding_cache_store
+from pipelines.base.jobs import job_store
+from pipelines.base.link_registry import link_registry
+from pipelines.base.metrics import serve_metrics
+from pipelines.base.llm import http_client as llm_http_client
+from pipelines.base.pool import pool
+from pipelines.base.repo_registry import repo_registry
+from pipelines.cpu_pool import cpu_pool
+from services.chat_compaction import chat_compactor
+from services.chat_import import chat_importer
+from services.file_service import file_service
+from services.ingestion_jobs import IngestionJobRunner
+from services.repo_service import repo_service
+
+
+async def main(args):
+    await pool.open()
+    await vector_store.setup()
+    await docstore_kvstore.setup()
+    await embedding_cache_store.setup()
+    await link_registry.setup()
+    await repo_registry.setup()
+    await chat_message_store.setup()
+    await chat_compactor.setup()
+    await job_store.setup()
+
+    runner = IngestionJobRunner(job_store, file_service, repo_service, chat_importer, chat_compactor,
+                                concurrency=args.concurrency)
+    metrics_server = await serve_metrics('0.0.0.0', args.metrics_port) if args.metrics_port else None
+
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        # jobs in progress are finished before exiting
+        loop.add_signal_handler(sig, runner.stop)
+
+    try:
+        if args.concurrency:
+            await cpu_pool.warm_up()
+        await runner.run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.close()
+        await file_service.close()
+        cpu_pool.shutdown()
+        await llm_http_client.aclose()
+        await pool.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Process ingestion jobs')
+    parser.add_argument('--concurrency', type=int, default=int(os.environ.get('INGESTION_JOB_CONCURRENCY', 2)),
+                        help='jobs processed at the same time')
+    parser.add_argument('--metrics-port', type=int, default=int(os.environ.get('WORKER_METRICS_PORT') or 0),
+                        help='port to serve Prometheus metrics on, none by default')
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,52 @@
+"""Syncs a repository into a company's documents without going through the job queue.
+
+    python -m commands.repo_sync COMPANY_ID owner/name [--url URL | --path DIR] [--ref REF]
+
+--path syncs a local checkout of the server, which the HTTP API doesn't allow.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from pipelines.base.db import docstore_kvstore, vector_store
+from pipelines.base.embedding import embedding_cache_store
+from pipelines.base.llm import http_client as llm_http_client
+from pipelines.base.pool import pool
+from pipelines.base.repo_registry import repo_registry
+from pipelines.cpu_pool import cpu_pool
+from services.file_service import file_service
+from services.repo_service import repo_service
+
+
+async def main(args):
+    await pool.open()
+    try:
+        await vector_store.setup()
+        await docstore_kvstore.setup()
+        await embedding_cache_store.setup()
+        await repo_registry.setup()
+
+        result = await repo_service.sync(args.company, args.repo, url=args.url, path=args.path, ref=args.ref)
+    finally:
+        await file_service.close()
+        cpu_pool.shutdown()
+        await llm_http_client.aclose()
+        await pool.close()
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Sync a repository')
+    parser.add_argument('company', type=int)
+    parser.add_argument('repo', help='owner/name, also the key documents are stored under')
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument('--url', default=None, help='https://github.com/ clone URL, from the repo name by default')
+    source.add_argument('--path', default=None, help='local git checkout to sync instead of cloning')
+    parser.add_argument('--ref', default=None, help='branch, tag or commit, HEAD by default')
+
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,114 @@
+"""Recall, latency and memory of the vector storage modes on a company's real embeddings.
+
+    python -m commands.vector_benchmark [--company ID] [--modes full:1536,halfvec:1536,binary:1536,halfvec:512]
+                                        [--queries 50] [--top-k 8] [--create-indexes]
+
+Query vectors are sampled from the company's rows. Recall@k is measured
+against an exact scan over full vectors.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import statistics
+import sys
+import time
+from typing import List, Optional
+
+import psycopg
+
+from pipelines.base.db import vector_index_manager
+from pipelines.base.vector_store import VectorIndexManager, VectorIndexSettings, tenant_predicate
+
+
+async def search(conn: psycopg.AsyncConnection, table: str, settings: VectorIndexSettings, company_id: int,
+                 query: str, top_k: int, exact: bool = False) -> List[int]:
+    async with conn.transaction():
+        if exact:
+            await conn.execute("SET LOCAL enable_indexscan = off")
+            await conn.execute("SET LOCAL enable_bitmapscan = off")
+        elif settings.index_type == 'hnsw':
+            ef_search = max(settings.hnsw_ef_search, settings.candidates(top_k))
+            await conn.execute(f"SET LOCAL hnsw.ef_search = {ef_search}")
+        else:
+            await conn.execute(f"SET LOCAL ivfflat.probes = {settings.ivfflat_probes}")
+
+        if exact or settings.exact:
+            cursor = await conn.execute(f"SELECT id FROM {table} WHERE {tenant_predicate(company_id)} "
+                                        "ORDER BY embedding <=> %s::vector LIMIT %s", [query, top_k])
+        else:
+            cursor = await conn.execute(f"SELECT id FROM (SELECT id, embedding FROM {table} "
+                                        f"WHERE {tenant_predicate(company_id)} "
+                                        f"ORDER BY {settings.ann_distance('%s::vector')} LIMIT %s) candidates "
+                                        "ORDER BY embedding <=> %s::vector LIMIT %s",
+                                        [query, settings.candidates(top_k), query, top_k])
+
+        return [row[0] for row in await cursor.fetchall()]
+
+
+async def index_size(conn: psycopg.AsyncConnection, name: str) -> Optional[int]:
+    cursor = await conn.execute("SELECT pg_relation_size(to_regclass(%s))", [name])
+    return (await cursor.fetchone())[0]
+
+
+async def main(args):
+    conninfo = os.environ.get('DOCUMENT_DATABASE_URL')
+    table = vector_index_manager.table_name
+
+    async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+        companies = [(company, rows) for company, rows in await vector_index_manager.companies(conn)
+                     if args.company is None or company == args.company]
+        company_id, rows = max(companies, key=lambda company: company[1])
+
+        cursor = await conn.execute(f"SELECT embedding::text FROM {table} WHERE {tenant_predicate(company_id)} "
+                                    "ORDER BY random() LIMIT %s", [args.queries])
+        queries = [row[0] for row in await cursor.fetchall()]
+
+        truth = [set(await search(conn, table, vector_index_manager.settings, company_id, query, args.top_k, True))
+                 for query in queries]
+
+        results = []
+        for mode in args.modes.split(','):
+            storage_mode, dimensions = mode.split(':')
+            settings = VectorIndexSettings(storage_mode, int(dimensions))
+            manager = VectorIndexManager(conninfo, settings, table)
+
+            if args.create_indexes:
+                await manager.create(company_id, force=True)
+
+            recalls = []
+            latencies = []
+            for query, expected in zip(queries, truth):
+                started = time.perf_counter()
+                found = await search(conn, table, settings, company_id, query, args.top_k)
+                latencies.append(time.perf_counter() - started)
+                recalls.append(len(expected & set(found)) / len(expected) if expected else 1.0)
+
+            results.append({
+                'mode': storage_mode,
+                'dimensions': settings.search_dimensions,
+                'recall': statistics.mean(recalls),
+                'latencyAvg': statistics.mean(latencies),
+                'latencyP95': sorted(latencies)[int(len(latencies) * 0.95)],
+                'vectorBytes': settings.bytes_per_vector() * rows,
+                'index': manager.index_name(company_id),
+                'indexBytes': await index_size(conn, manager.index_name(company_id)),
+            })
+
+    print(json.dumps({'companyId': company_id, 'rows': rows, 'queries': len(queries), 'topK': args.top_k,
+                      'results': results}, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Benchmark vector storage modes')
+    parser.add_argument('--company', type=int, default=None, help='company to sample, the largest by default')
+    parser.add_argument('--modes', default='full:1536,halfvec:1536,binary:1536,full:512,halfvec:512',
+                        help='comma separated storage_mode:dimensions')
+    parser.add_argument('--queries', type=int, default=50)
+    parser.add_argument('--top-k', type=int, default=8)
+    parser.add_argument('--create-indexes', action='store_true', help='build missing indexes of the modes first')
+
+    asyncio.run(main(parser.parse_args()))
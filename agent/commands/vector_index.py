@@ -0,0 +1,46 @@
+"""Maintenance of the per-company ANN indexes.
+
+    python -m commands.vector_index status
+    python -m commands.vector_index create [--company ID] [--force]
+    python -m commands.vector_index rebuild [--company ID]
+    python -m commands.vector_index drop [--company ID]
+    python -m commands.vector_index prune [--company ID]
+    python -m commands.vector_index prewarm
+
+prewarm installs the pg_prewarm extension, the app only prewarms where it is installed.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import sys
+
+from pipelines.base.db import vector_index_manager
+
+
+async def main(args):
+    if args.action == 'status':
+        result = await vector_index_manager.status()
+    elif args.action == 'create':
+        result = await vector_index_manager.create(args.company, force=args.force)
+    elif args.action == 'rebuild':
+        result = await vector_index_manager.rebuild(args.company)
+    elif args.action == 'prune':
+        result = await vector_index_manager.prune(args.company)
+    elif args.action == 'prewarm':
+        result = await vector_index_manager.prewarm(create_extension=True)
+    else:
+        result = await vector_index_manager.drop(args.company)
+
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Manage per-company vector indexes')
+    parser.add_argument('action', choices=['status', 'create', 'rebuild', 'drop', 'prune', 'prewarm'])
+    parser.add_argument('--company', type=int, default=None, help='only this company')
+    parser.add_argument('--force', action='store_true', help='index companies below VECTOR_INDEX_MIN_ROWS too')
+
+    asyncio.run(main(parser.parse_args()))
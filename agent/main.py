@@ -1,36 +1,110 @@
+import asyncio
 import logging
 import mimetypes
 import os
 import sys
 from contextlib import asynccontextmanager
 from tempfile import NamedTemporaryFile
-import urllib.request
-from typing import List
+from typing import List, Optional
 
 from dotenv import load_dotenv
-from fastapi import FastAPI, UploadFile
-from langfuse.llama_index import LlamaIndexCallbackHandler
-from llama_index.core import Document, Settings, SimpleDirectoryReader
+from fastapi import FastAPI, Header, HTTPException, UploadFile
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from llama_index.core import Document, Settings
 from llama_index.core.callbacks import CallbackManager
-from pydantic import BaseModel
+from pydantic import BaseModel, model_validator
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.requests import Request
 
-from pipelines.base.db import pool
-from pipelines.ingestion_pipeline import TextIngestionPipeline, build_code_ingestion_pipeline
+from pipelines.base.chat_messages import MESSAGE_TYPE, chat_message_store
+from pipelines.base.db import docstore_kvstore, vector_index_manager, vector_store
+from pipelines.base.embedding import embed_model, embedding_cache_store
+from pipelines.base.jobs import job_store
+from pipelines.base.link_registry import link_registry
+from pipelines.base.metrics import CONTENT_TYPE, metrics
+from pipelines.base.pool import pool, pool_stats
+from pipelines.base.repo_registry import repo_registry
+from pipelines.base.scheduler import openai_scheduler
+from pipelines.base.llm import http_client as llm_http_client
+from pipelines.context_packer import count_tokens
+from pipelines.cpu_pool import cpu_pool
+from pipelines.ingestion_pipeline import notify_ingested
+from pipelines.ingestion_queue import QueueClosedError, text_ingestion_queue
 from services.agent_service import AgentService
-from utils.ext_to_lang import EXTENSION_TO_LANGUAGE
+from services.answer_cache import answer_cache
+from services.chat_compaction import chat_compactor
+from services.chat_import import chat_importer
+from services.diff_summarizer import diff_summarizer
+from services.file_service import FileTooLargeError, file_service
+from services.ingestion_jobs import IngestionJobRunner
+from services.repo_service import repo_service, validate_repo
+from services.request_metrics import MetricsMiddleware
+from services.startup import startup
+from services.streaming import stream_answer, stream_result
+from services.suggest_debouncer import suggest_debouncer
+from services.suggest_gate import suggest_gate
 
 load_dotenv()
 
 
 
+async def setup():
+    # opening every connection up front keeps the first requests from paying for it
+    await pool.open(wait=True)
+    await vector_store.setup()
+    await docstore_kvstore.setup()
+    await embedding_cache_store.setup()
+    await link_registry.setup()
+    await repo_registry.setup()
+    await chat_message_store.setup()
+    await chat_compactor.setup()
+    await job_store.setup()
+
+
+async def build_pipelines():
+    agentService.pipelines.build_all()
+
+
+async def warm_up():
+    phases = [
+        ('pipelines', build_pipelines),
+        ('tokenizer', lambda: asyncio.to_thread(count_tokens, '')),
+        ('vectorIndex', vector_index_manager.prewarm),
+        ('suggestGate', suggest_gate.warm_up),
+    ]
+    # files are only parsed where jobs run, idle parser processes would just hold memory
+    if inline_job_runner.concurrency:
+        phases.insert(2, ('parsers', cpu_pool.warm_up))
+
+    await startup.warm_up(phases)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    await pool.open()
+    await startup.phase('setup', setup, required=True)
+    await text_ingestion_queue.start()
+
+    # answers cached here must be dropped when a worker process ingests documents
+    listener = asyncio.create_task(job_store.listen(os.environ.get('DOCUMENT_DATABASE_URL'), notify_ingested))
+    # and so must the chat buffers when a worker writes messages
+    chat_listener = asyncio.create_task(chat_message_store.listen(os.environ.get('DOCUMENT_DATABASE_URL')))
+    runner = asyncio.create_task(inline_job_runner.run())
+    warming = asyncio.create_task(warm_up())
+
     yield
+
+    warming.cancel()
+    listener.cancel()
+    chat_listener.cancel()
+    inline_job_runner.stop()
+    await asyncio.gather(warming, listener, chat_listener, runner, return_exceptions=True)
+    await text_ingestion_queue.stop()
+    await file_service.close()
+    cpu_pool.shutdown()
+    await llm_http_client.aclose()
     await pool.close()
-    langfuse_callback_handler.flush()
+    if langfuse_callback_handler is not None:
+        langfuse_callback_handler.flush()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -42,13 +116,19 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware, slow_request_seconds=float(os.environ.get('SLOW_REQUEST_SECONDS', 5)))
 
-langfuse_callback_handler = LlamaIndexCallbackHandler(
-    public_key=os.environ.get('LANGFUSE_PUBLIC_KEY'),
-    secret_key=os.environ.get('LANGFUSE_SECRET_KEY'),
-    host=os.environ.get('LANGFUSE_HOST')
-)
-Settings.callback_manager = CallbackManager([langfuse_callback_handler])
+langfuse_callback_handler = None
+if os.environ.get('LANGFUSE_PUBLIC_KEY'):
+    # the client is slow to import, only pay for it when tracing is configured
+    from langfuse.llama_index import LlamaIndexCallbackHandler
+
+    langfuse_callback_handler = LlamaIndexCallbackHandler(
+        public_key=os.environ.get('LANGFUSE_PUBLIC_KEY'),
+        secret_key=os.environ.get('LANGFUSE_SECRET_KEY'),
+        host=os.environ.get('LANGFUSE_HOST')
+    )
+    Settings.callback_manager = CallbackManager([langfuse_callback_handler])
 
 logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 logging.getLogger().addHandler(logging.StreamHandler(stream=sys.stdout))
@@ -66,6 +146,29 @@ class AddFileLinkRequest(BaseModel):
     meta: dict
 
 
+class BulkDocument(BaseModel):
+    content: str
+    meta: dict
+
+
+class AddBulkTextRequest(BaseModel):
+    companyId: int
+    documents: List[BulkDocument]
+
+
+class SyncRepoRequest(BaseModel):
+    companyId: int
+    repo: str
+    url: Optional[str] = None
+    ref: Optional[str] = None
+    meta: dict = {}
+
+    @model_validator(mode='after')
+    def check_repo(self):
+        validate_repo(self.repo, self.url, self.ref)
+        return self
+
+
 class QueryRequest(BaseModel):
     question: str
     companyId: int
@@ -104,95 +207,178 @@ class GenerateCalendarEventRequest(BaseModel):
 
 
 agentService = AgentService()
+# for development without a separate `python -m commands.ingestion_worker`
+inline_job_runner = IngestionJobRunner(job_store, file_service, repo_service, chat_importer, chat_compactor,
+                                       concurrency=int(os.environ.get('INGESTION_JOB_INLINE_WORKERS', 0)))
+
 
+@app.post("/api/agent/github/repo", status_code=202)
+async def sync_repo(request: SyncRepoRequest, idempotency_key: str = Header(None)):
+    job = await job_store.enqueue('repo', request.companyId, request.model_dump(exclude={'companyId'}),
+                                  idempotency_key)
 
-@app.post('/api/agent/github/repo')
-async def download_repo():
-    await agentService.download_repo()
+    return {'status': job.status, 'jobId': job.id}
 
-@app.post("/api/agent/text")
+
+@app.post("/api/agent/text", status_code=202)
 async def add_message(request: AddMessageRequest):
-    await TextIngestionPipeline.arun(documents=[
-        Document(text=request.content, metadata={**request.meta, 'companyId': request.companyId})
-    ])
+    metadata = {**request.meta, 'companyId': request.companyId}
+
+    if metadata.get('type') == MESSAGE_TYPE:
+        await chat_message_store.add(request.companyId, request.content, metadata)
+
+    try:
+        await text_ingestion_queue.put([
+            Document(text=request.content, metadata=metadata)
+        ])
+    except QueueClosedError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+
+    return {'status': 'accepted'}
+
+
+@app.post("/api/agent/chats/import", status_code=202)
+async def import_chat(file: UploadFile, companyId: int, chatId: Optional[str] = None, format: Optional[str] = None,
+                      idempotency_key: str = Header(None)):
+    export_format = format or ('ndjson' if os.path.splitext(file.filename or '')[1] in ('.ndjson', '.jsonl')
+                               else 'telegram')
+    if export_format not in ('telegram', 'ndjson'):
+        raise HTTPException(status_code=400, detail=f"Unknown format: {export_format}")
+
+    try:
+        file_path = await file_service.save_upload(file)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+
+    job = await job_store.enqueue('chat_import', companyId,
+                                  {'path': file_path, 'format': export_format, 'chatId': chatId, 'meta': {}},
+                                  idempotency_key)
+    if job.payload['path'] != file_path:
+        # the same upload was already accepted
+        os.remove(file_path)
+
+    return {'status': job.status, 'jobId': job.id}
+
+
+@app.post("/api/agent/chats/compact", status_code=202)
+async def compact_chats(companyId: int, dryRun: bool = False, rebuildIndex: bool = False,
+                        idempotency_key: str = Header(None)):
+    job = await job_store.enqueue('chat_compaction', companyId, {'dryRun': dryRun, 'rebuildIndex': rebuildIndex},
+                                  idempotency_key)
+
+    return {'status': job.status, 'jobId': job.id}
+
+
+@app.get("/api/agent/ingestion/stats")
+async def ingestion_stats():
+    return text_ingestion_queue.stats()
 
-    return {'status': 'ok'}
 
+@app.get("/api/agent/chats/stats")
+async def chat_stats():
+    return chat_message_store.stats()
 
-@app.post("/api/agent/files")
-async def add_file(file: UploadFile):
-    # if file.mimetype not in MIMETYPES:
-    #     raise HTTPException(status_code=400, detail="Invalid mimetype")
-    #
-    # extension = mimetypes.guess_extension(file.mimetype)
-    #
-    # with NamedTemporaryFile(delete=False, dir='uploads', suffix=extension) as temp_file:
-    #     file.save(temp_file.name)
-    #     file_path = temp_file.name
 
+@app.get("/api/agent/embeddings/stats")
+async def embedding_stats():
+    return embed_model.stats()
+
+
+@app.get("/api/agent/db/stats")
+async def db_stats():
+    return pool_stats()
+
+
+@app.get("/api/agent/cpu/stats")
+async def cpu_stats():
+    return cpu_pool.stats()
+
+
+@app.get("/api/agent/openai/stats")
+async def openai_stats():
+    return openai_scheduler.stats()
+
+
+@app.get("/api/agent/ready")
+async def ready():
+    return JSONResponse(startup.stats(), status_code=200 if startup.ready else 503)
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return PlainTextResponse(metrics.render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/api/agent/pipelines/stats")
+async def pipeline_stats():
+    return agentService.pipelines.stats()
+
+
+@app.post("/api/agent/text/bulk", status_code=202)
+async def add_bulk_text(request: AddBulkTextRequest, idempotency_key: str = Header(None)):
+    job = await job_store.enqueue('documents', request.companyId,
+                                  {'documents': [document.model_dump() for document in request.documents]},
+                                  idempotency_key)
+
+    return {'status': job.status, 'jobId': job.id}
+
+
+@app.post("/api/agent/files", status_code=202)
+async def add_file(request: Request, file: UploadFile, companyId: int, idempotency_key: str = Header(None)):
     meta = {}
-    # for arg in request.args:
-    #     meta[arg] = int(request.args[arg]) if request.args[arg].isdecimal() else request.args[arg]
-    #
-    # FilePipeline.run({
-    #     "file_type_router": {"sources": [file_path]},
-    #     "pypdf_converter": {"meta": meta},
-    #     "text_file_converter": {"meta": meta},
-    #     "markdown_converter": {"meta": meta},
-    # })
-    #
-    # os.remove(file_path)
-
-
-@app.post("/api/agent/files/link")
-async def add_file_via_link(file: AddFileLinkRequest):
-    [mtype, _] = mimetypes.guess_type(file.link)
-
-    extension = mimetypes.guess_extension(mtype)
-
-    with NamedTemporaryFile(delete=False, dir='uploads', suffix=extension) as temp_file:
-        urllib.request.urlretrieve(file.link, temp_file.name)
-        file_path = temp_file.name
-
-    meta = {
-        **file.meta,
-        'companyId': file.companyId
-    }
-
-    reader = SimpleDirectoryReader(
-        input_files=[file_path],
-    )
+    for arg in request.query_params:
+        if arg != 'companyId':
+            meta[arg] = int(request.query_params[arg]) if request.query_params[arg].isdecimal() \
+                else request.query_params[arg]
+
+    try:
+        file_path = await file_service.save_upload(file)
+    except FileTooLargeError as e:
+        raise HTTPException(status_code=413, detail=str(e))
 
-    docs = await reader.aload_data()
+    job = await job_store.enqueue('file', companyId,
+                                  {'path': file_path, 'fileName': file.filename, 'meta': meta},
+                                  idempotency_key)
+    if job.payload['path'] != file_path:
+        # the same upload was already accepted
+        os.remove(file_path)
 
-    for doc in docs:
-        doc.metadata = {
-            **meta,
-            **doc.metadata
-        }
+    return {'status': job.status, 'jobId': job.id}
 
-    validated_extension = extension.lstrip('.')
 
-    if validated_extension in EXTENSION_TO_LANGUAGE:
-        try:
-            pipeline = build_code_ingestion_pipeline(EXTENSION_TO_LANGUAGE[validated_extension][0])
-            await pipeline.arun(documents=docs)
-        except Exception as e:
-            logging.warning(e)
-            await TextIngestionPipeline.arun(documents=docs)
-    else:
-        await TextIngestionPipeline.arun(documents=docs)
+@app.post("/api/agent/files/link", status_code=202)
+async def add_file_via_link(file: AddFileLinkRequest, idempotency_key: str = Header(None)):
+    job = await job_store.enqueue('link', file.companyId, {'link': file.link, 'meta': file.meta}, idempotency_key)
 
-    os.remove(file_path)
+    return {'status': job.status, 'jobId': job.id}
 
-    return {'status': 'ok'}
+
+@app.get("/api/agent/jobs/{job_id}")
+async def get_job(job_id: int):
+    job = await job_store.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    return job.to_dict()
 
 
 @app.post("/api/agent/query")
 async def query(request: Request, query: QueryRequest):
     result = await agentService.query(query.question, query.companyId, query.meta)
 
-    return {"response": result}
+    return {"response": result.response, "cached": result.cached}
+
+
+@app.post("/api/agent/query/stream")
+async def query_stream(query: QueryRequest):
+    chunks = agentService.stream_query(query.question, query.companyId, query.meta)
+
+    return StreamingResponse(stream_answer(chunks), media_type="text/event-stream")
+
+
+@app.get("/api/agent/query/cache/stats")
+async def query_cache_stats():
+    return answer_cache.stats()
 
 
 @app.post("/api/agent/suggest")
@@ -202,6 +388,16 @@ async def suggest(request: SuggestRequest):
     return {"response": result}
 
 
+@app.get("/api/agent/suggest/stats")
+async def suggest_stats():
+    return suggest_debouncer.stats()
+
+
+@app.get("/api/agent/suggest/gate/stats")
+async def suggest_gate_stats():
+    return suggest_gate.stats()
+
+
 @app.post("/api/agent/git/diff/summary")
 async def summary_git_diff(request: SummaryGitDiffRequest):
     result = await agentService.summaryGitDiff(request.diff, request.companyId)
@@ -209,9 +405,25 @@ async def summary_git_diff(request: SummaryGitDiffRequest):
     return {"response": result}
 
 
+@app.get("/api/agent/git/diff/stats")
+async def git_diff_stats():
+    return diff_summarizer.stats()
+
+
 @app.post("/api/agent/calendars/event")
 async def generate_event(request: GenerateCalendarEventRequest):
     result = await agentService.generate_event(request.calendars, request.events, request.command, request.companyId,
                                                request.meta)
 
     return {"response": result}
+
+
+@app.post("/api/agent/calendars/event/stream")
+async def generate_event_stream(request: GenerateCalendarEventRequest):
+    result = agentService.generate_event(request.calendars, request.events, request.command, request.companyId,
+                                         request.meta)
+
+    return StreamingResponse(stream_result(result), media_type="text/event-stream")
+
+
+startup.mark_imported()
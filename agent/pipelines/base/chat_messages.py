@@ -0,0 +1,200 @@
+import asyncio
+import datetime
+import json
+import logging
+import os
+import uuid
+from bisect import insort
+from collections import OrderedDict, deque
+from typing import List, Optional, Tuple
+
+import psycopg
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.pool import pool
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_TYPE = 'telegram-message'
+
+# more chats than this in one notification drop the buffers of the whole company, payloads are limited to 8000 bytes
+MAX_NOTIFIED_CHATS = 100
+
+
+def parse_date(value: Optional[str]) -> datetime.datetime:
+    if not value:
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    date = datetime.datetime.fromisoformat(value)
+    return date if date.tzinfo else date.replace(tzinfo=datetime.timezone.utc)
+
+
+class ChatMessageStore:
+    """Chat messages in their own table, indexed for last-N lookups per chat.
+
+    The most recent messages of recently active chats are also kept in
+    in-process ring buffers, so most lookups don't touch the database.
+    Every write announces its chats on the `channel` notification channel,
+    so other processes, e.g. ingestion workers importing chats, don't leave
+    stale buffers behind.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, buffer_size: int = 5, max_chats: int = 10000,
+                 table_name: str = 'chat_messages', channel: str = 'chat_messages_changed'):
+        self.pool = pool
+        self.buffer_size = buffer_size
+        self.max_chats = max_chats
+        self.table_name = table_name
+        self.channel = channel
+        # tells this process's own notifications apart, its buffers are already up to date
+        self.origin = uuid.uuid4().hex
+
+        # (companyId, chatId) -> deque of (date, text, metadata) ordered by date
+        self._buffers: OrderedDict = OrderedDict()
+
+        self.buffer_hits = 0
+        self.buffer_misses = 0
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute("SELECT to_regclass(%s) IS NULL, to_regclass('data_documents') IS NOT NULL",
+                                        [self.table_name])
+            created, has_documents = await cursor.fetchone()
+
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                               "id BIGSERIAL PRIMARY KEY, "
+                               "company_id BIGINT NOT NULL, "
+                               "chat_id VARCHAR NOT NULL, "
+                               "date TIMESTAMPTZ NOT NULL, "
+                               "text VARCHAR NOT NULL, "
+                               "metadata JSONB NOT NULL)")
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_company_chat_date_idx "
+                               f"ON {self.table_name} (company_id, chat_id, date DESC)")
+
+            if created and has_documents:
+                await self._backfill(conn)
+
+    async def _backfill(self, conn):
+        # messages ingested before this table existed only live in the vector store, possibly split into nodes
+        await conn.execute(f"INSERT INTO {self.table_name} (company_id, chat_id, date, text, metadata) "
+                           "SELECT (metadata_->>'companyId')::bigint, metadata_->>'chatId', "
+                           "(metadata_->>'date')::timestamptz, string_agg(text, ' ' ORDER BY id), "
+                           "(array_agg(metadata_::jsonb - '_node_content' - '_node_type' - 'doc_id' "
+                           "- 'document_id' - 'ref_doc_id'))[1] "
+                           "FROM data_documents WHERE metadata_->>'type'=%s "
+                           "GROUP BY metadata_->>'doc_id', metadata_->>'companyId', metadata_->>'chatId', "
+                           "metadata_->>'date'",
+                           [MESSAGE_TYPE])
+
+    async def add(self, company_id: int, text: str, metadata: dict):
+        chat_id = str(metadata.get('chatId'))
+        date = parse_date(metadata.get('date'))
+
+        async with self.pool.connection() as conn:
+            await conn.execute(f"INSERT INTO {self.table_name} (company_id, chat_id, date, text, metadata) "
+                               "VALUES (%s, %s, %s, %s, %s)",
+                               [company_id, chat_id, date, text, Jsonb(metadata)])
+            await self._notify(conn, company_id, [chat_id])
+
+        buffer = self._buffers.get((company_id, chat_id))
+        if buffer is not None:
+            messages = list(buffer)
+            insort(messages, (date, text, metadata), key=lambda message: message[0])
+            buffer.clear()
+            buffer.extend(messages[-self.buffer_size:])
+
+    async def add_many(self, company_id: int, messages: List[Tuple[str, dict]]):
+        """Adds imported messages, skipping the ones already stored, e.g. by a failed import."""
+        rows = [(company_id, str(metadata.get('chatId')), parse_date(metadata.get('date')), text, Jsonb(metadata))
+                for text, metadata in messages]
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(f"INSERT INTO {self.table_name} (company_id, chat_id, date, text, metadata) "
+                                         "SELECT %(company_id)s, %(chat_id)s, %(date)s, %(text)s, %(metadata)s "
+                                         f"WHERE NOT EXISTS (SELECT 1 FROM {self.table_name} "
+                                         "WHERE company_id=%(company_id)s AND chat_id=%(chat_id)s "
+                                         "AND date=%(date)s AND text=%(text)s)",
+                                         [dict(zip(('company_id', 'chat_id', 'date', 'text', 'metadata'), row))
+                                          for row in rows])
+
+            chat_ids = sorted({row[1] for row in rows})
+            await self._notify(conn, company_id, chat_ids)
+
+        # buffers of the chats may miss messages now, they are reloaded on the next lookup
+        self.evict(company_id, chat_ids)
+
+    async def _notify(self, conn, company_id: int, chat_ids: List[str]):
+        payload = {'origin': self.origin, 'companyId': company_id,
+                   'chatIds': chat_ids if len(chat_ids) <= MAX_NOTIFIED_CHATS else None}
+        await conn.execute("SELECT pg_notify(%s, %s)", [self.channel, json.dumps(payload)])
+
+    def evict(self, company_id: int, chat_ids: Optional[List[str]] = None):
+        """Drops the buffers of the chats, or of every chat of the company."""
+        if chat_ids is None:
+            chat_ids = [chat_id for company, chat_id in self._buffers if company == company_id]
+
+        for chat_id in chat_ids:
+            self._buffers.pop((company_id, chat_id), None)
+
+    async def listen(self, conninfo: str):
+        """Drops the buffers of chats other processes wrote messages to, until cancelled."""
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.channel}")
+                    # messages written while the listener was away
+                    self._buffers.clear()
+
+                    async for notify in conn.notifies():
+                        payload = json.loads(notify.payload)
+                        if payload['origin'] != self.origin:
+                            self.evict(payload['companyId'], payload['chatIds'])
+            except psycopg.OperationalError:
+                logger.exception('Lost the %s listener connection', self.channel)
+                await asyncio.sleep(5)
+
+    async def get_last(self, company_id: int, chat_id, limit: int = 5) -> List[Tuple[str, dict]]:
+        """Returns the last `limit` messages of a chat, newest first."""
+        key = (company_id, str(chat_id))
+
+        buffer = self._buffers.get(key)
+        if buffer is not None and limit <= self.buffer_size:
+            self.buffer_hits += 1
+            self._buffers.move_to_end(key)
+        else:
+            self.buffer_misses += 1
+            buffer = await self._load(key, max(limit, self.buffer_size))
+
+        return [(text, metadata) for _, text, metadata in reversed(buffer)][:limit]
+
+    async def _load(self, key: Tuple[int, str], limit: int) -> deque:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT date, text, metadata FROM {self.table_name} "
+                                        "WHERE company_id=%s AND chat_id=%s ORDER BY date DESC LIMIT %s",
+                                        [key[0], key[1], limit])
+            rows = await cursor.fetchall()
+
+        buffer = deque(reversed(rows), maxlen=self.buffer_size)
+
+        self._buffers[key] = buffer
+        self._buffers.move_to_end(key)
+        while len(self._buffers) > self.max_chats:
+            self._buffers.popitem(last=False)
+
+        return deque(reversed(rows))
+
+    def stats(self) -> dict:
+        return {
+            'bufferedChats': len(self._buffers),
+            'bufferHits': self.buffer_hits,
+            'bufferMisses': self.buffer_misses,
+        }
+
+
+chat_message_store = ChatMessageStore(
+    pool,
+    buffer_size=int(os.environ.get('CHAT_BUFFER_SIZE', 5)),
+    max_chats=int(os.environ.get('CHAT_BUFFER_MAX_CHATS', 10000)),
+)
@@ -1,33 +1,32 @@
+import functools
 import os
-import sys
 
-import psycopg
 from llama_index.core import VectorStoreIndex
-from llama_index.vector_stores.postgres import PGVectorStore
-from psycopg_pool import AsyncConnectionPool
-from sqlalchemy import make_url
+from llama_index.core.storage.docstore.keyval_docstore import KVDocumentStore
 
 from pipelines.base.embedding import embed_model
+from pipelines.base.kvstore import PoolKVStore
+from pipelines.base.pool import pool
+from pipelines.base.vector_store import TenantPGVectorStore, VectorIndexManager, VectorIndexSettings
 
-url = make_url(os.environ.get('DOCUMENT_DATABASE_URL'))
+vector_index_settings = VectorIndexSettings()
 
-
-def reconnect_failed():
-    sys.exit(1)
-
-
-pool = AsyncConnectionPool(os.environ.get('DOCUMENT_DATABASE_URL'), open=False, reconnect_failed=reconnect_failed)
-
-vector_store = PGVectorStore.from_params(
-    database=url.database,
-    host=url.host,
-    password=url.password,
-    port=url.port,
-    user=url.username,
+vector_store = TenantPGVectorStore(
     table_name="documents",
     embed_dim=1536,
+    search_kwargs=vector_index_settings.search_kwargs(),
+    index_settings=vector_index_settings,
+    pool=pool,
 )
 
-index = VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
+vector_index_manager = VectorIndexManager(os.environ.get('DOCUMENT_DATABASE_URL'), vector_index_settings)
+
+docstore_kvstore = PoolKVStore(pool, table_name="docstore")
+
+docstore = KVDocumentStore(docstore_kvstore)
+
 
-query_engine = index.as_query_engine()
+@functools.lru_cache(maxsize=None)
+def get_index() -> VectorStoreIndex:
+    """The index retrievers are built from, created on first use."""
+    return VectorStoreIndex.from_vector_store(vector_store, embed_model=embed_model)
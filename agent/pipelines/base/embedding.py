@@ -1,11 +1,35 @@
+import os
+
 from dotenv import load_dotenv
 from llama_index.core import Settings
 from llama_index.embeddings.openai import OpenAIEmbedding
+from openai import AsyncOpenAI
+
+from pipelines.base.embedding_cache import CachedEmbedding, PostgresEmbeddingCacheStore
+from pipelines.base.llm import http_client
+from pipelines.base.pool import pool
 
 load_dotenv()
 
-embed_model = OpenAIEmbedding(
-    model="text-embedding-3-small",
+
+class SharedClientOpenAIEmbedding(OpenAIEmbedding):
+    """Sends async requests with the http client of the LLMs, so they share its connections and rate limits."""
+
+    def _get_aclient(self) -> AsyncOpenAI:
+        if self._aclient is None:
+            self._aclient = AsyncOpenAI(**{**self._get_credential_kwargs(), 'http_client': http_client})
+        return self._aclient
+
+
+embedding_cache_store = PostgresEmbeddingCacheStore(pool)
+
+embed_model = CachedEmbedding(
+    SharedClientOpenAIEmbedding(
+        model="text-embedding-3-small",
+        embed_batch_size=int(os.environ.get('EMBED_BATCH_SIZE', 100)),
+    ),
+    store=embedding_cache_store,
+    cache_size=int(os.environ.get('EMBEDDING_CACHE_SIZE', 5000)),
 )
 
 Settings.embed_model = embed_model
@@ -0,0 +1,239 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding, Embedding
+from llama_index.core.bridge.pydantic import Field, PrivateAttr
+
+from pipelines.base.metrics import metrics, timed
+from pipelines.base.pool import TimedConnectionPool
+
+logger = logging.getLogger(__name__)
+
+embedded_texts = metrics.counter('agent_embedded_texts_total', 'Texts sent to the embedding model, cache misses')
+
+
+class PostgresEmbeddingCacheStore:
+    """Persistent layer of the embedding cache, one row per content key."""
+
+    def __init__(self, pool: TimedConnectionPool, table_name: str = 'embedding_cache'):
+        self.pool = pool
+        self.table_name = table_name
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                               "key CHAR(64) PRIMARY KEY, "
+                               "model VARCHAR NOT NULL, "
+                               "embedding REAL[] NOT NULL, "
+                               "created_at TIMESTAMPTZ NOT NULL DEFAULT now())")
+
+    async def aget_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT key, embedding FROM {self.table_name} WHERE key = ANY(%s)", [keys])
+            return dict(await cursor.fetchall())
+
+    async def aput_many(self, model: str, items: Dict[str, List[float]]):
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(f"INSERT INTO {self.table_name} (key, model, embedding) "
+                                         "VALUES (%s, %s, %s) ON CONFLICT (key) DO NOTHING",
+                                         [(key, model, embedding) for key, embedding in items.items()])
+
+    def get_many(self, keys: List[str]) -> Dict[str, List[float]]:
+        return self.pool.run_sync(self.aget_many(keys))
+
+    def put_many(self, model: str, items: Dict[str, List[float]]):
+        self.pool.run_sync(self.aput_many(model, items))
+
+
+class CachedEmbedding(BaseEmbedding):
+    """Content-addressed cache in front of another embedding model.
+
+    Lookups go through an in-process LRU first, then the persistent store, and
+    only the remaining texts are sent to the wrapped model in one batch.
+    """
+
+    embed_model: BaseEmbedding = Field(description='The embedding model to cache.')
+    dimensions: Optional[int] = Field(default=None, description='Output dimensions of the wrapped model.')
+    cache_size: int = Field(default=5000, description='Number of embeddings kept in memory.')
+
+    _store: Optional[PostgresEmbeddingCacheStore] = PrivateAttr()
+    _lru: OrderedDict = PrivateAttr()
+    _lru_lock: threading.Lock = PrivateAttr()
+
+    _memory_hits: int = PrivateAttr(default=0)
+    _store_hits: int = PrivateAttr(default=0)
+    _misses: int = PrivateAttr(default=0)
+    _store_errors: int = PrivateAttr(default=0)
+
+    def __init__(self, embed_model: BaseEmbedding, store: Optional[PostgresEmbeddingCacheStore] = None,
+                 cache_size: int = 5000, **kwargs):
+        super().__init__(
+            embed_model=embed_model,
+            model_name=embed_model.model_name,
+            dimensions=getattr(embed_model, 'dimensions', None),
+            embed_batch_size=embed_model.embed_batch_size,
+            cache_size=cache_size,
+            **kwargs,
+        )
+        self._store = store
+        self._lru = OrderedDict()
+        self._lru_lock = threading.Lock()
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedEmbedding"
+
+    @property
+    def store(self) -> Optional[PostgresEmbeddingCacheStore]:
+        return self._store
+
+    def cache_key(self, text: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\x00{self.dimensions}\x00{text}".encode()).hexdigest()
+
+    def stats(self) -> dict:
+        requests = self._memory_hits + self._store_hits + self._misses
+
+        return {
+            'memoryHits': self._memory_hits,
+            'storeHits': self._store_hits,
+            'misses': self._misses,
+            'storeErrors': self._store_errors,
+            'hitRate': (self._memory_hits + self._store_hits) / requests if requests else 0.0,
+            'memorySize': len(self._lru),
+        }
+
+    def _lru_get(self, key: str) -> Optional[Embedding]:
+        with self._lru_lock:
+            value = self._lru.get(key)
+            if value is None:
+                return None
+
+            self._lru.move_to_end(key)
+            return value.tolist()
+
+    def _lru_put(self, key: str, embedding: Embedding):
+        with self._lru_lock:
+            self._lru[key] = np.asarray(embedding, dtype=np.float32)
+            self._lru.move_to_end(key)
+
+            while len(self._lru) > self.cache_size:
+                self._lru.popitem(last=False)
+
+    def _lookup_memory(self, keys: List[str]) -> Dict[str, Embedding]:
+        found = {}
+
+        for key in keys:
+            embedding = self._lru_get(key)
+            if embedding is not None:
+                found[key] = embedding
+
+        self._memory_hits += len(found)
+        return found
+
+    def _remember(self, found: Dict[str, Embedding]):
+        for key, embedding in found.items():
+            self._lru_put(key, embedding)
+
+    def _lookup(self, texts: List[str]) -> Tuple[List[str], Dict[str, Embedding], List[str]]:
+        """Keys of `texts`, what the LRU has of them and the distinct keys still missing."""
+        keys = [self.cache_key(text) for text in texts]
+        unique = list(dict.fromkeys(keys))
+        found = self._lookup_memory(unique)
+
+        return keys, found, [key for key in unique if key not in found]
+
+    def _add_stored(self, found: Dict[str, Embedding], stored: Dict[str, Embedding]):
+        self._store_hits += len(stored)
+        self._remember(stored)
+        found.update(stored)
+
+    def _to_compute(self, keys: List[str], texts: List[str], found: Dict[str, Embedding]) -> Dict[str, str]:
+        missing_texts = {key: text for key, text in zip(keys, texts) if key not in found}
+        self._misses += len(missing_texts)
+
+        return missing_texts
+
+    def _add_computed(self, found: Dict[str, Embedding], missing_texts: Dict[str, str],
+                      embeddings: List[Embedding]) -> Dict[str, Embedding]:
+        computed = dict(zip(missing_texts.keys(), embeddings))
+        embedded_texts.inc(amount=len(computed))
+        self._remember(computed)
+        found.update(computed)
+
+        return computed
+
+    def _store_failed(self, action: str, e: Exception):
+        self._store_errors += 1
+        logger.warning('Embedding cache %s failed: %s', action, e)
+
+    # the sync and async variants only differ in how they call the store and the model
+
+    async def _acached(self, texts: List[str], compute) -> List[Embedding]:
+        keys, found, missing = self._lookup(texts)
+        if missing and self._store is not None:
+            try:
+                self._add_stored(found, await self._store.aget_many(missing))
+            except Exception as e:
+                self._store_failed('lookup', e)
+
+        missing_texts = self._to_compute(keys, texts, found)
+        if missing_texts:
+            with timed('embedding'):
+                embeddings = await compute(list(missing_texts.values()))
+            computed = self._add_computed(found, missing_texts, embeddings)
+
+            if self._store is not None:
+                try:
+                    await self._store.aput_many(self.model_name, computed)
+                except Exception as e:
+                    self._store_failed('write', e)
+
+        return [found[key] for key in keys]
+
+    def _cached(self, texts: List[str], compute) -> List[Embedding]:
+        keys, found, missing = self._lookup(texts)
+        if missing and self._store is not None:
+            try:
+                self._add_stored(found, self._store.get_many(missing))
+            except Exception as e:
+                self._store_failed('lookup', e)
+
+        missing_texts = self._to_compute(keys, texts, found)
+        if missing_texts:
+            with timed('embedding'):
+                embeddings = compute(list(missing_texts.values()))
+            computed = self._add_computed(found, missing_texts, embeddings)
+
+            if self._store is not None:
+                try:
+                    self._store.put_many(self.model_name, computed)
+                except Exception as e:
+                    self._store_failed('write', e)
+
+        return [found[key] for key in keys]
+
+    def _get_query_embedding(self, query: str) -> Embedding:
+        return self._cached([query], lambda texts: [self.embed_model._get_query_embedding(texts[0])])[0]
+
+    async def _aget_query_embedding(self, query: str) -> Embedding:
+        async def compute(texts):
+            return [await self.embed_model._aget_query_embedding(texts[0])]
+
+        return (await self._acached([query], compute))[0]
+
+    def _get_text_embedding(self, text: str) -> Embedding:
+        return self._cached([text], self.embed_model._get_text_embeddings)[0]
+
+    async def _aget_text_embedding(self, text: str) -> Embedding:
+        return (await self._acached([text], self.embed_model._aget_text_embeddings))[0]
+
+    def _get_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return self._cached(texts, self.embed_model._get_text_embeddings)
+
+    async def _aget_text_embeddings(self, texts: List[str]) -> List[Embedding]:
+        return await self._acached(texts, self.embed_model._aget_text_embeddings)
@@ -0,0 +1,180 @@
+import asyncio
+import datetime
+import logging
+import os
+from dataclasses import dataclass, field
+from typing import Callable, Optional, Set
+
+import psycopg
+from psycopg.rows import class_row
+from psycopg.types.json import Jsonb
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.pool import pool
+
+logger = logging.getLogger(__name__)
+
+JOB_COLUMNS = "id, kind, company_id, payload, idempotency_key, status, attempts, max_attempts, progress, result, " \
+              "error, created_at, updated_at"
+
+
+@dataclass
+class Job:
+    id: int
+    kind: str
+    company_id: int
+    payload: dict
+    idempotency_key: Optional[str] = None
+    status: str = 'queued'
+    attempts: int = 0
+    max_attempts: int = 5
+    progress: dict = field(default_factory=dict)
+    result: Optional[dict] = None
+    error: Optional[str] = None
+    created_at: Optional[datetime.datetime] = None
+    updated_at: Optional[datetime.datetime] = None
+
+    def to_dict(self) -> dict:
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'companyId': self.company_id,
+            'status': self.status,
+            'attempts': self.attempts,
+            'maxAttempts': self.max_attempts,
+            'progress': self.progress,
+            'result': self.result,
+            'error': self.error,
+            'createdAt': self.created_at,
+            'updatedAt': self.updated_at,
+        }
+
+
+class JobStore:
+    """Durable ingestion jobs in Postgres, claimed by workers with FOR UPDATE SKIP LOCKED.
+
+    A running job whose worker stopped heartbeating for `lease` seconds is
+    claimed again. Workers announce ingested companies on the `channel`
+    notification channel, so API processes can drop their cached answers.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, max_attempts: int = 5, backoff: float = 10,
+                 lease: float = 300, table_name: str = 'ingestion_jobs', channel: str = 'ingested_companies'):
+        self.pool = pool
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.table_name = table_name
+        self.channel = channel
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                               "id BIGSERIAL PRIMARY KEY, "
+                               "kind VARCHAR NOT NULL, "
+                               "company_id BIGINT NOT NULL, "
+                               "payload JSONB NOT NULL, "
+                               "idempotency_key VARCHAR, "
+                               "status VARCHAR NOT NULL DEFAULT 'queued', "
+                               "attempts INT NOT NULL DEFAULT 0, "
+                               "max_attempts INT NOT NULL, "
+                               "run_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                               "progress JSONB NOT NULL DEFAULT '{}', "
+                               "result JSONB, "
+                               "error TEXT, "
+                               "created_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                               "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                               "UNIQUE (company_id, idempotency_key))")
+            await conn.execute(f"CREATE INDEX IF NOT EXISTS {self.table_name}_pending_idx "
+                               f"ON {self.table_name} (run_at) WHERE status IN ('queued', 'running')")
+
+    async def enqueue(self, kind: str, company_id: int, payload: dict, idempotency_key: Optional[str] = None) -> Job:
+        """Adds a job, or returns the existing one if the company already used `idempotency_key`."""
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=class_row(Job)) as cursor:
+                await cursor.execute(f"INSERT INTO {self.table_name} "
+                                     "(kind, company_id, payload, idempotency_key, max_attempts) "
+                                     "VALUES (%s, %s, %s, %s, %s) "
+                                     "ON CONFLICT (company_id, idempotency_key) DO UPDATE "
+                                     f"SET idempotency_key=EXCLUDED.idempotency_key RETURNING {JOB_COLUMNS}",
+                                     [kind, company_id, Jsonb(payload), idempotency_key, self.max_attempts])
+                return await cursor.fetchone()
+
+    async def get(self, job_id: int) -> Optional[Job]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=class_row(Job)) as cursor:
+                await cursor.execute(f"SELECT {JOB_COLUMNS} FROM {self.table_name} WHERE id=%s", [job_id])
+                return await cursor.fetchone()
+
+    async def claim(self) -> Optional[Job]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=class_row(Job)) as cursor:
+                # a job whose worker died on its last attempt is failed instead of being run once more
+                await cursor.execute(f"WITH expired AS (UPDATE {self.table_name} SET status='failed', "
+                                     "error='Lease expired on the last attempt', updated_at=now() "
+                                     "WHERE status='running' AND attempts >= max_attempts "
+                                     "AND updated_at < now() - make_interval(secs => %s)) "
+                                     f"UPDATE {self.table_name} SET status='running', attempts=attempts + 1, "
+                                     "updated_at=now() "
+                                     f"WHERE id = (SELECT id FROM {self.table_name} "
+                                     "WHERE (status='queued' AND run_at <= now()) "
+                                     "OR (status='running' AND attempts < max_attempts "
+                                     "AND updated_at < now() - make_interval(secs => %s)) "
+                                     "ORDER BY run_at LIMIT 1 FOR UPDATE SKIP LOCKED) "
+                                     f"RETURNING {JOB_COLUMNS}",
+                                     [self.lease, self.lease])
+                return await cursor.fetchone()
+
+    async def heartbeat(self, job: Job):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"UPDATE {self.table_name} SET updated_at=now() WHERE id=%s", [job.id])
+
+    async def update_progress(self, job: Job, progress: dict):
+        job.progress = {**job.progress, **progress}
+
+        async with self.pool.connection() as conn:
+            await conn.execute(f"UPDATE {self.table_name} SET progress=%s, updated_at=now() WHERE id=%s",
+                               [Jsonb(job.progress), job.id])
+            await conn.execute("SELECT pg_notify(%s, %s)", [self.channel, str(job.company_id)])
+
+    async def complete(self, job: Job, result: dict):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"UPDATE {self.table_name} SET status='succeeded', result=%s, error=NULL, "
+                               "updated_at=now() WHERE id=%s",
+                               [Jsonb(result), job.id])
+            await conn.execute("SELECT pg_notify(%s, %s)", [self.channel, str(job.company_id)])
+
+    async def fail(self, job: Job, error: str, retry: bool = True):
+        """Schedules the job again with exponential backoff, or fails it for good after `max_attempts`."""
+        if retry and job.attempts < job.max_attempts:
+            delay = self.backoff * 2 ** (job.attempts - 1)
+            status = 'queued'
+        else:
+            delay = 0
+            status = 'failed'
+
+        async with self.pool.connection() as conn:
+            await conn.execute(f"UPDATE {self.table_name} SET status=%s, error=%s, "
+                               "run_at=now() + make_interval(secs => %s), updated_at=now() WHERE id=%s",
+                               [status, error, delay, job.id])
+
+    async def listen(self, conninfo: str, callback: Callable[[Set[int]], None]):
+        """Calls `callback` with the companies workers ingested documents for, until cancelled."""
+        while True:
+            try:
+                async with await psycopg.AsyncConnection.connect(conninfo, autocommit=True) as conn:
+                    await conn.execute(f"LISTEN {self.channel}")
+
+                    async for notify in conn.notifies():
+                        callback({int(notify.payload)})
+            except psycopg.OperationalError:
+                logger.exception('Lost the %s listener connection', self.channel)
+                await asyncio.sleep(5)
+
+
+job_store = JobStore(
+    pool,
+    max_attempts=int(os.environ.get('JOB_MAX_ATTEMPTS', 5)),
+    backoff=float(os.environ.get('JOB_RETRY_BACKOFF', 10)),
+    lease=float(os.environ.get('JOB_LEASE', 300)),
+)
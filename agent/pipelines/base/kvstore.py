@@ -0,0 +1,79 @@
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core.storage.kvstore.types import DEFAULT_BATCH_SIZE, DEFAULT_COLLECTION, BaseKVStore
+from psycopg.types.json import Jsonb
+
+from pipelines.base.pool import TimedConnectionPool
+
+
+class PoolKVStore(BaseKVStore):
+    """Key-value store on the shared connection pool, the sync methods run the async ones on the pool's loop.
+
+    Uses the table layout of PostgresKVStore (with use_jsonb), so existing
+    docstore tables keep working.
+    """
+
+    def __init__(self, pool: TimedConnectionPool, table_name: str = 'docstore', schema_name: str = 'public'):
+        self.pool = pool
+        self.table_name = f"data_{table_name}"
+        self.qualified_table_name = f"{schema_name}.{self.table_name}"
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.qualified_table_name} ("
+                               "id SERIAL PRIMARY KEY, "
+                               "key VARCHAR NOT NULL, "
+                               "namespace VARCHAR NOT NULL, "
+                               "value JSONB, "
+                               f"CONSTRAINT \"{self.table_name}:unique_key_namespace\" UNIQUE (key, namespace))")
+
+    def put(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        self.pool.run_sync(self.aput(key, val, collection=collection))
+
+    def put_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION,
+                batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        self.pool.run_sync(self.aput_all(kv_pairs, collection=collection, batch_size=batch_size))
+
+    def get(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        return self.pool.run_sync(self.aget(key, collection=collection))
+
+    def get_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        return self.pool.run_sync(self.aget_all(collection=collection))
+
+    def delete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        return self.pool.run_sync(self.adelete(key, collection=collection))
+
+    async def aput(self, key: str, val: dict, collection: str = DEFAULT_COLLECTION) -> None:
+        await self.aput_all([(key, val)], collection=collection)
+
+    async def aput_all(self, kv_pairs: List[Tuple[str, dict]], collection: str = DEFAULT_COLLECTION,
+                       batch_size: int = DEFAULT_BATCH_SIZE) -> None:
+        if not kv_pairs:
+            return
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(f"INSERT INTO {self.qualified_table_name} (key, namespace, value) "
+                                         "VALUES (%s, %s, %s) "
+                                         "ON CONFLICT (key, namespace) DO UPDATE SET value=EXCLUDED.value",
+                                         [(key, collection, Jsonb(value)) for key, value in kv_pairs])
+
+    async def aget(self, key: str, collection: str = DEFAULT_COLLECTION) -> Optional[dict]:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT value FROM {self.qualified_table_name} "
+                                        "WHERE key=%s AND namespace=%s", [key, collection])
+            row = await cursor.fetchone()
+
+        return row[0] if row else None
+
+    async def aget_all(self, collection: str = DEFAULT_COLLECTION) -> Dict[str, dict]:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT key, value FROM {self.qualified_table_name} WHERE namespace=%s",
+                                        [collection])
+            return dict(await cursor.fetchall())
+
+    async def adelete(self, key: str, collection: str = DEFAULT_COLLECTION) -> bool:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"DELETE FROM {self.qualified_table_name} WHERE key=%s AND namespace=%s",
+                                        [key, collection])
+            return cursor.rowcount > 0
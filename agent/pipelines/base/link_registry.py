@@ -0,0 +1,68 @@
+import hashlib
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+from psycopg.rows import class_row
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.pool import pool
+
+
+@dataclass
+class LinkRecord:
+    company_id: int
+    link_hash: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_hash: Optional[str] = None
+    doc_ids: List[str] = field(default_factory=list)
+
+
+def hash_link(link: str) -> str:
+    return hashlib.sha256(link.encode()).hexdigest()
+
+
+class LinkRegistry:
+    """Remembers what was ingested from every (companyId, link) pair.
+
+    Links are stored hashed, since some of them (Telegram file links) embed
+    credentials.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, table_name: str = 'ingested_links'):
+        self.pool = pool
+        self.table_name = table_name
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                               "company_id BIGINT NOT NULL, "
+                               "link_hash CHAR(64) NOT NULL, "
+                               "etag VARCHAR, "
+                               "last_modified VARCHAR, "
+                               "content_hash CHAR(64), "
+                               "doc_ids VARCHAR[] NOT NULL DEFAULT '{}', "
+                               "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                               "PRIMARY KEY (company_id, link_hash))")
+
+    async def get(self, company_id: int, link: str) -> Optional[LinkRecord]:
+        async with self.pool.connection() as conn:
+            async with conn.cursor(row_factory=class_row(LinkRecord)) as cursor:
+                await cursor.execute(f"SELECT company_id, link_hash, etag, last_modified, content_hash, doc_ids "
+                                     f"FROM {self.table_name} WHERE company_id=%s AND link_hash=%s",
+                                     [company_id, hash_link(link)])
+                return await cursor.fetchone()
+
+    async def save(self, record: LinkRecord):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"INSERT INTO {self.table_name} "
+                               "(company_id, link_hash, etag, last_modified, content_hash, doc_ids) "
+                               "VALUES (%s, %s, %s, %s, %s, %s) "
+                               "ON CONFLICT (company_id, link_hash) DO UPDATE SET "
+                               "etag=EXCLUDED.etag, last_modified=EXCLUDED.last_modified, "
+                               "content_hash=EXCLUDED.content_hash, doc_ids=EXCLUDED.doc_ids, updated_at=now()",
+                               [record.company_id, record.link_hash, record.etag, record.last_modified,
+                                record.content_hash, record.doc_ids])
+
+
+link_registry = LinkRegistry(pool)
@@ -0,0 +1,86 @@
+import os
+import time
+from typing import Any, Dict, Tuple
+
+import httpx
+from dotenv import load_dotenv
+from llama_index.core.bridge.pydantic import PrivateAttr
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.llm import (LLMChatEndEvent, LLMChatInProgressEvent, LLMChatStartEvent,
+                                                         LLMCompletionEndEvent, LLMCompletionInProgressEvent,
+                                                         LLMCompletionStartEvent)
+from llama_index.llms.openai import OpenAI
+
+from pipelines.base.metrics import record_stage, record_tokens
+from pipelines.base.scheduler import ScheduledTransport, openai_scheduler
+
+load_dotenv()
+
+# one pooled http client shared by every LLM and the embeddings, so connections to the API are kept alive between
+# requests and every request goes through the rate limit scheduler
+http_client = httpx.AsyncClient(
+    transport=ScheduledTransport(httpx.AsyncHTTPTransport(limits=httpx.Limits(
+        max_connections=int(os.environ.get('LLM_MAX_CONNECTIONS', 100)),
+        max_keepalive_connections=int(os.environ.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20)),
+    )), openai_scheduler),
+    timeout=httpx.Timeout(600, connect=5),
+)
+
+
+def response_usage(response) -> Dict[str, int]:
+    """Token counts of a response, only reported by requests that don't stream."""
+    raw = getattr(response, 'raw', None)
+    usage = raw.get('usage') if isinstance(raw, dict) else getattr(raw, 'usage', None)
+    if usage is None:
+        return {}
+
+    if isinstance(usage, dict):
+        return {kind: usage[kind] for kind in ('prompt_tokens', 'completion_tokens') if usage.get(kind)}
+
+    return {kind: getattr(usage, kind) for kind in ('prompt_tokens', 'completion_tokens') if getattr(usage, kind, None)}
+
+
+class LlmTimer(BaseEventHandler):
+    """Times LLM requests and their first streamed token, and counts the tokens they report."""
+
+    # span id -> model, start time, whether a token was streamed yet
+    _started: Dict[str, Tuple[str, float, bool]] = PrivateAttr(default_factory=dict)
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LlmTimer"
+
+    def handle(self, event: BaseEvent, **kwargs) -> Any:
+        if isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            if event.span_id is not None:
+                self._started[event.span_id] = (event.model_dict.get('model', 'unknown'), time.perf_counter(), False)
+                # failed requests never end
+                if len(self._started) > 1000:
+                    self._started.pop(next(iter(self._started)))
+        elif isinstance(event, (LLMChatInProgressEvent, LLMCompletionInProgressEvent)):
+            started = self._started.get(event.span_id)
+            if started is not None and not started[2]:
+                self._started[event.span_id] = (started[0], started[1], True)
+                record_stage('llm_first_token', time.perf_counter() - started[1])
+        elif isinstance(event, (LLMChatEndEvent, LLMCompletionEndEvent)):
+            started = self._started.pop(event.span_id, None)
+            if started is None:
+                return
+
+            model = started[0]
+            record_stage('llm', time.perf_counter() - started[1])
+
+            for kind, count in response_usage(event.response).items():
+                record_tokens(model, kind, count)
+
+
+get_dispatcher().add_event_handler(LlmTimer())
+
+
+def build_llm(model: str, **kwargs) -> OpenAI:
+    return OpenAI(model=model, temperature=0.5, reuse_client=True, async_http_client=http_client, **kwargs)
+
+
+llm = build_llm("gpt-4o")
@@ -0,0 +1,200 @@
+import asyncio
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# seconds, from a cached embedding to a long completion
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values: Dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels: str, amount: float = 1.0):
+        with self._lock:
+            self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in list(self.values.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, labels)} {value}')
+
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket, the last one above every bucket], sum
+        self.values: Dict[tuple, Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels: str):
+        index = bisect_left(self.buckets, value)
+
+        with self._lock:
+            if labels not in self.values:
+                self.values[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+            counts, total = self.values[labels]
+            counts[index] += 1
+            total[0] += value
+
+    def render(self) -> List[str]:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in list(self.values.items()):
+            cumulative = 0
+            for bucket, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                le = f'le="{bucket}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, labels, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, labels)} {total[0]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, labels)} {cumulative}')
+
+        return lines
+
+
+class Gauge:
+    """A value read when metrics are collected."""
+
+    def __init__(self, name: str, documentation: str, read: Callable[[], float]):
+        self.name = name
+        self.documentation = documentation
+        self.read = read
+
+    def render(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge', f'{self.name} {self.read()}']
+
+
+class MetricsRegistry:
+    """Counters and histograms of the process in the Prometheus text format.
+
+    Observing takes a lock and a bisect, cheap enough to time every stage of
+    every request.
+    """
+
+    def __init__(self):
+        self.metrics: Dict[str, object] = {}
+
+    def _register(self, metric):
+        return self.metrics.setdefault(metric.name, metric)
+
+    def counter(self, name: str, documentation: str, labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, read: Callable[[], float]) -> Gauge:
+        return self._register(Gauge(name, documentation, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+metrics = MetricsRegistry()
+
+stage_seconds = metrics.histogram('agent_stage_seconds', 'Time spent in a stage of a request or ingestion',
+                                  ('stage',))
+tokens_total = metrics.counter('agent_tokens_total', 'Tokens sent to and received from models', ('model', 'kind'))
+
+
+class Trace:
+    """Time per stage of one request. Stages nest, retrieval includes the query embedding."""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages: Dict[str, List[float]] = {}
+        self.tokens: Dict[str, int] = {}
+
+    def add(self, stage: str, seconds: float):
+        timing = self.stages.setdefault(stage, [0.0, 0])
+        timing[0] += seconds
+        timing[1] += 1
+
+    def summary(self) -> str:
+        stages = ' '.join(f'{stage}={seconds:.3f}s/{count}' for stage, (seconds, count) in self.stages.items())
+        tokens = ' '.join(f'{kind}={count}' for kind, count in self.tokens.items())
+
+        return f'{stages} {tokens}'.strip()
+
+
+# the request in progress, set by the HTTP middleware
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+
+
+def record_stage(stage: str, seconds: float):
+    stage_seconds.observe(seconds, stage)
+
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add(stage, seconds)
+
+
+def record_tokens(model: str, kind: str, count: int):
+    tokens_total.inc(model, kind, amount=count)
+
+    trace = current_trace.get()
+    if trace is not None:
+        trace.tokens[kind] = trace.tokens.get(kind, 0) + count
+
+
+class timed:
+    """Records the time spent in the block as `stage`. A class, as it is cheaper to enter than a generator."""
+
+    __slots__ = ('stage', 'started')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.perf_counter() - self.started)
+
+
+async def serve_metrics(host: str, port: int) -> asyncio.AbstractServer:
+    """Answers every HTTP request with the metrics, for processes without an API like the ingestion worker."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.render().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                         % (CONTENT_TYPE.encode(), len(body)) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
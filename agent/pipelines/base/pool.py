@@ -0,0 +1,98 @@
+import asyncio
+import os
+import sys
+from typing import Awaitable, Optional, TypeVar
+
+from dotenv import load_dotenv
+from psycopg import AsyncConnection
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.metrics import metrics, timed
+
+load_dotenv()
+
+T = TypeVar('T')
+
+
+def reconnect_failed():
+    sys.exit(1)
+
+
+def prepare_threshold():
+    # empty disables prepared statements, e.g. behind pgbouncer in transaction mode
+    value = os.environ.get('DB_PREPARE_THRESHOLD', '2')
+
+    return int(value) if value else None
+
+
+class TimedConnectionPool(AsyncConnectionPool):
+    """Records how long every request waited for a connection.
+
+    Sync code, e.g. the sync API of llama-index stores called from a thread,
+    runs its queries on the pool through `run_sync`.
+    """
+
+    loop: Optional[asyncio.AbstractEventLoop] = None
+
+    async def open(self, *args, **kwargs):
+        self.loop = asyncio.get_running_loop()
+        await super().open(*args, **kwargs)
+
+    def run_sync(self, coroutine: Awaitable[T]) -> T:
+        """Runs `coroutine` on the loop the pool was opened on and waits for its result."""
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+
+        if self.loop is None or self.loop.is_closed() or running is self.loop:
+            coroutine.close()
+            raise RuntimeError('Sync database calls only work off the loop of the open pool, '
+                               'use the async API on the loop')
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    async def getconn(self, timeout: Optional[float] = None) -> AsyncConnection:
+        with timed('db_pool_wait'):
+            return await super().getconn(timeout)
+
+
+# the one pool of the process: retrieval, ingestion, the docstore and chat history all run on it
+pool = TimedConnectionPool(
+    os.environ.get('DOCUMENT_DATABASE_URL'),
+    open=False,
+    reconnect_failed=reconnect_failed,
+    min_size=int(os.environ.get('DB_POOL_MIN_SIZE', 4)),
+    max_size=int(os.environ.get('DB_POOL_MAX_SIZE', 20)),
+    timeout=float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    kwargs={
+        'options': f"-c statement_timeout={int(os.environ.get('DB_STATEMENT_TIMEOUT', 30000))}",
+        'prepare_threshold': prepare_threshold(),
+    },
+)
+
+
+def pool_stats() -> dict:
+    stats = pool.get_stats()
+    waits = stats.get('requests_queued', 0)
+
+    return {
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'min': stats.get('pool_min'),
+        'max': stats.get('pool_max'),
+        'waiting': stats.get('requests_waiting', 0),
+        'requests': stats.get('requests_num', 0),
+        'requestsQueued': waits,
+        'requestsErrors': stats.get('requests_errors', 0),
+        'totalWaitMs': stats.get('requests_wait_ms', 0),
+        'avgWaitMs': stats.get('requests_wait_ms', 0) / waits if waits else 0,
+        'totalUsageMs': stats.get('usage_ms', 0),
+        'connectionsLost': stats.get('connections_lost', 0),
+    }
+
+
+for name, key, documentation in (('size', 'pool_size', 'Connections open'),
+                                 ('available', 'pool_available', 'Connections idle in the pool'),
+                                 ('waiting', 'requests_waiting', 'Requests waiting for a connection')):
+    metrics.gauge(f'agent_db_pool_{name}', documentation, lambda key=key: pool.get_stats().get(key, 0))
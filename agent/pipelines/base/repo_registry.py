@@ -0,0 +1,47 @@
+from typing import Dict
+
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.pool import pool
+
+
+class RepoRegistry:
+    """Remembers the blob SHA of every ingested file of a repository."""
+
+    def __init__(self, pool: AsyncConnectionPool, table_name: str = 'ingested_repo_files'):
+        self.pool = pool
+        self.table_name = table_name
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.table_name} ("
+                               "company_id BIGINT NOT NULL, "
+                               "repo VARCHAR NOT NULL, "
+                               "path VARCHAR NOT NULL, "
+                               "blob_sha CHAR(40) NOT NULL, "
+                               "updated_at TIMESTAMPTZ NOT NULL DEFAULT now(), "
+                               "PRIMARY KEY (company_id, repo, path))")
+
+    async def get_files(self, company_id: int, repo: str) -> Dict[str, str]:
+        """Returns path -> blob SHA of the files ingested from the repository."""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT path, blob_sha FROM {self.table_name} "
+                                        "WHERE company_id=%s AND repo=%s",
+                                        [company_id, repo])
+            return dict(await cursor.fetchall())
+
+    async def save_file(self, company_id: int, repo: str, path: str, blob_sha: str):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"INSERT INTO {self.table_name} (company_id, repo, path, blob_sha) "
+                               "VALUES (%s, %s, %s, %s) "
+                               "ON CONFLICT (company_id, repo, path) DO UPDATE SET "
+                               "blob_sha=EXCLUDED.blob_sha, updated_at=now()",
+                               [company_id, repo, path, blob_sha])
+
+    async def delete_file(self, company_id: int, repo: str, path: str):
+        async with self.pool.connection() as conn:
+            await conn.execute(f"DELETE FROM {self.table_name} WHERE company_id=%s AND repo=%s AND path=%s",
+                               [company_id, repo, path])
+
+
+repo_registry = RepoRegistry(pool)
@@ -0,0 +1,286 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+from dotenv import load_dotenv
+
+from pipelines.base.metrics import metrics, record_stage
+
+load_dotenv()
+
+# lower goes first
+PRIORITIES = {'query': 0, 'suggest': 1, 'ingestion': 2}
+
+# completions that don't set max_tokens are charged this much up front
+DEFAULT_COMPLETION_TOKENS = 512
+
+# what the calls of the current task are for and which company they are made for
+current_priority: ContextVar[Tuple[str, Optional[int]]] = ContextVar('current_priority', default=('ingestion', None))
+
+queue_seconds = metrics.histogram('agent_openai_queue_seconds', 'Time OpenAI requests waited for rate limit quota',
+                                  ('resource', 'priority'))
+rate_limited_total = metrics.counter('agent_openai_rate_limited_total', 'OpenAI requests answered with 429',
+                                     ('resource',))
+
+
+def set_priority(priority: str, company_id: Optional[int] = None):
+    """Schedules the OpenAI calls of the rest of the task, and of the tasks it starts, at `priority`."""
+    if priority not in PRIORITIES:
+        raise ValueError(f'Unknown priority: {priority}')
+
+    current_priority.set((priority, company_id))
+
+
+class TokenBucket:
+    """Refills `per_minute` units evenly over a minute, holding at most a minute's worth. 0 is unlimited."""
+
+    def __init__(self, per_minute: int):
+        self.per_minute = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.per_minute, self.level + (now - self.updated) * self.per_minute / 60)
+        self.updated = now
+
+    def delay(self, amount: float) -> float:
+        """Seconds until `amount` can be taken, a request larger than the bucket waits for a full one."""
+        if not self.per_minute:
+            return 0.0
+
+        self._refill()
+        missing = min(amount, self.per_minute) - self.level
+
+        return max(missing, 0.0) * 60 / self.per_minute
+
+    def take(self, amount: float):
+        if self.per_minute:
+            self._refill()
+            self.level -= min(amount, self.per_minute)
+
+    def limit(self, remaining: float):
+        """Lowers the level to what the API reports as left, e.g. when other processes use the same account."""
+        if self.per_minute:
+            self._refill()
+            self.level = min(self.level, remaining)
+
+
+class Lane:
+    """Requests waiting for the quota of one resource, by priority and then by start-time fair queueing of companies.
+
+    Within a priority every company's requests get tags that advance by the
+    tokens they cost, so a company enqueueing a thousand embedding batches
+    doesn't hold back another one's single batch.
+    """
+
+    def __init__(self, name: str, rpm: int, tpm: int):
+        self.name = name
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        # priority, tag, sequence, cost, future
+        self.heap: List[tuple] = []
+        self.virtual: Dict[int, float] = {}
+        self.finish: Dict[Tuple[int, Optional[int]], float] = {}
+        self.sequence = 0
+        self.wakeup = asyncio.Event()
+        self.dispatcher: Optional[asyncio.Task] = None
+
+        self.granted: Dict[str, int] = {}
+        self.total_wait: Dict[str, float] = {}
+        self.max_wait: Dict[str, float] = {}
+        self.rate_limited = 0
+
+    @property
+    def limited(self) -> bool:
+        return bool(self.requests.per_minute or self.tokens.per_minute)
+
+    def _delay(self, cost: float) -> float:
+        return max(self.requests.delay(1), self.tokens.delay(cost))
+
+    def _take(self, cost: float):
+        self.requests.take(1)
+        self.tokens.take(cost)
+
+    async def acquire(self, priority: str, company_id: Optional[int], cost: float):
+        if not self.heap and self._delay(cost) == 0:
+            self._take(cost)
+            return
+
+        rank = PRIORITIES[priority]
+        tag = max(self.virtual.get(rank, 0.0), self.finish.get((rank, company_id), 0.0))
+        self.finish[(rank, company_id)] = tag + cost
+        self.sequence += 1
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.heap, (rank, tag, self.sequence, cost, future))
+        self.wakeup.set()
+
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.create_task(self._dispatch())
+
+        await future
+
+    async def _dispatch(self):
+        while True:
+            # cancelled requests leave their futures behind
+            while self.heap and self.heap[0][-1].done():
+                heapq.heappop(self.heap)
+
+            self.wakeup.clear()
+            if not self.heap:
+                await self.wakeup.wait()
+                continue
+
+            rank, tag, _, cost, future = self.heap[0]
+            delay = self._delay(cost)
+            if delay > 0:
+                # a request of a higher priority may arrive meanwhile
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self.heap)
+            self._take(cost)
+            self.virtual[rank] = tag
+            future.set_result(None)
+
+    def record(self, priority: str, wait: float):
+        self.granted[priority] = self.granted.get(priority, 0) + 1
+        self.total_wait[priority] = self.total_wait.get(priority, 0.0) + wait
+        self.max_wait[priority] = max(self.max_wait.get(priority, 0.0), wait)
+
+    def observe(self, response: httpx.Response):
+        if response.status_code == 429:
+            self.rate_limited += 1
+            rate_limited_total.inc(self.name)
+            # hold everyone back until the API refills, the client retries on its own
+            self.tokens.limit(0)
+            self.requests.limit(0)
+            return
+
+        for bucket, header in ((self.requests, 'x-ratelimit-remaining-requests'),
+                               (self.tokens, 'x-ratelimit-remaining-tokens')):
+            remaining = response.headers.get(header)
+            if remaining is not None and remaining.isdecimal():
+                bucket.limit(int(remaining))
+
+    def stats(self) -> dict:
+        waiting = {}
+        for rank, _, _, _, future in self.heap:
+            if not future.done():
+                priority = next(name for name, value in PRIORITIES.items() if value == rank)
+                waiting[priority] = waiting.get(priority, 0) + 1
+
+        return {
+            'rpm': self.requests.per_minute,
+            'tpm': self.tokens.per_minute,
+            'waiting': waiting,
+            'granted': self.granted,
+            'avgWait': {priority: self.total_wait[priority] / count for priority, count in self.granted.items()},
+            'maxWait': self.max_wait,
+            'rateLimited': self.rate_limited,
+        }
+
+
+def resource_of(path: str) -> Optional[str]:
+    if path.endswith('/embeddings'):
+        return 'embeddings'
+    if path.endswith('/completions'):
+        return 'chat'
+
+    return None
+
+
+def estimate_tokens(resource: str, request: httpx.Request) -> float:
+    """A cheap upper estimate: about four bytes of JSON per prompt token, plus the completion."""
+    try:
+        content = request.content
+    except httpx.RequestNotRead:
+        return DEFAULT_COMPLETION_TOKENS
+
+    tokens = len(content) / 4
+    if resource == 'chat':
+        try:
+            body = json.loads(content)
+        except ValueError:
+            body = {}
+        tokens += body.get('max_tokens') or body.get('max_completion_tokens') or DEFAULT_COMPLETION_TOKENS
+
+    return tokens
+
+
+class OpenAIScheduler:
+    """Makes every OpenAI call of the process wait for its share of the account's rate limits.
+
+    Requests and tokens per minute are accounted per resource (chat
+    completions and embeddings have separate limits), requests wait in
+    priority order, query before suggest before ingestion, and companies
+    share their priority fairly. Token counts are estimated up front and
+    corrected by the remaining quota the API reports with every response.
+    """
+
+    def __init__(self, limits: Dict[str, Tuple[int, int]]):
+        self.lanes = {name: Lane(name, rpm, tpm) for name, (rpm, tpm) in limits.items()}
+
+    async def acquire(self, resource: str, cost: float):
+        lane = self.lanes.get(resource)
+        if lane is None or not lane.limited:
+            return
+
+        priority, company_id = current_priority.get()
+        started = time.perf_counter()
+        await lane.acquire(priority, company_id, cost)
+        wait = time.perf_counter() - started
+
+        lane.record(priority, wait)
+        queue_seconds.observe(wait, resource, priority)
+        record_stage('openai_queue', wait)
+
+    def observe(self, resource: str, response: httpx.Response):
+        lane = self.lanes.get(resource)
+        if lane is not None:
+            lane.observe(response)
+
+    def waiting(self) -> int:
+        return sum(not future.done() for lane in self.lanes.values() for *_, future in lane.heap)
+
+    def stats(self) -> dict:
+        return {name: lane.stats() for name, lane in self.lanes.items()}
+
+
+class ScheduledTransport(httpx.AsyncBaseTransport):
+    """Sends OpenAI requests once the scheduler lets them through."""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, scheduler: OpenAIScheduler):
+        self.transport = transport
+        self.scheduler = scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        resource = resource_of(request.url.path)
+        if resource is None:
+            return await self.transport.handle_async_request(request)
+
+        await self.scheduler.acquire(resource, estimate_tokens(resource, request))
+        response = await self.transport.handle_async_request(request)
+        self.scheduler.observe(resource, response)
+
+        return response
+
+    async def aclose(self):
+        await self.transport.aclose()
+
+
+openai_scheduler = OpenAIScheduler({
+    'chat': (int(os.environ.get('OPENAI_CHAT_RPM', 0)), int(os.environ.get('OPENAI_CHAT_TPM', 0))),
+    'embeddings': (int(os.environ.get('OPENAI_EMBEDDING_RPM', 0)), int(os.environ.get('OPENAI_EMBEDDING_TPM', 0))),
+})
+
+metrics.gauge('agent_openai_queued', 'OpenAI requests waiting for rate limit quota', openai_scheduler.waiting)
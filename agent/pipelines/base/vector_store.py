@@ -0,0 +1,410 @@
+import logging
+import os
+from typing import Any, List, Optional, Sequence, Tuple
+
+import psycopg
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.schema import BaseNode, MetadataMode
+from llama_index.core.vector_stores.types import (BasePydanticVectorStore, FilterCondition, FilterOperator,
+                                                  MetadataFilter, MetadataFilters, VectorStoreQuery,
+                                                  VectorStoreQueryMode, VectorStoreQueryResult)
+from llama_index.core.vector_stores.utils import node_to_metadata_dict
+from llama_index.vector_stores.postgres import PGVectorStore
+from llama_index.vector_stores.postgres.base import DBEmbeddingRow
+from psycopg.types.json import Json
+
+logger = logging.getLogger(__name__)
+
+TENANT_KEY = 'companyId'
+
+# filter operator -> SQL operator on the text value of the metadata key
+FILTER_OPERATORS = {
+    FilterOperator.EQ: '=',
+    FilterOperator.NE: '!=',
+    FilterOperator.GT: '>',
+    FilterOperator.GTE: '>=',
+    FilterOperator.LT: '<',
+    FilterOperator.LTE: '<=',
+}
+
+
+def tenant_predicate(company_id) -> str:
+    # must stay textually identical between the partial indexes and the queries, or the planner won't use them
+    return f"(metadata_->>'{TENANT_KEY}') = '{int(company_id)}'"
+
+
+def vector_literal(embedding: Sequence[float]) -> str:
+    return '[' + ','.join(map(str, embedding)) + ']'
+
+
+class TenantPGVectorStore(PGVectorStore):
+    """PGVectorStore on the shared connection pool whose company filter matches the per-company partial ANN indexes.
+
+    Only the async API is supported: it never opens the SQLAlchemy engines of
+    PGVectorStore, so the process holds one pool for all of its queries.
+    """
+
+    search_kwargs: dict = Field(default_factory=dict, description="hnsw_ef_search / ivfflat_probes for queries")
+    index_settings: Any = Field(default=None, description="VectorIndexSettings the ANN pass is built from")
+    pool: Any = Field(default=None, description="AsyncConnectionPool all statements run on")
+
+    def __init__(self, table_name: str, schema_name: str = 'public', embed_dim: int = 1536, **kwargs: Any):
+        # PGVectorStore.__init__ only adds the SQLAlchemy model, which loads the postgres dialect at import time
+        BasePydanticVectorStore.__init__(
+            self,
+            connection_string='',
+            async_connection_string='',
+            table_name=table_name.lower(),
+            schema_name=schema_name.lower(),
+            embed_dim=embed_dim,
+            hybrid_search=False,
+            text_search_config='english',
+            cache_ok=False,
+            perform_setup=False,
+            debug=False,
+            use_jsonb=False,
+            **kwargs,
+        )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TenantPGVectorStore"
+
+    @property
+    def qualified_table_name(self) -> str:
+        return f"{self.schema_name}.data_{self.table_name}"
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.qualified_table_name} ("
+                               "id BIGSERIAL PRIMARY KEY, "
+                               "text VARCHAR NOT NULL, "
+                               "metadata_ JSON, "
+                               "node_id VARCHAR, "
+                               f"embedding VECTOR({self.embed_dim}))")
+
+    # the sync API, e.g. of retrievers run in a thread, runs the async one on the shared pool
+
+    def add(self, nodes: List[BaseNode], **add_kwargs: Any) -> List[str]:
+        return self.pool.run_sync(self.async_add(nodes, **add_kwargs))
+
+    def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        return self.pool.run_sync(self.aquery(query, **kwargs))
+
+    def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        self.pool.run_sync(self.adelete(ref_doc_id, **delete_kwargs))
+
+    async def async_add(self, nodes: List[BaseNode], **kwargs: Any) -> List[str]:
+        rows = [(node.get_content(metadata_mode=MetadataMode.NONE),
+                 Json(node_to_metadata_dict(node, remove_text=True, flat_metadata=self.flat_metadata)),
+                 node.node_id,
+                 vector_literal(node.get_embedding())) for node in nodes]
+
+        async with self.pool.connection() as conn:
+            async with conn.cursor() as cursor:
+                await cursor.executemany(f"INSERT INTO {self.qualified_table_name} "
+                                         "(text, metadata_, node_id, embedding) VALUES (%s, %s, %s, %s::vector)", rows)
+
+        return [node.node_id for node in nodes]
+
+    async def adelete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(f"DELETE FROM {self.qualified_table_name} WHERE metadata_->>'doc_id' = %s",
+                               [ref_doc_id])
+
+    async def aquery(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+        if query.mode != VectorStoreQueryMode.DEFAULT:
+            raise ValueError(f"Unsupported query mode: {query.mode}")
+
+        return self._db_rows_to_query_result(
+            await self._aquery_with_score(query.query_embedding, query.similarity_top_k, query.filters, **kwargs)
+        )
+
+    def _filter_sql(self, filters: MetadataFilters) -> Tuple[str, list]:
+        clauses = []
+        params = []
+
+        for filter_ in filters.filters:
+            if isinstance(filter_, MetadataFilters):
+                clause, clause_params = self._filter_sql(filter_)
+            elif filter_.key == TENANT_KEY and filter_.operator == FilterOperator.EQ:
+                clause, clause_params = tenant_predicate(filter_.value), []
+            elif filter_.operator in (FilterOperator.IN, FilterOperator.NIN):
+                negation = 'NOT ' if filter_.operator == FilterOperator.NIN else ''
+                clause = f"{negation}(metadata_->>%s) = ANY(%s)"
+                clause_params = [filter_.key, [str(value) for value in filter_.value]]
+            elif filter_.operator in FILTER_OPERATORS:
+                # numbers are compared as numbers, like PGVectorStore does
+                cast = '::float' if isinstance(filter_.value, (int, float)) and not isinstance(filter_.value, bool) \
+                    else ''
+                value = filter_.value if cast else str(filter_.value)
+                clause = f"(metadata_->>%s){cast} {FILTER_OPERATORS[filter_.operator]} %s"
+                clause_params = [filter_.key, value]
+            else:
+                raise ValueError(f"Unsupported filter operator: {filter_.operator}")
+
+            clauses.append(f"({clause})")
+            params.extend(clause_params)
+
+        condition = ' OR ' if filters.condition == FilterCondition.OR else ' AND '
+        return condition.join(clauses) or 'TRUE', params
+
+    def _query_sql(self, embedding: List[float], limit: int,
+                   metadata_filters: Optional[MetadataFilters]) -> Tuple[str, list]:
+        """Ranks the company's rows by the ANN representation, then re-ranks the candidates on full vectors."""
+        where, params = self._filter_sql(metadata_filters) if metadata_filters else ('TRUE', [])
+        query = vector_literal(embedding)
+
+        if self.index_settings is None or self.index_settings.exact:
+            return (f"SELECT node_id, text, metadata_, embedding <=> %s::vector AS distance "
+                    f"FROM {self.qualified_table_name} WHERE {where} ORDER BY distance LIMIT %s",
+                    [query, *params, limit])
+
+        return (f"SELECT node_id, text, metadata_, embedding <=> %s::vector AS distance FROM ("
+                f"SELECT node_id, text, metadata_, embedding FROM {self.qualified_table_name} WHERE {where} "
+                f"ORDER BY {self.index_settings.ann_distance('%s::vector')} LIMIT %s"
+                ") candidates ORDER BY distance LIMIT %s",
+                [query, *params, query, self.index_settings.candidates(limit), limit])
+
+    def _search_kwargs(self, limit: int, kwargs: dict) -> dict:
+        search_kwargs = {**self.search_kwargs, **kwargs}
+
+        # hnsw returns at most ef_search rows, which must cover the candidates to re-rank
+        if self.index_settings is not None and search_kwargs.get('hnsw_ef_search'):
+            search_kwargs['hnsw_ef_search'] = max(search_kwargs['hnsw_ef_search'],
+                                                  self.index_settings.candidates(limit))
+
+        return search_kwargs
+
+    async def _aquery_with_score(self, embedding: Optional[List[float]], limit: int = 10, metadata_filters=None,
+                                 **kwargs: Any) -> List[DBEmbeddingRow]:
+        search_kwargs = self._search_kwargs(limit, kwargs)
+        sql, params = self._query_sql(embedding, limit, metadata_filters)
+
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                if search_kwargs.get('hnsw_ef_search'):
+                    await conn.execute(f"SET LOCAL hnsw.ef_search = {int(search_kwargs['hnsw_ef_search'])}")
+                if search_kwargs.get('ivfflat_probes'):
+                    await conn.execute(f"SET LOCAL ivfflat.probes = {int(search_kwargs['ivfflat_probes'])}")
+
+                cursor = await conn.execute(sql, params)
+                rows = await cursor.fetchall()
+
+        return [DBEmbeddingRow(node_id=node_id, text=text, metadata=metadata,
+                               similarity=(1 - distance) if distance is not None else 0)
+                for node_id, text, metadata, distance in rows]
+
+
+# storage mode -> (pgvector type, distance operator, operator class suffix) of the vectors the ANN pass ranks
+STORAGE_MODES = {
+    'full': ('vector', '<=>', 'cosine_ops'),
+    'halfvec': ('halfvec', '<=>', 'cosine_ops'),
+    'binary': ('bit', '<~>', 'hamming_ops'),
+}
+
+
+class VectorIndexSettings:
+    """Build and search parameters of the ANN indexes.
+
+    The table always keeps the full embeddings. With a `storage_mode` other
+    than 'full' or fewer `search_dimensions`, indexes are built over a
+    truncated and/or quantized expression of them, which is much smaller,
+    and the top candidates of the ANN pass are re-ranked on full vectors.
+    """
+
+    def __init__(self, storage_mode: Optional[str] = None, search_dimensions: Optional[int] = None,
+                 embed_dim: int = 1536):
+        self.embed_dim = embed_dim
+        self.storage_mode = storage_mode or os.environ.get('VECTOR_STORAGE_MODE', 'full')
+        # text-embedding-3 vectors can be shortened by keeping their first dimensions
+        self.search_dimensions = search_dimensions or int(os.environ.get('VECTOR_SEARCH_DIMENSIONS', 0)) or embed_dim
+        # the ANN pass returns rerank_factor times the requested number of rows
+        self.rerank_factor = int(os.environ.get('VECTOR_RERANK_FACTOR', 4))
+        self.index_type = os.environ.get('VECTOR_INDEX_TYPE', 'hnsw')
+        self.hnsw_m = int(os.environ.get('HNSW_M', 16))
+        self.hnsw_ef_construction = int(os.environ.get('HNSW_EF_CONSTRUCTION', 64))
+        self.hnsw_ef_search = int(os.environ.get('HNSW_EF_SEARCH', 40))
+        self.ivfflat_lists = int(os.environ.get('IVFFLAT_LISTS', 0))
+        self.ivfflat_probes = int(os.environ.get('IVFFLAT_PROBES', 10))
+        # below this many rows an exact scan over the company's rows is fast enough
+        self.min_rows = int(os.environ.get('VECTOR_INDEX_MIN_ROWS', 1000))
+
+        if self.index_type not in ('hnsw', 'ivfflat'):
+            raise ValueError(f'Unknown VECTOR_INDEX_TYPE: {self.index_type}')
+        if self.storage_mode not in STORAGE_MODES:
+            raise ValueError(f'Unknown VECTOR_STORAGE_MODE: {self.storage_mode}')
+        if not 0 < self.search_dimensions <= embed_dim:
+            raise ValueError(f'VECTOR_SEARCH_DIMENSIONS must be between 1 and {embed_dim}')
+
+    @property
+    def exact(self) -> bool:
+        """Whether the ANN pass already ranks on full vectors, so there is nothing to re-rank."""
+        return self.storage_mode == 'full' and self.search_dimensions == self.embed_dim
+
+    @property
+    def suffix(self) -> str:
+        if self.exact:
+            return ''
+
+        return f"_{STORAGE_MODES[self.storage_mode][0]}{self.search_dimensions}"
+
+    def representation(self, vector: str = 'embedding') -> str:
+        """SQL of the vector, as stored in the ANN indexes."""
+        if self.search_dimensions != self.embed_dim:
+            vector = f"subvector({vector}, 1, {self.search_dimensions})"
+
+        if self.storage_mode == 'binary':
+            return f"(binary_quantize({vector})::bit({self.search_dimensions}))"
+
+        return f"({vector}::{STORAGE_MODES[self.storage_mode][0]}({self.search_dimensions}))"
+
+    def ann_distance(self, query_vector: str) -> str:
+        return f"{self.representation()} {STORAGE_MODES[self.storage_mode][1]} {self.representation(query_vector)}"
+
+    def candidates(self, limit: int) -> int:
+        return limit * self.rerank_factor
+
+    def bytes_per_vector(self) -> int:
+        if self.storage_mode == 'binary':
+            return 8 + (self.search_dimensions + 7) // 8
+
+        return 8 + self.search_dimensions * (4 if self.storage_mode == 'full' else 2)
+
+    def search_kwargs(self) -> dict:
+        if self.index_type == 'hnsw':
+            return {'hnsw_ef_search': self.hnsw_ef_search}
+
+        return {'ivfflat_probes': self.ivfflat_probes}
+
+    def index_options(self, rows: int) -> str:
+        vector_type, _, ops = STORAGE_MODES[self.storage_mode]
+        column = 'embedding' if self.exact else self.representation()
+        opclass = f"{vector_type}_{ops}"
+
+        if self.index_type == 'hnsw':
+            return f"USING hnsw ({column} {opclass}) " \
+                   f"WITH (m = {self.hnsw_m}, ef_construction = {self.hnsw_ef_construction})"
+
+        # pgvector recommends rows / 1000 lists for up to 1M rows
+        lists = self.ivfflat_lists or max(10, rows // 1000)
+        return f"USING ivfflat ({column} {opclass}) WITH (lists = {lists})"
+
+
+class VectorIndexManager:
+    """Creates and rebuilds the per-company partial ANN indexes of the documents table.
+
+    Index DDL runs CONCURRENTLY on a dedicated autocommit connection so
+    ingestion and retrieval keep working while indexes are built.
+    """
+
+    def __init__(self, conninfo: str, settings: VectorIndexSettings, table_name: str = 'data_documents'):
+        self.conninfo = conninfo
+        self.settings = settings
+        self.table_name = table_name
+
+    def index_name(self, company_id: int) -> str:
+        return f"{self.table_name}_company_{int(company_id)}_{self.settings.index_type}{self.settings.suffix}_idx"
+
+    async def _connect(self) -> psycopg.AsyncConnection:
+        return await psycopg.AsyncConnection.connect(self.conninfo, autocommit=True)
+
+    async def companies(self, conn: psycopg.AsyncConnection) -> List[tuple]:
+        cursor = await conn.execute(f"SELECT (metadata_->>'{TENANT_KEY}')::bigint, count(*) FROM {self.table_name} "
+                                    f"WHERE metadata_->>'{TENANT_KEY}' IS NOT NULL GROUP BY 1 ORDER BY 1")
+        return await cursor.fetchall()
+
+    async def ensure_tenant_index(self, conn: psycopg.AsyncConnection):
+        await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {self.table_name}_company_idx "
+                           f"ON {self.table_name} ((metadata_->>'{TENANT_KEY}'))")
+
+    async def create(self, company_id: Optional[int] = None, force: bool = False) -> List[str]:
+        """Creates missing indexes for one or all companies, skipping companies below min_rows."""
+        created = []
+
+        async with await self._connect() as conn:
+            await self.ensure_tenant_index(conn)
+
+            for company, rows in await self.companies(conn):
+                if company_id is not None and company != company_id:
+                    continue
+                if rows < self.settings.min_rows and not force:
+                    continue
+
+                name = self.index_name(company)
+                await conn.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {self.table_name} "
+                                   f"{self.settings.index_options(rows)} WHERE {tenant_predicate(company)}")
+                created.append(name)
+                logger.info('Index %s is ready (%d rows)', name, rows)
+
+        return created
+
+    async def rebuild(self, company_id: Optional[int] = None) -> List[str]:
+        """Drops and recreates indexes, picking up changed build parameters and data distribution."""
+        await self.drop(company_id)
+        return await self.create(company_id)
+
+    async def drop(self, company_id: Optional[int] = None) -> List[str]:
+        dropped = []
+
+        async with await self._connect() as conn:
+            for name, _, _ in await self._indexes(conn):
+                if company_id is not None and not name.startswith(f"{self.table_name}_company_{company_id}_"):
+                    continue
+
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                dropped.append(name)
+
+        return dropped
+
+    async def prune(self, company_id: Optional[int] = None) -> List[str]:
+        """Drops indexes built with other settings, e.g. the full vector indexes after switching storage mode."""
+        dropped = []
+
+        async with await self._connect() as conn:
+            current = {self.index_name(company) for company, _ in await self.companies(conn)}
+
+            for name, _, _ in await self._indexes(conn):
+                if name in current:
+                    continue
+                if company_id is not None and not name.startswith(f"{self.table_name}_company_{company_id}_"):
+                    continue
+
+                await conn.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+                dropped.append(name)
+
+        return dropped
+
+    async def prewarm(self, create_extension: bool = False) -> List[str]:
+        """Loads the ANN indexes into shared buffers, if the pg_prewarm extension is installed.
+
+        Searches read the whole index but only a few heap pages, so the table is left alone.
+        """
+        async with await self._connect() as conn:
+            if create_extension:
+                await conn.execute("CREATE EXTENSION IF NOT EXISTS pg_prewarm")
+
+            cursor = await conn.execute("SELECT 1 FROM pg_extension WHERE extname='pg_prewarm'")
+            if await cursor.fetchone() is None:
+                logger.info('Skipping prewarm, the pg_prewarm extension is not installed')
+                return []
+
+            indexes = [name for name, _, _ in await self._indexes(conn)]
+            for index in indexes:
+                await conn.execute("SELECT pg_prewarm(%s::regclass)", [index])
+
+        return indexes
+
+    async def status(self) -> List[dict]:
+        async with await self._connect() as conn:
+            return [{'index': name, 'size': size, 'definition': definition}
+                    for name, size, definition in await self._indexes(conn)]
+
+    async def _indexes(self, conn: psycopg.AsyncConnection) -> List[tuple]:
+        cursor = await conn.execute("SELECT indexname, pg_size_pretty(pg_relation_size(indexname::regclass)), "
+                                    "indexdef FROM pg_indexes "
+                                    "WHERE tablename=%s AND indexname ~ %s ORDER BY indexname",
+                                    [self.table_name, f"^{self.table_name}_company_[0-9]+_(hnsw|ivfflat)"
+                                                      f"(_(vector|halfvec|bit)[0-9]+)?_idx$"])
+        return await cursor.fetchall()
@@ -0,0 +1,201 @@
+import functools
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Set
+
+import tiktoken
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.prompts import BasePromptTemplate
+from llama_index.core.query_pipeline import CustomQueryComponent
+from llama_index.core.schema import BaseNode, MetadataMode, NodeRelationship, NodeWithScore, TransformComponent
+
+from pipelines.base.metrics import metrics
+from pipelines.query_pipeline import current_run
+
+TOKENS_KEY = 'tokens'
+
+# the synthesizer joins node contents with a blank line
+SEPARATOR_TOKENS = 2
+
+WORD = re.compile(r'\w+')
+
+ingested_tokens = metrics.counter('agent_ingested_tokens_total', 'Tokens of the nodes ingested')
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model: str) -> tiktoken.Encoding:
+    return tiktoken.encoding_for_model(model)
+
+
+def count_tokens(text: str, model: str = 'gpt-4o') -> int:
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+class TokenCounter(TransformComponent):
+    """Stores the number of tokens a node takes in a prompt in its metadata."""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "TokenCounter"
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        for node in nodes:
+            for keys in (node.excluded_embed_metadata_keys, node.excluded_llm_metadata_keys):
+                if TOKENS_KEY not in keys:
+                    keys.append(TOKENS_KEY)
+
+            node.metadata[TOKENS_KEY] = count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+
+        ingested_tokens.inc(amount=sum(node.metadata[TOKENS_KEY] for node in nodes))
+
+        return nodes
+
+
+def node_tokens(node: BaseNode) -> int:
+    tokens = node.metadata.get(TOKENS_KEY)
+    if tokens is None:
+        # nodes ingested before token counts were stored
+        tokens = count_tokens(node.get_content(metadata_mode=MetadataMode.LLM))
+
+    return tokens
+
+
+def _shingles(text: str, size: int = 3) -> Set[tuple]:
+    words = WORD.findall(text.lower())
+
+    return {tuple(words[i:i + size]) for i in range(max(len(words) - size + 1, 1))}
+
+
+def _similarity(a: Set[tuple], b: Set[tuple]) -> float:
+    if not a or not b:
+        return 0.0
+
+    return len(a & b) / len(a | b)
+
+
+def _follows(a: BaseNode, b: BaseNode, max_gap: int) -> bool:
+    """Whether `b` continues `a` in their source document."""
+    next_node = a.relationships.get(NodeRelationship.NEXT)
+    if next_node is not None and next_node.node_id == b.node_id:
+        return True
+
+    return (a.end_char_idx is not None and b.start_char_idx is not None
+            and a.start_char_idx <= b.start_char_idx <= a.end_char_idx + max_gap)
+
+
+def _merge(a: NodeWithScore, b: NodeWithScore) -> NodeWithScore:
+    first, second = a.node, b.node
+
+    if first.end_char_idx is not None and second.start_char_idx is not None:
+        overlap = max(first.end_char_idx - second.start_char_idx, 0)
+        text = first.text + second.text[overlap:]
+        end_char_idx = max(first.end_char_idx, second.end_char_idx or 0)
+    else:
+        text = first.text + ' ' + second.text
+        end_char_idx = None
+
+    node = first.copy()
+    node.text = text
+    node.end_char_idx = end_char_idx
+    node.relationships = {**first.relationships}
+    if NodeRelationship.NEXT in second.relationships:
+        node.relationships[NodeRelationship.NEXT] = second.relationships[NodeRelationship.NEXT]
+    # the metadata header is only repeated once, so the sum overestimates a bit
+    node.metadata = {**first.metadata, TOKENS_KEY: node_tokens(first) + node_tokens(second)}
+
+    return NodeWithScore(node=node, score=max(a.score or 0.0, b.score or 0.0))
+
+
+class ContextPackerComponent(CustomQueryComponent):
+    """Fits retrieved nodes into a token budget, so the synthesizer makes a single LLM call.
+
+    Adjacent chunks of the same document are merged, near-duplicates are
+    dropped and the best scoring nodes are kept while they fit in what the
+    prompt, filled with the query and prompt args, leaves of the budget.
+    """
+
+    prompt: BasePromptTemplate = Field(..., description="Prompt the nodes are synthesized with")
+    token_budget: int = Field(default=12000, description="Tokens the filled prompt may take")
+    dedup_threshold: float = Field(default=0.9, description="Shingle similarity above which nodes are duplicates")
+    max_gap: int = Field(default=2, description="Characters between chunks still considered adjacent")
+
+    @property
+    def _input_keys(self) -> Set[str]:
+        return {"query_str", "nodes", "prompt_args"}
+
+    @property
+    def _output_keys(self) -> Set[str]:
+        return {"nodes"}
+
+    def merge_adjacent(self, nodes: Sequence[NodeWithScore]) -> List[NodeWithScore]:
+        by_source: Dict[Optional[str], List[NodeWithScore]] = {}
+        for node in nodes:
+            by_source.setdefault(node.node.ref_doc_id, []).append(node)
+
+        merged = []
+        for source, source_nodes in by_source.items():
+            if source is None:
+                merged.extend(source_nodes)
+                continue
+
+            source_nodes.sort(key=lambda n: n.node.start_char_idx if n.node.start_char_idx is not None else -1)
+            current = source_nodes[0]
+            for node in source_nodes[1:]:
+                if _follows(current.node, node.node, self.max_gap):
+                    current = _merge(current, node)
+                else:
+                    merged.append(current)
+                    current = node
+            merged.append(current)
+
+        return sorted(merged, key=lambda n: n.score or 0.0, reverse=True)
+
+    def drop_duplicates(self, nodes: Sequence[NodeWithScore]) -> List[NodeWithScore]:
+        kept = []
+        kept_shingles = []
+
+        # nodes come best first, so the better scoring copy is the one kept
+        for node in nodes:
+            shingles = _shingles(node.node.get_content())
+            if any(_similarity(shingles, other) >= self.dedup_threshold for other in kept_shingles):
+                continue
+
+            kept.append(node)
+            kept_shingles.append(shingles)
+
+        return kept
+
+    def prompt_tokens(self, query_str: str, prompt_args: dict) -> int:
+        return count_tokens(self.prompt.format(query_str=query_str, context_str='', **prompt_args))
+
+    def pack(self, query_str: str, nodes: Sequence[NodeWithScore], prompt_args: dict) -> List[NodeWithScore]:
+        budget = self.token_budget - self.prompt_tokens(query_str, prompt_args)
+
+        packed = []
+        for node in self.drop_duplicates(self.merge_adjacent(nodes)):
+            tokens = node_tokens(node.node) + SEPARATOR_TOKENS
+            if tokens <= budget:
+                packed.append(node)
+                budget -= tokens
+
+        run = current_run.get()
+        if run is not None:
+            run.nodes_retrieved += len(nodes)
+            run.nodes_packed += len(packed)
+            run.context_tokens += self.token_budget - budget
+
+        return packed
+
+    def _run_component(self, query_str: str, nodes: list, prompt_args: dict) -> Dict[str, Any]:
+        return {"nodes": self.pack(query_str, nodes, prompt_args)}
+
+    async def _arun_component(self, query_str: str, nodes: list, prompt_args: dict) -> Dict[str, Any]:
+        return self._run_component(query_str, nodes, prompt_args)
+
+
+def build_context_packer(prompt: BasePromptTemplate) -> ContextPackerComponent:
+    return ContextPackerComponent(
+        prompt=prompt,
+        token_budget=int(os.environ.get('CONTEXT_TOKEN_BUDGET', 12000)),
+        dedup_threshold=float(os.environ.get('CONTEXT_DEDUP_THRESHOLD', 0.9)),
+    )
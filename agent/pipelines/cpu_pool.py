@@ -0,0 +1,153 @@
+"""Process pool for CPU-bound parsing, so it doesn't block the event loop.
+
+Worker processes are spawned and only import this module, so it must not
+import anything that opens connections (the db, embedding or llm modules).
+Parsers are imported where they are used, so neither the API nor the
+workers pay for them at startup.
+"""
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+from llama_index.core import Document, SimpleDirectoryReader
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.node_parser import CodeSplitter
+from llama_index.core.schema import BaseNode, TransformComponent
+
+from pipelines.base.metrics import timed
+
+# language -> CodeSplitter, kept for the lifetime of each worker process
+_code_splitters: Dict[str, CodeSplitter] = {}
+
+
+def _code_splitter(language: str) -> CodeSplitter:
+    if language not in _code_splitters:
+        import tree_sitter_languages
+
+        _code_splitters[language] = CodeSplitter(language=language,
+                                                 parser=tree_sitter_languages.get_parser(language))
+
+    return _code_splitters[language]
+
+
+def _warm_up(languages: Sequence[str]):
+    for language in languages:
+        _code_splitter(language)
+
+
+def _timed(fn: Callable, *args) -> Tuple[Any, float]:
+    started = time.process_time()
+    result = fn(*args)
+
+    return result, time.process_time() - started
+
+
+def split_code(language: str, nodes: List[BaseNode]) -> List[BaseNode]:
+    return _code_splitter(language).get_nodes_from_documents(nodes)
+
+
+def read_pdf_pages(file_path: str, start: int, end: int) -> List[Tuple[str, str]]:
+    import pypdf
+
+    with open(file_path, 'rb') as f:
+        reader = pypdf.PdfReader(f)
+        end = min(end, len(reader.pages))
+
+        return [(reader.page_labels[page], reader.pages[page].extract_text()) for page in range(start, end)]
+
+
+def count_pdf_pages(file_path: str) -> int:
+    import pypdf
+
+    with open(file_path, 'rb') as f:
+        return len(pypdf.PdfReader(f).pages)
+
+
+def load_file(file_path: str, metadata: dict) -> List[Document]:
+    return SimpleDirectoryReader(input_files=[file_path], file_metadata=lambda path: metadata).load_data()
+
+
+class CpuPool:
+    """Runs functions of this module in worker processes and records their CPU time per task name.
+
+    With `size` 0 functions run in a thread of the current process instead.
+    """
+
+    def __init__(self, size: int, warm_languages: Sequence[str] = ()):
+        self.size = size
+        self.warm_languages = list(warm_languages)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.tasks: Dict[str, dict] = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.size,
+                                                 mp_context=multiprocessing.get_context('spawn'),
+                                                 initializer=_warm_up, initargs=(self.warm_languages,))
+
+        return self._executor
+
+    async def run(self, fn: Callable, *args) -> Any:
+        started = time.perf_counter()
+
+        if self.size:
+            loop = asyncio.get_running_loop()
+            result, cpu_time = await loop.run_in_executor(self._get_executor(), _timed, fn, *args)
+        else:
+            result, cpu_time = await asyncio.to_thread(_timed, fn, *args)
+
+        self._record(fn.__name__, cpu_time, time.perf_counter() - started)
+
+        return result
+
+    async def warm_up(self):
+        """Starts the worker processes and loads the parsers of the warm languages in each."""
+        await asyncio.gather(*(self.run(_warm_up, self.warm_languages) for _ in range(max(self.size, 1))))
+
+    def _record(self, name: str, cpu_time: float, duration: float):
+        task = self.tasks.setdefault(name, {'runs': 0, 'totalCpuTime': 0.0, 'maxCpuTime': 0.0, 'totalDuration': 0.0})
+        task['runs'] += 1
+        task['totalCpuTime'] += cpu_time
+        task['maxCpuTime'] = max(task['maxCpuTime'], cpu_time)
+        task['totalDuration'] += duration
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'tasks': {
+                name: {**task, 'avgCpuTime': task['totalCpuTime'] / task['runs']}
+                for name, task in self.tasks.items()
+            },
+        }
+
+
+class PooledCodeSplitter(TransformComponent):
+    """CodeSplitter whose async path parses in the CPU pool with a warm parser for the language."""
+
+    language: str = Field(description="tree-sitter language")
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "PooledCodeSplitter"
+
+    def __call__(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        with timed('splitting'):
+            return split_code(self.language, nodes)
+
+    async def acall(self, nodes: List[BaseNode], **kwargs: Any) -> List[BaseNode]:
+        with timed('splitting'):
+            return await cpu_pool.run(split_code, self.language, nodes)
+
+
+cpu_pool = CpuPool(
+    size=int(os.environ.get('CPU_POOL_SIZE', os.cpu_count() or 1)),
+    warm_languages=[language for language in os.environ.get('CPU_POOL_WARM_LANGUAGES', '').split(',') if language],
+)
@@ -1,23 +1,67 @@
-import tree_sitter_languages
+import functools
+import os
+from collections import Counter
+from typing import Callable, Iterable, List, Set
+
+from llama_index.core import Document
 from llama_index.core.ingestion import IngestionPipeline, DocstoreStrategy
-from llama_index.core.node_parser import SemanticSplitterNodeParser, CodeSplitter
 
-from pipelines.base.db import vector_store
+from pipelines.base.db import vector_store, docstore
 from pipelines.base.embedding import embed_model
+from pipelines.base.scheduler import set_priority
+from pipelines.context_packer import TokenCounter
+from pipelines.cpu_pool import PooledCodeSplitter
+from pipelines.semantic_splitter import EmbeddingSemanticSplitterNodeParser
 
-splitter = SemanticSplitterNodeParser(
-    buffer_size=1, breakpoint_percentile_threshold=95, embed_model=embed_model
+splitter = EmbeddingSemanticSplitterNodeParser(
+    buffer_size=1, breakpoint_percentile_threshold=95, embed_model=embed_model,
+    short_input_sentences=int(os.environ.get('SPLITTER_SHORT_INPUT_SENTENCES', 3)),
+    node_embedding_mode=os.environ.get('SPLITTER_NODE_EMBEDDING_MODE', 'derive'),
 )
 
+# the splitter embeds the nodes it produces, so no separate embed_model step is needed;
+# pipelines live for the whole process, so the in-memory transformation cache would only grow
 TextIngestionPipeline = IngestionPipeline(transformations=[
     splitter,
-    embed_model,
-], vector_store=vector_store, docstore_strategy=DocstoreStrategy.UPSERTS)
+    TokenCounter(),
+], vector_store=vector_store, docstore_strategy=DocstoreStrategy.UPSERTS, disable_cache=True)
+
+# files get stable document ids, so the docstore can skip unchanged documents and replace changed ones
+FileIngestionPipeline = IngestionPipeline(transformations=[
+    splitter,
+    TokenCounter(),
+], vector_store=vector_store, docstore=docstore, docstore_strategy=DocstoreStrategy.UPSERTS,
+    disable_cache=True)
 
 
-def build_code_ingestion_pipeline(language: str):
-    parser = tree_sitter_languages.get_parser(language)
+@functools.lru_cache(maxsize=None)
+def get_code_ingestion_pipeline(language: str) -> IngestionPipeline:
+    # the docstore already skips unchanged documents
     return IngestionPipeline(transformations=[
-        CodeSplitter(language=language, parser=parser),
+        PooledCodeSplitter(language=language),
+        TokenCounter(),
         embed_model,
-    ], vector_store=vector_store, docstore_strategy=DocstoreStrategy.UPSERTS)
+    ], vector_store=vector_store, docstore=docstore, docstore_strategy=DocstoreStrategy.UPSERTS,
+        disable_cache=True)
+
+
+# called with the ids of companies whose documents were just added, changed or removed
+ingestion_listeners: List[Callable[[Set[int]], None]] = []
+
+
+def notify_ingested(company_ids: Iterable[int]):
+    company_ids = set(company_ids) - {None}
+
+    for listener in ingestion_listeners:
+        listener(company_ids)
+
+
+async def arun_ingestion(pipeline: IngestionPipeline, documents: List[Document], **kwargs):
+    # a batch of the ingestion queue may mix companies, it waits in line as the one with most documents
+    companies = Counter(doc.metadata.get('companyId') for doc in documents)
+    set_priority('ingestion', companies.most_common(1)[0][0] if companies else None)
+
+    nodes = await pipeline.arun(documents=documents, **kwargs)
+    notify_ingested(doc.metadata.get('companyId') for doc in documents)
+
+    return nodes
@@ -0,0 +1,159 @@
+import asyncio
+import logging
+import os
+import time
+from typing import List, Optional
+
+from llama_index.core import Document
+from llama_index.core.ingestion import IngestionPipeline
+
+from pipelines.ingestion_pipeline import TextIngestionPipeline, arun_ingestion
+
+logger = logging.getLogger(__name__)
+
+_STOP = object()
+
+
+class QueueClosedError(RuntimeError):
+    pass
+
+
+class IngestionQueue:
+    """Coalesces documents from concurrent requests into batched pipeline runs.
+
+    A batch is flushed when it reaches `max_batch_size` documents or when the
+    oldest document in it has waited `max_delay` seconds.
+    """
+
+    def __init__(self, pipeline: IngestionPipeline, max_batch_size: int = 64, max_delay: float = 0.5,
+                 max_size: int = 10000, workers: int = 1):
+        self.pipeline = pipeline
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_size = max_size
+        self.workers = workers
+
+        self._queue: Optional[asyncio.Queue] = None
+        self._tasks: List[asyncio.Task] = []
+        self._closed = True
+        # puts that were accepted and may still wait for room in the queue
+        self._pending_puts = 0
+        self._puts_done = asyncio.Event()
+
+        self.enqueued_documents = 0
+        self.flushed_documents = 0
+        self.flushes = 0
+        self.failed_flushes = 0
+        self.last_flush_size = 0
+        self.last_flush_duration = 0.0
+        self.total_flush_duration = 0.0
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize() if self._queue else 0
+
+    async def start(self):
+        self._queue = asyncio.Queue(maxsize=self.max_size)
+        self._closed = False
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """Stops accepting documents and waits until everything queued is flushed."""
+        if self._closed:
+            return
+
+        self._closed = True
+        # the sentinels go last, behind the documents of every accepted put
+        if self._pending_puts:
+            self._puts_done.clear()
+            await self._puts_done.wait()
+
+        for _ in self._tasks:
+            await self._queue.put(_STOP)
+
+        await asyncio.gather(*self._tasks)
+        self._tasks = []
+
+    async def put(self, documents: List[Document]):
+        if self._closed:
+            raise QueueClosedError('Ingestion queue is not running')
+
+        self._pending_puts += 1
+        try:
+            for document in documents:
+                await self._queue.put(document)
+                self.enqueued_documents += 1
+        finally:
+            self._pending_puts -= 1
+            if not self._pending_puts:
+                self._puts_done.set()
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        stopping = False
+
+        while not stopping:
+            item = await self._queue.get()
+            if item is _STOP:
+                break
+
+            batch = [item]
+            deadline = loop.time() + self.max_delay
+
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+
+                try:
+                    item = await asyncio.wait_for(self._queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+
+                if item is _STOP:
+                    stopping = True
+                    break
+
+                batch.append(item)
+
+            await self._flush(batch)
+
+    async def _flush(self, batch: List[Document]):
+        started = time.perf_counter()
+
+        try:
+            await arun_ingestion(self.pipeline, batch)
+            self.flushed_documents += len(batch)
+        except Exception:
+            self.failed_flushes += 1
+            logger.exception('Failed to ingest batch of %d documents', len(batch))
+        finally:
+            duration = time.perf_counter() - started
+
+            self.flushes += 1
+            self.last_flush_size = len(batch)
+            self.last_flush_duration = duration
+            self.total_flush_duration += duration
+
+    def stats(self) -> dict:
+        return {
+            'depth': self.depth,
+            'enqueuedDocuments': self.enqueued_documents,
+            'flushedDocuments': self.flushed_documents,
+            'flushes': self.flushes,
+            'failedFlushes': self.failed_flushes,
+            'lastFlushSize': self.last_flush_size,
+            'lastFlushDuration': self.last_flush_duration,
+            'avgFlushDuration': self.total_flush_duration / self.flushes if self.flushes else 0.0,
+            'avgFlushSize': (self.flushed_documents / (self.flushes - self.failed_flushes)
+                             if self.flushes > self.failed_flushes else 0.0),
+        }
+
+
+text_ingestion_queue = IngestionQueue(
+    TextIngestionPipeline,
+    max_batch_size=int(os.environ.get('INGESTION_BATCH_SIZE', 64)),
+    max_delay=float(os.environ.get('INGESTION_MAX_DELAY', 0.5)),
+    max_size=int(os.environ.get('INGESTION_QUEUE_SIZE', 10000)),
+    workers=int(os.environ.get('INGESTION_WORKERS', 1)),
+)
@@ -0,0 +1,214 @@
+import logging
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Set
+
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.instrumentation import get_dispatcher
+from llama_index.core.instrumentation.event_handlers import BaseEventHandler
+from llama_index.core.instrumentation.events import BaseEvent
+from llama_index.core.instrumentation.events.llm import LLMChatStartEvent, LLMCompletionStartEvent
+from llama_index.core.query_pipeline import CustomQueryComponent, InputComponent, QueryPipeline
+from llama_index.core.vector_stores import MetadataFilters, MetadataFilter
+
+from pipelines.base.metrics import timed
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class RunStats:
+    llm_calls: int = 0
+    nodes_retrieved: int = 0
+    nodes_packed: int = 0
+    context_tokens: int = 0
+
+
+# stats of the pipeline run in progress, filled by the packer and the LLM call counter
+current_run: ContextVar[Optional[RunStats]] = ContextVar('current_run', default=None)
+
+
+class LlmCallCounter(BaseEventHandler):
+    """Counts the LLM requests made by the pipeline run in progress."""
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "LlmCallCounter"
+
+    def handle(self, event: BaseEvent, **kwargs) -> Any:
+        run = current_run.get()
+        if run is not None and isinstance(event, (LLMChatStartEvent, LLMCompletionStartEvent)):
+            run.llm_calls += 1
+
+
+get_dispatcher().add_event_handler(LlmCallCounter())
+
+
+class CompanyRetrieverComponent(CustomQueryComponent):
+    """Retrieves nodes of the company passed at run time."""
+
+    index: Any = Field(..., description="Index to retrieve from")
+    similarity_top_k: int = Field(default=8, description="Number of nodes to retrieve")
+
+    @property
+    def _input_keys(self) -> Set[str]:
+        return {"query_str", "company_id"}
+
+    @property
+    def _output_keys(self) -> Set[str]:
+        return {"nodes"}
+
+    def _retriever(self, company_id: int):
+        filters = MetadataFilters(
+            filters=[
+                MetadataFilter(key="companyId", value=company_id, operator="=="),
+            ],
+        )
+
+        return self.index.as_retriever(filters=filters, similarity_top_k=self.similarity_top_k)
+
+    def _run_component(self, query_str: str, company_id: int) -> Dict[str, Any]:
+        return {"nodes": self._retriever(company_id).retrieve(query_str)}
+
+    async def _arun_component(self, query_str: str, company_id: int) -> Dict[str, Any]:
+        with timed('retrieval'):
+            return {"nodes": await self._retriever(company_id).aretrieve(query_str)}
+
+
+class PromptArgsSynthesizerComponent(CustomQueryComponent):
+    """Synthesizes a response, filling the prompt with values passed at run time."""
+
+    synthesizer: Any = Field(..., description="Response synthesizer")
+
+    @property
+    def _input_keys(self) -> Set[str]:
+        return {"query_str", "nodes", "prompt_args"}
+
+    @property
+    def _output_keys(self) -> Set[str]:
+        return {"output"}
+
+    def _run_component(self, query_str: str, nodes: list, prompt_args: dict) -> Dict[str, Any]:
+        return {"output": self.synthesizer.synthesize(query_str, nodes, **prompt_args)}
+
+    async def _arun_component(self, query_str: str, nodes: list, prompt_args: dict) -> Dict[str, Any]:
+        return {"output": await self.synthesizer.asynthesize(query_str, nodes, **prompt_args)}
+
+
+def build_retrieval_pipeline(retriever: CompanyRetrieverComponent,
+                             synthesizer: PromptArgsSynthesizerComponent,
+                             packer: Optional[CustomQueryComponent] = None) -> QueryPipeline:
+    p = QueryPipeline(verbose=False)
+    p.add_modules(
+        {
+            "input": InputComponent(),
+            "retriever": retriever,
+            "summarizer": synthesizer,
+        }
+    )
+    p.add_link("input", "retriever", src_key="query_str", dest_key="query_str")
+    p.add_link("input", "retriever", src_key="company_id", dest_key="company_id")
+    p.add_link("input", "summarizer", src_key="query_str", dest_key="query_str")
+    p.add_link("input", "summarizer", src_key="prompt_args", dest_key="prompt_args")
+
+    if packer is None:
+        p.add_link("retriever", "summarizer", dest_key="nodes")
+    else:
+        p.add_modules({"packer": packer})
+        p.add_link("input", "packer", src_key="query_str", dest_key="query_str")
+        p.add_link("input", "packer", src_key="prompt_args", dest_key="prompt_args")
+        p.add_link("retriever", "packer", dest_key="nodes")
+        p.add_link("packer", "summarizer", dest_key="nodes")
+
+    return p
+
+
+class PipelineRegistry:
+    """Builds every kind of query pipeline once and reuses it between requests."""
+
+    def __init__(self, builders: Dict[str, Callable[[], QueryPipeline]]):
+        self.builders = builders
+        self.pipelines: Dict[str, QueryPipeline] = {}
+        self.timings: Dict[str, dict] = {
+            kind: {'construction': None, 'runs': 0, 'totalExecution': 0.0, 'lastExecution': None,
+                   'firstTokens': 0, 'totalFirstToken': 0.0, 'lastFirstToken': None,
+                   'llmCalls': 0, 'multiCallRuns': 0, 'lastRun': None}
+            for kind in builders
+        }
+
+    def get(self, kind: str) -> QueryPipeline:
+        if kind not in self.pipelines:
+            started = time.perf_counter()
+            self.pipelines[kind] = self.builders[kind]()
+            self.timings[kind]['construction'] = time.perf_counter() - started
+
+        return self.pipelines[kind]
+
+    def build_all(self):
+        for kind in self.builders:
+            self.get(kind)
+
+    async def arun(self, kind: str, query_str: str, company_id: int, **prompt_args) -> Any:
+        pipeline = self.get(kind)
+
+        run = RunStats()
+        run_token = current_run.set(run)
+        started = time.perf_counter()
+        try:
+            return await pipeline.arun(query_str=query_str, company_id=company_id, prompt_args=prompt_args)
+        finally:
+            self._record(kind, time.perf_counter() - started, run)
+            current_run.reset(run_token)
+
+    async def astream(self, kind: str, query_str: str, company_id: int, **prompt_args) -> AsyncIterator[str]:
+        """Runs a pipeline with a streaming synthesizer and yields the answer tokens as they arrive."""
+        pipeline = self.get(kind)
+
+        run = RunStats()
+        current_run.set(run)
+        started = time.perf_counter()
+        first_token = None
+        try:
+            response = await pipeline.arun(query_str=query_str, company_id=company_id, prompt_args=prompt_args)
+
+            async for token in response.async_response_gen():
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+
+                yield token
+        finally:
+            self._record(kind, time.perf_counter() - started, run, first_token)
+            # a generator closed by the event loop finalizes in another context, so the token can't be reset
+            current_run.set(None)
+
+    def _record(self, kind: str, duration: float, run: RunStats, first_token: float = None):
+        timing = self.timings[kind]
+        timing['runs'] += 1
+        timing['totalExecution'] += duration
+        timing['lastExecution'] = duration
+        timing['llmCalls'] += run.llm_calls
+        timing['lastRun'] = {'llmCalls': run.llm_calls, 'nodesRetrieved': run.nodes_retrieved,
+                             'nodesPacked': run.nodes_packed, 'contextTokens': run.context_tokens}
+
+        if run.llm_calls > 1:
+            timing['multiCallRuns'] += 1
+            logger.warning('%s pipeline made %d LLM calls', kind, run.llm_calls)
+
+        if first_token is not None:
+            timing['firstTokens'] += 1
+            timing['totalFirstToken'] += first_token
+            timing['lastFirstToken'] = first_token
+
+        logger.debug('%s pipeline executed in %.3fs with %d LLM calls', kind, duration, run.llm_calls)
+
+    def stats(self) -> dict:
+        return {
+            kind: {
+                **timing,
+                'avgExecution': timing['totalExecution'] / timing['runs'] if timing['runs'] else None,
+                'avgFirstToken': timing['totalFirstToken'] / timing['firstTokens'] if timing['firstTokens'] else None,
+                'avgLlmCalls': timing['llmCalls'] / timing['runs'] if timing['runs'] else None,
+            }
+            for kind, timing in self.timings.items()
+        }
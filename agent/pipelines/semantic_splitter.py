@@ -0,0 +1,173 @@
+from typing import Any, List, Sequence, Tuple
+
+import numpy as np
+from llama_index.core.bridge.pydantic import Field
+from llama_index.core.node_parser import SemanticSplitterNodeParser
+from llama_index.core.node_parser.node_utils import build_nodes_from_splits
+from llama_index.core.node_parser.text.semantic_splitter import SentenceCombination
+from llama_index.core.schema import BaseNode, MetadataMode
+
+from pipelines.base.metrics import timed
+
+
+class EmbeddingSemanticSplitterNodeParser(SemanticSplitterNodeParser):
+    """Semantic splitter that also embeds the nodes it produces.
+
+    The sentence window vectors used to find breakpoints are kept and node
+    vectors are derived from them, so the pipeline no longer needs a separate
+    embedding step. Short documents skip the breakpoint search entirely and
+    cost a single embedding of the whole text. Windows are embedded with the
+    document's metadata header, like every node, so all vectors of the index
+    are comparable.
+    """
+
+    short_input_sentences: int = Field(
+        default=3,
+        description="Documents with at most this many sentences are embedded as a single node.",
+    )
+
+    node_embedding_mode: str = Field(
+        default="derive",
+        description=(
+            "How to embed multi-sentence nodes: 'derive' averages the sentence window vectors, "
+            "'embed' re-embeds the node text. Nodes equal to a sentence window always reuse its vector."
+        ),
+    )
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "EmbeddingSemanticSplitterNodeParser"
+
+    @staticmethod
+    def _embed_text(doc: BaseNode, text: str) -> str:
+        """`text` as `doc.get_content(MetadataMode.EMBED)` would render it, the way its nodes are embedded."""
+        metadata_str = doc.get_metadata_str(mode=MetadataMode.EMBED).strip()
+        if not metadata_str:
+            return text
+
+        return doc.text_template.format(content=text, metadata_str=metadata_str).strip()
+
+    def _plan(self, documents: Sequence[BaseNode]) -> Tuple[list, List[str]]:
+        plans = []
+        texts = []
+
+        for doc in documents:
+            text_splits = self.sentence_splitter(doc.text)
+
+            if len(text_splits) <= self.short_input_sentences:
+                plans.append((doc, None, len(texts)))
+                texts.append(doc.get_content(metadata_mode=MetadataMode.EMBED))
+            else:
+                sentences = self._build_sentence_groups(text_splits)
+                plans.append((doc, sentences, len(texts)))
+                texts.extend(self._embed_text(doc, s["combined_sentence"]) for s in sentences)
+
+        return plans, texts
+
+    def _build(self, plans: list, embeddings: List[List[float]]) -> Tuple[List[BaseNode], List[BaseNode]]:
+        all_nodes: List[BaseNode] = []
+        to_embed: List[BaseNode] = []
+
+        for doc, sentences, offset in plans:
+            if sentences is None:
+                nodes = build_nodes_from_splits([doc.text], doc, id_func=self.id_func)
+                nodes[0].embedding = embeddings[offset]
+                all_nodes.extend(nodes)
+                continue
+
+            for i, sentence in enumerate(sentences):
+                sentence["combined_sentence_embedding"] = embeddings[offset + i]
+
+            distances = self._calculate_distances_between_sentence_groups(sentences)
+            groups = self._build_sentence_chunk_groups(sentences, distances)
+
+            nodes = build_nodes_from_splits(
+                ["".join(s["sentence"] for s in group) for group in groups],
+                doc,
+                id_func=self.id_func,
+            )
+
+            for node, group in zip(nodes, groups):
+                window = next((s for s in group if s["combined_sentence"] == node.text), None)
+
+                if window is not None:
+                    node.embedding = window["combined_sentence_embedding"]
+                elif self.node_embedding_mode == "derive":
+                    node.embedding = self._derive_embedding(group)
+                else:
+                    to_embed.append(node)
+
+            all_nodes.extend(nodes)
+
+        return all_nodes, to_embed
+
+    def _build_sentence_chunk_groups(
+        self, sentences: List[SentenceCombination], distances: List[float]
+    ) -> List[List[SentenceCombination]]:
+        if not distances:
+            return [sentences]
+
+        threshold = np.percentile(distances, self.breakpoint_percentile_threshold)
+
+        groups = []
+        start_index = 0
+        for index, distance in enumerate(distances):
+            if distance > threshold:
+                groups.append(sentences[start_index: index + 1])
+                start_index = index + 1
+
+        if start_index < len(sentences):
+            groups.append(sentences[start_index:])
+
+        return groups
+
+    def _derive_embedding(self, group: List[SentenceCombination]) -> List[float]:
+        vectors = np.asarray([s["combined_sentence_embedding"] for s in group], dtype=np.float64)
+        weights = np.asarray([len(s["sentence"]) for s in group], dtype=np.float64)
+
+        embedding = np.average(vectors, axis=0, weights=weights if weights.sum() else None)
+        norm = np.linalg.norm(embedding)
+
+        return (embedding / norm if norm else embedding).tolist()
+
+    def _parse_nodes(
+        self,
+        nodes: Sequence[BaseNode],
+        show_progress: bool = False,
+        **kwargs: Any,
+    ) -> List[BaseNode]:
+        with timed('splitting'):
+            plans, texts = self._plan(nodes)
+        embeddings = self.embed_model.get_text_embedding_batch(texts, show_progress=show_progress)
+
+        with timed('splitting'):
+            all_nodes, to_embed = self._build(plans, embeddings)
+        if to_embed:
+            node_embeddings = self.embed_model.get_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in to_embed]
+            )
+            for node, embedding in zip(to_embed, node_embeddings):
+                node.embedding = embedding
+
+        return all_nodes
+
+    async def _aparse_nodes(
+        self,
+        nodes: Sequence[BaseNode],
+        show_progress: bool = False,
+        **kwargs: Any,
+    ) -> List[BaseNode]:
+        with timed('splitting'):
+            plans, texts = self._plan(nodes)
+        embeddings = await self.embed_model.aget_text_embedding_batch(texts, show_progress=show_progress)
+
+        with timed('splitting'):
+            all_nodes, to_embed = self._build(plans, embeddings)
+        if to_embed:
+            node_embeddings = await self.embed_model.aget_text_embedding_batch(
+                [node.get_content(metadata_mode=MetadataMode.EMBED) for node in to_embed]
+            )
+            for node, embedding in zip(to_embed, node_embeddings):
+                node.embedding = embedding
+
+        return all_nodes
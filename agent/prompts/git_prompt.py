@@ -2,3 +2,13 @@ SYSTEM_GIT_DIFF_SUMMARY = ("You have to write a short description (2-3 sentences
                            "your answer will be used for a pull request description.\n"
                            "Avoid statements like 'diff shows ...' or 'Based on diff ...' or anything along those "
                            "lines.")
+
+SYSTEM_GIT_DIFF_CHUNK_SUMMARY = ("You are given a part of a git diff of pull request. Summarize in a few sentences what "
+                                 "changed in it and why, mentioning the files and the notable functions, classes or "
+                                 "settings. Your summary will be combined with summaries of the other parts.")
+
+USER_GIT_DIFF_REDUCE = ("Below are summaries of the parts of a git diff of pull request.\n"
+                        "---------------------\n"
+                        "{summaries_str}\n"
+                        "---------------------\n"
+                        "Combine them into the description of the whole pull request.")
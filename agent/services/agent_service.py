@@ -1,21 +1,27 @@
 import datetime
 from enum import Enum
-from typing import Optional, List, Any
+from typing import Optional, List, Any, AsyncIterator
 
 from llama_index.core import ChatPromptTemplate
 from llama_index.core.llms import ChatMessage, MessageRole
-from llama_index.core.query_pipeline import InputComponent, QueryPipeline
 from llama_index.core.response_synthesizers import TreeSummarize
-from llama_index.core.vector_stores import MetadataFilters, MetadataFilter
-# from llama_index.readers.github import GithubClient, GithubRepositoryReader
-from llama_index.llms.openai import OpenAI
 from llama_index.core.types import BaseModel
-# from llama_index.readers.github import GithubRepositoryReader, GithubClient
 from pydantic.v1 import Field
-from pipelines.base.db import index, pool
+from pipelines.base.chat_messages import chat_message_store
+from pipelines.base.db import get_index
+from pipelines.base.embedding import embed_model
+from pipelines.base.llm import llm
+from pipelines.base.metrics import timed
+from pipelines.base.scheduler import set_priority
+from pipelines.context_packer import build_context_packer
+from pipelines.query_pipeline import (PipelineRegistry, CompanyRetrieverComponent, PromptArgsSynthesizerComponent,
+                                      build_retrieval_pipeline)
 from prompts.calendar_prompts import SYSTEM_PROMPT_CALENDAR, USER_PROMPT_CALENDAR
-from prompts.git_prompt import SYSTEM_GIT_DIFF_SUMMARY
 from prompts.main_prompt import SYSTEM_SUGGESTION_PROMPT, USER_SUGGESTION_PROMPT, SYSTEM_PROMPT, USER_QUERY_PROMPT
+from services.answer_cache import answer_cache
+from services.diff_summarizer import diff_summarizer
+from services.suggest_debouncer import Burst, suggest_debouncer
+from services.suggest_gate import suggest_gate
 
 
 class Query(BaseModel):
@@ -26,6 +32,13 @@ class Query(BaseModel):
     message: str
 
 
+class QueryAnswer(BaseModel):
+    """Data model for a query response."""
+
+    response: str
+    cached: bool = False
+
+
 class CalendarEventActionEnum(str, Enum):
     insert = 'insert',
     update = 'update',
@@ -64,156 +77,133 @@ class CalendarEventRoot(BaseModel):
 
 
 class AgentService:
-    async def query(self, question: str, companyId: int, meta: dict):
-        llm = OpenAI(model="gpt-4o", temperature=0.5)
-
-        filters = MetadataFilters(
-            filters=[
-                MetadataFilter(key="companyId", value=companyId, operator="=="),
-            ],
-        )
-
-        retriever = index.as_retriever(filters=filters, llm=llm, similarity_top_k=8)
-
+    def __init__(self):
+        self.pipelines = PipelineRegistry({
+            'query': self._build_query_pipeline,
+            'query_stream': self._build_query_stream_pipeline,
+            'suggest': self._build_suggest_pipeline,
+            'calendar': self._build_calendar_pipeline,
+        })
+
+    def _build_pipeline(self, system_prompt: str, user_prompt: str, output_cls=None, streaming: bool = False):
         message_templates = [
-            ChatMessage(content=SYSTEM_PROMPT, role=MessageRole.SYSTEM),
-            ChatMessage(content=USER_QUERY_PROMPT, role=MessageRole.USER)
+            ChatMessage(content=system_prompt, role=MessageRole.SYSTEM),
+            ChatMessage(content=user_prompt, role=MessageRole.USER)
         ]
 
         prompt_tmpl = ChatPromptTemplate(message_templates=message_templates)
 
-        messages = await self.get_last_messages(companyId, meta['chatId'])
-        prompt_tmpl = prompt_tmpl.partial_format(messages_str=await self.format_messages(messages))
-
-        summarizer = TreeSummarize(llm=llm, summary_template=prompt_tmpl)
-        p = QueryPipeline(verbose=False)
-        p.add_modules(
-            {
-                "input": InputComponent(),
-                "retriever": retriever,
-                "summarizer": summarizer,
-            }
+        summarizer = TreeSummarize(llm=llm, summary_template=prompt_tmpl, output_cls=output_cls, streaming=streaming)
+
+        return build_retrieval_pipeline(
+            CompanyRetrieverComponent(index=get_index(), similarity_top_k=8),
+            PromptArgsSynthesizerComponent(synthesizer=summarizer),
+            build_context_packer(prompt_tmpl),
         )
-        p.add_link("input", "retriever")
-        p.add_link("input", "summarizer", dest_key="query_str")
-        p.add_link("retriever", "summarizer", dest_key="nodes")
 
-        response = await p.arun(input=await self.format_query(question, meta))
+    def _build_query_pipeline(self):
+        return self._build_pipeline(SYSTEM_PROMPT, USER_QUERY_PROMPT)
 
-        return response.response
+    def _build_query_stream_pipeline(self):
+        return self._build_pipeline(SYSTEM_PROMPT, USER_QUERY_PROMPT, streaming=True)
 
-    async def suggest(self, message: str, companyId: int, meta: dict):
-        llm = OpenAI(model="gpt-4o", temperature=0.5)
+    def _build_suggest_pipeline(self):
+        return self._build_pipeline(SYSTEM_SUGGESTION_PROMPT, USER_SUGGESTION_PROMPT, output_cls=Query)
 
-        filters = MetadataFilters(
-            filters=[
-                MetadataFilter(key="companyId", value=companyId, operator="=="),
-            ],
-        )
+    def _build_calendar_pipeline(self):
+        return self._build_pipeline(SYSTEM_PROMPT_CALENDAR, USER_PROMPT_CALENDAR, output_cls=CalendarEventRoot)
 
-        retriever = index.as_retriever(filters=filters, llm=llm, similarity_top_k=8)
+    async def _cached_answer(self, question: str, companyId: int, meta: dict):
+        """Returns the cache generation, the question embedding and the answer cached for the chat, if any."""
+        generation = answer_cache.generation(companyId)
+        if not answer_cache.enabled:
+            return generation, None, None
 
-        message_templates = [
-            ChatMessage(content=SYSTEM_SUGGESTION_PROMPT, role=MessageRole.SYSTEM),
-            ChatMessage(content=USER_SUGGESTION_PROMPT, role=MessageRole.USER)
-        ]
+        embedding = await embed_model.aget_query_embedding(question)
 
-        prompt_tmpl = ChatPromptTemplate(message_templates=message_templates)
+        return generation, embedding, answer_cache.lookup(companyId, str(meta['chatId']), embedding)
+
+    async def query(self, question: str, companyId: int, meta: dict) -> QueryAnswer:
+        set_priority('query', companyId)
+        generation, embedding, answer = await self._cached_answer(question, companyId, meta)
+        if answer is not None:
+            return QueryAnswer(response=answer, cached=True)
 
         messages = await self.get_last_messages(companyId, meta['chatId'])
-        prompt_tmpl = prompt_tmpl.partial_format(messages_str=await self.format_messages(messages))
-
-        summarizer = TreeSummarize(llm=llm, summary_template=prompt_tmpl, output_cls=Query)
-        p = QueryPipeline(verbose=False)
-        p.add_modules(
-            {
-                "input": InputComponent(),
-                "retriever": retriever,
-                "summarizer": summarizer,
-            }
-        )
-        p.add_link("input", "retriever")
-        p.add_link("input", "summarizer", dest_key="query_str")
-        p.add_link("retriever", "summarizer", dest_key="nodes")
 
-        response = await p.arun(input=await self.format_query(message, meta))
+        response = await self.pipelines.arun('query', await self.format_query(question, meta), companyId,
+                                             messages_str=await self.format_messages(messages))
 
-        if response.score < 9 or response.relevance < 7:
-            return None
+        if embedding is not None:
+            answer_cache.put(companyId, str(meta['chatId']), embedding, response.response, generation)
 
-        return response.message
+        return QueryAnswer(response=response.response)
 
-    async def generate_event(self, calendars, events, command: str, companyId: int, meta: dict):
-        llm = OpenAI(model="gpt-4o", temperature=0.5)
+    async def stream_query(self, question: str, companyId: int, meta: dict) -> AsyncIterator[QueryAnswer]:
+        """Yields the answer in pieces as the LLM produces them."""
+        set_priority('query', companyId)
+        generation, embedding, answer = await self._cached_answer(question, companyId, meta)
+        if answer is not None:
+            yield QueryAnswer(response=answer, cached=True)
+            return
 
-        filters = MetadataFilters(
-            filters=[
-                MetadataFilter(key="companyId", value=companyId, operator="=="),
-            ],
-        )
+        messages = await self.get_last_messages(companyId, meta['chatId'])
 
-        retriever = index.as_retriever(filters=filters, llm=llm, similarity_top_k=8)
+        tokens = []
+        async for token in self.pipelines.astream('query_stream', await self.format_query(question, meta), companyId,
+                                                  messages_str=await self.format_messages(messages)):
+            tokens.append(token)
+            yield QueryAnswer(response=token)
 
-        message_templates = [
-            ChatMessage(content=SYSTEM_PROMPT_CALENDAR, role=MessageRole.SYSTEM),
-            ChatMessage(content=USER_PROMPT_CALENDAR, role=MessageRole.USER)
-        ]
+        if embedding is not None:
+            answer_cache.put(companyId, str(meta['chatId']), embedding, ''.join(tokens), generation)
 
-        prompt_tmpl = ChatPromptTemplate(message_templates=message_templates)
+    async def suggest(self, message: str, companyId: int, meta: dict):
+        set_priority('suggest', companyId)
+
+        async def evaluate(message: str, meta: dict, burst: Burst):
+            return await self._suggest(message, companyId, meta, burst)
+
+        return await suggest_debouncer.run(companyId, meta.get('chatId'), message, meta, evaluate)
+
+    async def _suggest(self, message: str, companyId: int, meta: dict, burst: Burst):
+        decision = await suggest_gate.evaluate(message, meta)
+        if not decision.passed and suggest_gate.enforced:
+            return None
 
         messages = await self.get_last_messages(companyId, meta['chatId'])
+        # messages of the burst usually reach the history only after their suggest requests
+        known = {text for text, _ in messages}
+        messages = [item for item in reversed(burst) if item[0] not in known] + messages
 
-        prompt_tmpl = prompt_tmpl.partial_format(messages_str=await self.format_messages(messages),
-                                                 calendars_str=await self.format_calendars(calendars),
-                                                 events_str=await self.format_events(events),
-                                                 now=datetime.datetime.now().isoformat())
-
-        summarizer = TreeSummarize(llm=llm, summary_template=prompt_tmpl, output_cls=CalendarEventRoot)
-        p = QueryPipeline(verbose=False)
-        p.add_modules(
-            {
-                "input": InputComponent(),
-                "retriever": retriever,
-                "summarizer": summarizer,
-            }
-        )
-        p.add_link("input", "retriever")
-        p.add_link("input", "summarizer", dest_key="query_str")
-        p.add_link("retriever", "summarizer", dest_key="nodes")
+        response = await self.pipelines.arun('suggest', await self.format_query(message, meta), companyId,
+                                             messages_str=await self.format_messages(messages))
+
+        accepted = response.score >= 9 and response.relevance >= 7
+        suggest_gate.record(decision, accepted=accepted)
+
+        return response.message if accepted else None
 
-        response = await p.arun(input=await self.format_query(command, meta))
+    async def generate_event(self, calendars, events, command: str, companyId: int, meta: dict):
+        # someone is waiting for the event like for an answer
+        set_priority('query', companyId)
+        messages = await self.get_last_messages(companyId, meta['chatId'])
+
+        response = await self.pipelines.arun('calendar', await self.format_query(command, meta), companyId,
+                                             messages_str=await self.format_messages(messages),
+                                             calendars_str=await self.format_calendars(calendars),
+                                             events_str=await self.format_events(events),
+                                             now=datetime.datetime.now().isoformat())
         return response.response
 
     async def summaryGitDiff(self, diff: str, companyId):
-        llm = OpenAI(model="gpt-4o-mini", temperature=0.5, system_prompt=SYSTEM_GIT_DIFF_SUMMARY)
-
-        response = await llm.acomplete(diff)
-
-        return response.text
-
-    # async def download_repo(self):
-    #     github_client = GithubClient(github_token='52575622')
-    #     reader = GithubRepositoryReader(
-    #         github_client=github_client,
-    #         owner='salakhovilia',
-    #         repo='coworker',
-    #         use_parser=False,
-    #         verbose=False,
-    #     )
-    #
-    #     docs = await reader.aload_data(branch='master')
-    #     print(docs)
-
-    async def get_last_messages(self, companyId:int, chatId: str):
-        async with pool.connection() as conn:
-            async with conn.cursor() as cursor:
-                await cursor.execute("SELECT text, metadata_ FROM data_documents "
-                                     "WHERE metadata_->>'companyId'=%s and metadata_->>'type'='telegram-message'"
-                                     " and metadata_->>'chatId'=%s "
-                                     "ORDER BY metadata_->>'date' DESC "
-                                     "LIMIT 5", [str(companyId), str(chatId)])
-                results = await cursor.fetchall()
-                return results
+        # summaries are posted to a chat, like suggestions nobody is waiting for
+        set_priority('suggest', companyId)
+        return await diff_summarizer.summarize(diff)
+
+    async def get_last_messages(self, companyId: int, chatId: str):
+        with timed('chat_history'):
+            return await chat_message_store.get_last(companyId, chatId, limit=5)
 
     async def format_messages(self, messages):
         messages_str = ""
@@ -0,0 +1,119 @@
+import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+from pipelines.ingestion_pipeline import ingestion_listeners
+
+
+@dataclass
+class CachedAnswer:
+    # the chat it was answered in, its history went into the answer
+    scope: Optional[str]
+    embedding: np.ndarray
+    answer: str
+    created_at: float
+
+
+class SemanticAnswerCache:
+    """Per-company cache of query answers keyed by the question embedding.
+
+    A question is answered from the cache when a cached question of the same
+    company and chat is at least `threshold` cosine-similar and younger than
+    `ttl` seconds. All answers of a company are dropped once new documents are
+    ingested for it.
+    """
+
+    def __init__(self, threshold: float = 0.95, ttl: float = 3600, max_size: int = 256, enabled: bool = True):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.enabled = enabled
+
+        # companyId -> OrderedDict of id -> CachedAnswer, least recently used first
+        self._entries: Dict[int, OrderedDict] = {}
+        self._next_id = 0
+        # bumped on invalidation, so answers computed from older documents aren't stored afterwards
+        self._generations: Dict[int, int] = {}
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        return embedding / (np.linalg.norm(embedding) or 1.0)
+
+    def lookup(self, company_id: int, scope: Optional[str], embedding: List[float]) -> Optional[str]:
+        if not self.enabled:
+            return None
+
+        entries = self._entries.get(company_id)
+        if entries:
+            expired = [key for key, entry in entries.items() if time.monotonic() - entry.created_at > self.ttl]
+            for key in expired:
+                del entries[key]
+
+        keys = [key for key, entry in (entries or {}).items() if entry.scope == scope]
+        if not keys:
+            self.misses += 1
+            return None
+
+        similarities = np.stack([entries[key].embedding for key in keys]) @ self._normalize(embedding)
+        best = int(np.argmax(similarities))
+
+        if similarities[best] < self.threshold:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        entries.move_to_end(keys[best])
+
+        return entries[keys[best]].answer
+
+    def generation(self, company_id: int) -> int:
+        return self._generations.get(company_id, 0)
+
+    def put(self, company_id: int, scope: Optional[str], embedding: List[float], answer: str, generation: int):
+        if not self.enabled or generation != self.generation(company_id):
+            return
+
+        entries = self._entries.setdefault(company_id, OrderedDict())
+        entries[self._next_id] = CachedAnswer(scope, self._normalize(embedding), answer,
+                                                time.monotonic())
+        self._next_id += 1
+
+        while len(entries) > self.max_size:
+            entries.popitem(last=False)
+
+    def invalidate(self, company_ids: Iterable[int]):
+        for company_id in company_ids:
+            self._generations[company_id] = self.generation(company_id) + 1
+            if self._entries.pop(company_id, None):
+                self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'hitRate': self.hits / lookups if lookups else None,
+            'invalidations': self.invalidations,
+            'companies': len(self._entries),
+            'size': sum(len(entries) for entries in self._entries.values()),
+        }
+
+
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.environ.get('ANSWER_CACHE_THRESHOLD', 0.95)),
+    ttl=float(os.environ.get('ANSWER_CACHE_TTL', 3600)),
+    max_size=int(os.environ.get('ANSWER_CACHE_SIZE', 256)),
+    enabled=os.environ.get('ANSWER_CACHE_ENABLED', 'true').lower() == 'true',
+)
+ingestion_listeners.append(answer_cache.invalidate)
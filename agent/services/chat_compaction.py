@@ -0,0 +1,267 @@
+import datetime
+import json
+import logging
+import os
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from typing import Dict, List, Optional
+
+from llama_index.core.vector_stores.types import MetadataFilter, MetadataFilters, VectorStoreQuery
+from psycopg_pool import AsyncConnectionPool
+
+from pipelines.base.chat_messages import MESSAGE_TYPE
+from pipelines.base.db import vector_index_manager, vector_store
+from pipelines.base.pool import pool
+from pipelines.base.vector_store import TENANT_KEY, TenantPGVectorStore, VectorIndexManager, tenant_predicate
+from pipelines.ingestion_pipeline import TextIngestionPipeline, arun_ingestion
+from services.chat_import import ChatImporter, ImportedMessage, chat_importer
+from services.file_service import Progress
+
+logger = logging.getLogger(__name__)
+
+# node metadata that belongs to the node, not to the message
+NODE_KEYS = "'_node_content' - '_node_type' - 'doc_id' - 'document_id' - 'ref_doc_id'"
+
+# the date of a message node, NULL where it is missing or not a timestamp instead of failing the whole query
+MESSAGE_DATE = "chat_message_date(metadata_->>'date')"
+
+
+@dataclass
+class RetentionPolicy:
+    # messages older than this are compacted, 0 keeps them forever
+    days: float = 90
+    # 'archive' moves the compacted nodes to the cold table, 'delete' drops them
+    mode: str = 'archive'
+
+
+class ChatCompactor:
+    """Rolls aged chat messages of the vector store up into conversation digests.
+
+    Every message is ingested as its own node, so old chatter outnumbers the
+    documents in the index and in the top results. Messages older than the
+    company's retention are grouped into the same conversation windows chat
+    imports use, a digest node is ingested per window and the message nodes
+    are moved to the cold table or deleted. The chat history table keeps
+    every message. Digests have ids derived from their first message, so a
+    failed run can simply be repeated.
+    """
+
+    def __init__(self, pool: AsyncConnectionPool, store: TenantPGVectorStore, index_manager: VectorIndexManager,
+                 importer: ChatImporter, default_policy: RetentionPolicy,
+                 policies: Optional[Dict[int, RetentionPolicy]] = None, batch_size: int = 2000,
+                 sample_queries: int = 20, top_k: int = 8):
+        self.pool = pool
+        self.store = store
+        self.index_manager = index_manager
+        self.importer = importer
+        self.default_policy = default_policy
+        self.policies = policies or {}
+        self.batch_size = batch_size
+        self.sample_queries = sample_queries
+        self.top_k = top_k
+
+        self.table_name = store.qualified_table_name
+        self.cold_table_name = f"{self.table_name}_cold"
+
+    async def setup(self):
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                # concurrent replacements of a function fail, processes start together
+                await conn.execute("SELECT pg_advisory_xact_lock(hashtext('chat_message_date'))")
+                await conn.execute("CREATE OR REPLACE FUNCTION chat_message_date(value TEXT) RETURNS TIMESTAMPTZ AS $$ "
+                                   "BEGIN RETURN value::timestamptz; "
+                                   "EXCEPTION WHEN invalid_datetime_format OR datetime_field_overflow "
+                                   "OR invalid_parameter_value THEN RETURN NULL; "
+                                   "END $$ LANGUAGE plpgsql STABLE")
+
+    def policy(self, company_id: int) -> RetentionPolicy:
+        return self.policies.get(company_id, self.default_policy)
+
+    async def companies(self) -> List[int]:
+        """Companies with chat messages in the vector store."""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT DISTINCT (metadata_->>'{TENANT_KEY}')::bigint FROM {self.table_name} "
+                                        "WHERE metadata_->>'type'=%s ORDER BY 1", [MESSAGE_TYPE])
+            return [row[0] for row in await cursor.fetchall() if row[0] is not None]
+
+    async def run(self, company_id: int, dry_run: bool = False, rebuild_index: bool = False,
+                  progress: Progress = None) -> dict:
+        """Compacts the company's aged messages and reports index size and retrieval latency before and after."""
+        policy = self.policy(company_id)
+        report = {'companyId': company_id, 'policy': asdict(policy), 'dryRun': dry_run}
+        if policy.days <= 0:
+            return {**report, 'status': 'skipped'}
+
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=policy.days)
+        queries = await self._sample_queries(company_id)
+
+        report['cutoff'] = cutoff.isoformat()
+        report['before'] = await self.measure(company_id, queries)
+        report['compaction'] = await self.compact(company_id, cutoff, policy.mode, dry_run, progress)
+
+        if rebuild_index and not dry_run:
+            await self.index_manager.rebuild(company_id)
+        report['after'] = await self.measure(company_id, queries)
+
+        return {'status': 'ok', **report}
+
+    async def compact(self, company_id: int, cutoff: datetime.datetime, mode: str, dry_run: bool = False,
+                      progress: Progress = None) -> dict:
+        if mode not in ('archive', 'delete'):
+            raise ValueError(f'Unknown retention mode: {mode}')
+
+        counts = {'chats': 0, 'messages': 0, 'removedNodes': 0, 'digests': 0, 'digestNodes': 0,
+                  'unparsableDates': 0}
+
+        async with self.pool.connection() as conn:
+            if mode == 'archive' and not dry_run:
+                # no indexes, the cold table is only read to restore messages
+                await conn.execute(f"CREATE TABLE IF NOT EXISTS {self.cold_table_name} (LIKE {self.table_name})")
+
+            cursor = await conn.execute(f"SELECT DISTINCT metadata_->>'chatId' FROM {self.table_name} "
+                                        f"WHERE {tenant_predicate(company_id)} AND metadata_->>'type'=%s "
+                                        f"AND {MESSAGE_DATE} < %s", [MESSAGE_TYPE, cutoff])
+            chats = [row[0] for row in await cursor.fetchall()]
+
+            # such messages are never compacted, they are only counted
+            cursor = await conn.execute(f"SELECT count(DISTINCT metadata_->>'doc_id') FROM {self.table_name} "
+                                        f"WHERE {tenant_predicate(company_id)} AND metadata_->>'type'=%s "
+                                        f"AND {MESSAGE_DATE} IS NULL", [MESSAGE_TYPE])
+            counts['unparsableDates'] = (await cursor.fetchone())[0]
+            if counts['unparsableDates']:
+                logger.warning('Skipping %d messages of company %d without a valid date',
+                               counts['unparsableDates'], company_id)
+
+        for chat_id in chats:
+            counts['chats'] += 1
+            if dry_run:
+                counts['messages'] += await self._count_aged_messages(company_id, chat_id, cutoff)
+                continue
+
+            while True:
+                rows = await self._aged_messages(company_id, chat_id, cutoff)
+                if not rows:
+                    break
+
+                windows = list(self.importer.windows(ImportedMessage(None, date, text, metadata)
+                                                     for _, date, text, metadata in rows))
+                if len(rows) == self.batch_size and len(windows) > 1:
+                    # the last window may go on in the next batch
+                    windows.pop()
+
+                messages = sum(len(window.messages) for window in windows)
+                documents = [self.importer.document(company_id, window) for window in windows]
+                for document in documents:
+                    await self.store.adelete(document.id_)
+                counts['digestNodes'] += len(await arun_ingestion(TextIngestionPipeline, documents))
+                counts['digests'] += len(documents)
+
+                counts['removedNodes'] += await self._remove([node for ids, _, _, _ in rows[:messages]
+                                                              for node in ids], mode)
+                counts['messages'] += messages
+
+                if progress:
+                    await progress(counts)
+
+        logger.info('Compacted chats of company %d: %s', company_id, counts)
+
+        return counts
+
+    async def _aged_messages(self, company_id: int, chat_id: Optional[str], cutoff: datetime.datetime) -> List[tuple]:
+        """Oldest aged messages of a chat as (node ids, date, text, metadata), joining messages split into nodes."""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT array_agg(id ORDER BY id), min({MESSAGE_DATE}), "
+                                        "string_agg(text, ' ' ORDER BY id), "
+                                        f"(array_agg(metadata_::jsonb - {NODE_KEYS}))[1] "
+                                        f"FROM {self.table_name} WHERE {tenant_predicate(company_id)} "
+                                        "AND metadata_->>'type'=%s AND (metadata_->>'chatId') IS NOT DISTINCT FROM %s "
+                                        f"AND {MESSAGE_DATE} < %s "
+                                        "GROUP BY metadata_->>'doc_id' ORDER BY 2 LIMIT %s",
+                                        [MESSAGE_TYPE, chat_id, cutoff, self.batch_size])
+            return await cursor.fetchall()
+
+    async def _count_aged_messages(self, company_id: int, chat_id: Optional[str],
+                                   cutoff: datetime.datetime) -> int:
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT count(DISTINCT metadata_->>'doc_id') FROM {self.table_name} "
+                                        f"WHERE {tenant_predicate(company_id)} AND metadata_->>'type'=%s "
+                                        "AND (metadata_->>'chatId') IS NOT DISTINCT FROM %s "
+                                        f"AND {MESSAGE_DATE} < %s",
+                                        [MESSAGE_TYPE, chat_id, cutoff])
+            return (await cursor.fetchone())[0]
+
+    async def _remove(self, ids: List[int], mode: str) -> int:
+        async with self.pool.connection() as conn:
+            if mode == 'archive':
+                cursor = await conn.execute(f"WITH moved AS (DELETE FROM {self.table_name} WHERE id = ANY(%s) "
+                                            f"RETURNING *) INSERT INTO {self.cold_table_name} SELECT * FROM moved",
+                                            [ids])
+            else:
+                cursor = await conn.execute(f"DELETE FROM {self.table_name} WHERE id = ANY(%s)", [ids])
+
+            return cursor.rowcount
+
+    async def _sample_queries(self, company_id: int) -> List[List[float]]:
+        # the same vectors are searched before and after, so latencies are comparable
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT embedding::text FROM {self.table_name} "
+                                        f"WHERE {tenant_predicate(company_id)} ORDER BY random() LIMIT %s",
+                                        [self.sample_queries])
+            return [json.loads(row[0]) for row in await cursor.fetchall()]
+
+    async def measure(self, company_id: int, queries: List[List[float]]) -> dict:
+        """Rows and index sizes of the company, and latency and share of messages in the results of its searches."""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(f"SELECT count(*), count(*) FILTER (WHERE metadata_->>'type'=%s) "
+                                        f"FROM {self.table_name} WHERE {tenant_predicate(company_id)}",
+                                        [MESSAGE_TYPE])
+            rows, message_rows = await cursor.fetchone()
+            # deleted rows only give their space back after a vacuum, and to the ANN index after a rebuild
+            cursor = await conn.execute("SELECT pg_total_relation_size(to_regclass(%s)), "
+                                        "pg_relation_size(to_regclass(%s))",
+                                        [self.table_name, self.index_manager.index_name(company_id)])
+            table_bytes, index_bytes = await cursor.fetchone()
+
+        filters = MetadataFilters(filters=[MetadataFilter(key=TENANT_KEY, value=company_id)])
+        latencies = []
+        results = messages = 0
+        for embedding in queries:
+            started = time.perf_counter()
+            result = await self.store.aquery(VectorStoreQuery(query_embedding=embedding, similarity_top_k=self.top_k,
+                                                              filters=filters))
+            latencies.append(time.perf_counter() - started)
+
+            results += len(result.nodes)
+            messages += sum(node.metadata.get('type') == MESSAGE_TYPE for node in result.nodes)
+
+        return {
+            'rows': rows,
+            'messageRows': message_rows,
+            'tableBytes': table_bytes,
+            'indexBytes': index_bytes,
+            'latencyAvg': statistics.mean(latencies) if latencies else None,
+            'latencyP95': sorted(latencies)[int(len(latencies) * 0.95)] if latencies else None,
+            'messageShare': messages / results if results else None,
+        }
+
+
+def load_policies() -> Dict[int, RetentionPolicy]:
+    path = os.environ.get('CHAT_RETENTION_POLICIES')
+    if not path:
+        return {}
+
+    with open(path) as f:
+        return {int(company_id): RetentionPolicy(**policy) for company_id, policy in json.load(f).items()}
+
+
+chat_compactor = ChatCompactor(
+    pool,
+    vector_store,
+    vector_index_manager,
+    chat_importer,
+    default_policy=RetentionPolicy(days=float(os.environ.get('CHAT_RETENTION_DAYS', 90)),
+                                   mode=os.environ.get('CHAT_RETENTION_MODE', 'archive')),
+    policies=load_policies(),
+    batch_size=int(os.environ.get('CHAT_COMPACTION_BATCH_SIZE', 2000)),
+)
@@ -0,0 +1,317 @@
+import asyncio
+import datetime
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Iterator, List, Optional, Tuple
+
+from llama_index.core import Document
+
+from pipelines.base.chat_messages import MESSAGE_TYPE, ChatMessageStore, chat_message_store, parse_date
+from pipelines.base.db import vector_store
+from pipelines.ingestion_pipeline import TextIngestionPipeline, arun_ingestion
+from services.file_service import Progress
+
+CONVERSATION_TYPE = 'telegram-conversation'
+
+MESSAGES_ARRAY = re.compile(r'"messages"\s*:\s*\[')
+
+
+class ChatExportError(Exception):
+    pass
+
+
+@dataclass
+class ImportedMessage:
+    id: Optional[int]
+    date: datetime.datetime
+    text: str
+    metadata: dict
+
+
+@dataclass
+class Window:
+    index: int
+    messages: List[ImportedMessage] = field(default_factory=list)
+    chars: int = 0
+
+
+def read_json_array(f, buffer: str, read_size: int = 1 << 16) -> Iterator[dict]:
+    """Yields the items of the JSON array whose opening bracket was just consumed, reading `f` as needed."""
+    decoder = json.JSONDecoder()
+    position = 0
+
+    while True:
+        # skip separators between items
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer):
+                break
+
+            chunk = f.read(read_size)
+            if not chunk:
+                raise ChatExportError('Unexpected end of the messages array')
+            buffer, position = chunk, 0
+
+        if buffer[position] == ']':
+            return
+
+        while True:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+                break
+            except json.JSONDecodeError:
+                chunk = f.read(read_size)
+                if not chunk:
+                    raise ChatExportError('Malformed message in the export')
+                buffer = buffer[position:] + chunk
+                position = 0
+
+        yield item
+        position = end
+
+
+def iter_telegram_export(path: str) -> Tuple[dict, Iterator[dict]]:
+    """Returns the chat fields of a Telegram export and an iterator over its messages, read incrementally."""
+    f = open(path, encoding='utf-8')
+
+    header = ''
+    while (match := MESSAGES_ARRAY.search(header)) is None:
+        chunk = f.read(1 << 16)
+        if not chunk:
+            f.close()
+            raise ChatExportError('No messages array in the export')
+        header += chunk
+
+    # Telegram writes the chat name, type and id before the messages
+    try:
+        chat = json.loads(header[:match.start()].rstrip().rstrip(',') + '}')
+    except json.JSONDecodeError:
+        chat = {}
+
+    def messages():
+        with f:
+            yield from read_json_array(f, header[match.end():])
+
+    return chat, messages()
+
+
+def iter_ndjson(path: str) -> Tuple[dict, Iterator[dict]]:
+    def messages():
+        with open(path, encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ChatExportError(f'Malformed line {number}: {e}')
+
+    return {}, messages()
+
+
+def message_text(text) -> str:
+    # formatted Telegram texts are lists of strings and entities
+    if isinstance(text, list):
+        return ''.join(part if isinstance(part, str) else part.get('text', '') for part in text)
+
+    return text or ''
+
+
+def message_date(message: dict) -> datetime.datetime:
+    if message.get('date_unixtime'):
+        return datetime.datetime.fromtimestamp(int(message['date_unixtime']), datetime.timezone.utc)
+
+    return parse_date(message.get('date'))
+
+
+class ChatImporter:
+    """Imports the history of a chat from a Telegram export or NDJSON.
+
+    Messages are read incrementally, grouped into conversation windows (split
+    on `window_gap` seconds of silence, `window_size` messages or
+    `window_chars` characters) and ingested `batch_size` windows per pipeline
+    run, `concurrency` runs at a time. Every message is also added to the chat
+    history.
+    """
+
+    def __init__(self, messages: ChatMessageStore, window_gap: float = 600, window_size: int = 20,
+                 window_chars: int = 4000, batch_size: int = 128, concurrency: int = 4, reply_names: int = 10000):
+        self.messages = messages
+        self.window_gap = datetime.timedelta(seconds=window_gap)
+        self.window_size = window_size
+        self.window_chars = window_chars
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.reply_names = reply_names
+
+    def read(self, path: str, export_format: str, chat_id: Optional[str], meta: dict) -> Iterator[ImportedMessage]:
+        chat, items = iter_ndjson(path) if export_format == 'ndjson' else iter_telegram_export(path)
+        chat_id = chat_id or chat.get('id')
+        # author of recent messages by id, for the names of replied-to authors
+        authors: OrderedDict = OrderedDict()
+
+        for item in items:
+            if 'content' in item:
+                # NDJSON in the shape of /api/agent/text requests
+                metadata = {**meta, 'type': MESSAGE_TYPE, 'chatId': chat_id, **item.get('meta', {})}
+                date = message_date(metadata)
+                yield ImportedMessage(None, date, item['content'], {**metadata, 'date': date.isoformat()})
+                continue
+
+            text = message_text(item.get('text'))
+            if item.get('type', 'message') != 'message' or not text.strip():
+                continue
+
+            date = message_date(item)
+            metadata = {
+                **meta,
+                'date': date.isoformat(),
+                'type': MESSAGE_TYPE,
+                'chatId': chat_id,
+                'chatTitle': chat.get('name'),
+                'authorFirstName': item.get('from'),
+            }
+            if item.get('reply_to_message_id') in authors:
+                metadata['replyToFirstName'] = authors[item['reply_to_message_id']]
+
+            if item.get('id') is not None:
+                authors[item['id']] = item.get('from')
+                while len(authors) > self.reply_names:
+                    authors.popitem(last=False)
+
+            yield ImportedMessage(item.get('id'), date, text, {k: v for k, v in metadata.items() if v is not None})
+
+    def windows(self, messages: Iterator[ImportedMessage]) -> Iterator[Window]:
+        window = Window(0)
+
+        for message in messages:
+            if window.messages and (message.date - window.messages[-1].date > self.window_gap
+                                    or len(window.messages) >= self.window_size
+                                    or window.chars + len(message.text) > self.window_chars):
+                yield window
+                window = Window(window.index + 1)
+
+            window.messages.append(message)
+            window.chars += len(message.text)
+
+        if window.messages:
+            yield window
+
+    def document(self, company_id: int, window: Window) -> Document:
+        first, last = window.messages[0], window.messages[-1]
+        lines = [f"{message.metadata.get('authorFirstName', 'unknown')}: {message.text}" for message in window.messages]
+
+        document = Document(text='\n'.join(lines), metadata={
+            **{k: v for k, v in first.metadata.items() if k not in ('authorFirstName', 'replyToFirstName')},
+            'companyId': company_id,
+            'type': CONVERSATION_TYPE,
+            'date': first.date.isoformat(),
+            'dateEnd': last.date.isoformat(),
+            'messages': len(window.messages),
+        })
+        # stable ids let a retried import replace the windows it had already ingested
+        message_id = first.id if first.id is not None else first.date.isoformat()
+        document.id_ = f"{company_id}:{first.metadata.get('chatId')}:{message_id}"
+
+        return document
+
+    async def run(self, path: str, export_format: str, company_id: int, chat_id: Optional[str] = None,
+                  meta: Optional[dict] = None, progress: Progress = None, resume: Optional[dict] = None,
+                  retry: bool = False) -> dict:
+        """Imports the chat, skipping the windows a previous attempt reported as ingested."""
+        resume = resume or {}
+        skip = resume.get('windowsIngested', 0)
+        counts = {
+            'messagesImported': resume.get('messagesImported', 0),
+            'windowsIngested': skip,
+            'nodesEmbedded': resume.get('nodesEmbedded', 0),
+            'messagesPerSecond': 0.0,
+        }
+
+        started = time.perf_counter()
+        imported_now = 0
+        semaphore = asyncio.Semaphore(self.concurrency)
+        # batch index -> (windows, messages, nodes) of batches done while earlier ones are still running
+        finished = {}
+        next_batch = 0
+
+        async def ingest(index: int, batch: List[Window]):
+            nonlocal imported_now, next_batch
+
+            try:
+                documents = [self.document(company_id, window) for window in batch]
+                if retry:
+                    # batches after the resume point may have been ingested before the previous attempt failed
+                    for document in documents:
+                        await vector_store.adelete(document.id_)
+
+                await self.messages.add_many(company_id, [(message.text, {**message.metadata, 'companyId': company_id})
+                                                          for window in batch for message in window.messages])
+                nodes = len(await arun_ingestion(TextIngestionPipeline, documents))
+            finally:
+                semaphore.release()
+
+            finished[index] = (len(batch), sum(len(window.messages) for window in batch), nodes)
+
+            # progress only moves over a prefix of finished batches, so a retry can resume from it
+            while next_batch in finished:
+                windows, messages, nodes = finished.pop(next_batch)
+                counts['windowsIngested'] += windows
+                counts['messagesImported'] += messages
+                counts['nodesEmbedded'] += nodes
+                imported_now += messages
+                next_batch += 1
+
+            counts['messagesPerSecond'] = imported_now / (time.perf_counter() - started)
+            if progress:
+                await progress(counts)
+
+        tasks = []
+        batch: List[Window] = []
+        windows = self.windows(self.read(path, export_format, chat_id, meta or {}))
+        try:
+            for window in windows:
+                if window.index < skip:
+                    continue
+
+                batch.append(window)
+                if len(batch) == self.batch_size:
+                    await semaphore.acquire()
+                    tasks.append(asyncio.create_task(ingest(len(tasks), batch)))
+                    batch = []
+
+                    # surface failures without waiting for the whole file to be read
+                    for task in tasks:
+                        if task.done() and task.exception():
+                            raise task.exception()
+
+            if batch:
+                await semaphore.acquire()
+                tasks.append(asyncio.create_task(ingest(len(tasks), batch)))
+
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        finally:
+            windows.close()
+
+        return {'status': 'ok', **counts}
+
+
+chat_importer = ChatImporter(
+    chat_message_store,
+    window_gap=float(os.environ.get('CHAT_IMPORT_WINDOW_GAP', 600)),
+    window_size=int(os.environ.get('CHAT_IMPORT_WINDOW_SIZE', 20)),
+    window_chars=int(os.environ.get('CHAT_IMPORT_WINDOW_CHARS', 4000)),
+    batch_size=int(os.environ.get('CHAT_IMPORT_BATCH_SIZE', 128)),
+    concurrency=int(os.environ.get('CHAT_IMPORT_CONCURRENCY', 4)),
+)
@@ -0,0 +1,196 @@
+import asyncio
+import hashlib
+import os
+import re
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional
+
+import tiktoken
+from llama_index.llms.openai import OpenAI
+
+from pipelines.base.llm import build_llm
+from prompts.git_prompt import SYSTEM_GIT_DIFF_CHUNK_SUMMARY, SYSTEM_GIT_DIFF_SUMMARY, USER_GIT_DIFF_REDUCE
+
+FILE_HEADER = re.compile(r'^diff --git ', re.MULTILINE)
+HUNK_HEADER = re.compile(r'^@@ ', re.MULTILINE)
+
+
+def split_at(text: str, pattern: re.Pattern) -> List[str]:
+    """Splits `text` before every match of `pattern`, keeping any preamble as the first part."""
+    starts = [match.start() for match in pattern.finditer(text)]
+    if not starts or starts[0] != 0:
+        starts.insert(0, 0)
+
+    return [text[start:end] for start, end in zip(starts, starts[1:] + [len(text)]) if text[start:end]]
+
+
+class DiffSummarizer:
+    """Summarizes pull request diffs of any size.
+
+    A diff that fits `chunk_tokens` is summarized with one call. Larger diffs
+    are split by file and hunk into chunks of at most `chunk_tokens`, the
+    chunks are summarized concurrently (at most `concurrency` at a time) and
+    the chunk summaries are reduced into the final description. Results are
+    cached by diff hash.
+    """
+
+    def __init__(self, llm: OpenAI, chunk_llm: OpenAI, chunk_tokens: int = 6000, concurrency: int = 8,
+                 cache_size: int = 256, tokenizer: Optional[Callable[[str], list]] = None):
+        self.llm = llm
+        self.chunk_llm = chunk_llm
+        self.chunk_tokens = chunk_tokens
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.cache_size = cache_size
+        self._tokenizer = tokenizer
+
+        self._cache: OrderedDict = OrderedDict()
+        # summaries being computed, so concurrent requests for the same diff share one
+        self._pending: Dict[str, asyncio.Future] = {}
+
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.chunks = 0
+        self.llm_calls = 0
+
+    def count_tokens(self, text: str) -> int:
+        if self._tokenizer is None:
+            self._tokenizer = tiktoken.encoding_for_model(self.llm.model).encode
+
+        return len(self._tokenizer(text))
+
+    def split(self, diff: str) -> List[str]:
+        """Packs files, hunks and, for huge hunks, lines into chunks of at most `chunk_tokens`."""
+        pieces = []
+
+        for file_diff in split_at(diff, FILE_HEADER):
+            if self.count_tokens(file_diff) <= self.chunk_tokens:
+                pieces.append(file_diff)
+                continue
+
+            header, *hunks = split_at(file_diff, HUNK_HEADER)
+            if not hunks:
+                # no hunks to cut at: the rest of the file diff is cut under just its `diff --git` line
+                header, _, rest = file_diff.partition('\n')
+                header, hunks = header + '\n', [rest]
+
+            for hunk in hunks:
+                if self.count_tokens(header + hunk) <= self.chunk_tokens:
+                    pieces.append(header + hunk)
+                    continue
+
+                pieces.extend(self._split_lines(header, hunk))
+
+        return self._pack(pieces)
+
+    def _split_lines(self, header: str, text: str) -> List[str]:
+        """Cuts `text` into runs of lines, each repeating `header`, counting every line once."""
+        header_tokens = self.count_tokens(header)
+
+        pieces = []
+        lines, tokens = [], header_tokens
+        for line in text.splitlines(keepends=True):
+            line_tokens = self.count_tokens(line)
+            if lines and tokens + line_tokens > self.chunk_tokens:
+                pieces.append(header + ''.join(lines))
+                lines, tokens = [], header_tokens
+            lines.append(line)
+            tokens += line_tokens
+
+        if lines:
+            pieces.append(header + ''.join(lines))
+
+        return pieces
+
+    def _pack(self, pieces: List[str]) -> List[str]:
+        chunks = []
+        chunk, tokens = '', 0
+
+        for piece in pieces:
+            piece_tokens = self.count_tokens(piece)
+            if chunk and tokens + piece_tokens > self.chunk_tokens:
+                chunks.append(chunk)
+                chunk, tokens = '', 0
+
+            chunk += piece
+            tokens += piece_tokens
+
+        if chunk:
+            chunks.append(chunk)
+
+        return chunks
+
+    async def _complete(self, llm: OpenAI, prompt: str) -> str:
+        async with self.semaphore:
+            self.llm_calls += 1
+            response = await llm.acomplete(prompt)
+
+        return response.text
+
+    def _chunks(self, diff: str) -> List[str]:
+        return [diff] if self.count_tokens(diff) <= self.chunk_tokens else self.split(diff)
+
+    async def _summarize(self, diff: str) -> str:
+        # tokenizing a large diff takes long enough to hold up every other request on the loop
+        chunks = await asyncio.to_thread(self._chunks, diff)
+        if len(chunks) == 1:
+            return await self._complete(self.llm, chunks[0])
+
+        self.chunks += len(chunks)
+
+        summaries = await asyncio.gather(*(self._complete(self.chunk_llm, chunk) for chunk in chunks))
+
+        return await self._reduce(summaries)
+
+    async def _reduce(self, summaries: List[str]) -> str:
+        summaries_str = '\n\n'.join(summaries)
+        if self.count_tokens(summaries_str) <= self.chunk_tokens or len(summaries) == 1:
+            return await self._complete(self.llm, USER_GIT_DIFF_REDUCE.format(summaries_str=summaries_str))
+
+        # too many summaries for one call: summarize groups of them first
+        groups = self._pack([summary + '\n\n' for summary in summaries])
+        return await self._reduce(list(await asyncio.gather(
+            *(self._complete(self.chunk_llm, USER_GIT_DIFF_REDUCE.format(summaries_str=group)) for group in groups)
+        )))
+
+    async def summarize(self, diff: str) -> str:
+        key = hashlib.sha256(diff.encode()).hexdigest()
+
+        if key in self._cache:
+            self.cache_hits += 1
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        if key in self._pending:
+            self.cache_hits += 1
+            return await asyncio.shield(self._pending[key])
+
+        self.cache_misses += 1
+        self._pending[key] = asyncio.ensure_future(self._summarize(diff))
+        try:
+            summary = await asyncio.shield(self._pending[key])
+        finally:
+            self._pending.pop(key, None)
+
+        self._cache[key] = summary
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+        return summary
+
+    def stats(self) -> dict:
+        return {
+            'cacheHits': self.cache_hits,
+            'cacheMisses': self.cache_misses,
+            'cacheSize': len(self._cache),
+            'chunks': self.chunks,
+            'llmCalls': self.llm_calls,
+        }
+
+
+diff_summarizer = DiffSummarizer(
+    build_llm("gpt-4o-mini", system_prompt=SYSTEM_GIT_DIFF_SUMMARY),
+    build_llm("gpt-4o-mini", system_prompt=SYSTEM_GIT_DIFF_CHUNK_SUMMARY),
+    chunk_tokens=int(os.environ.get('DIFF_CHUNK_TOKENS', 6000)),
+    concurrency=int(os.environ.get('DIFF_SUMMARY_CONCURRENCY', 8)),
+    cache_size=int(os.environ.get('DIFF_SUMMARY_CACHE_SIZE', 256)),
+)
@@ -0,0 +1,65 @@
+import asyncio
+from typing import AsyncIterator, List, Optional
+
+from llama_index.core import Document
+
+from pipelines.cpu_pool import count_pdf_pages, cpu_pool, load_file, read_pdf_pages
+
+TEXT_EXTENSIONS = {'txt', 'md', 'markdown', 'csv', 'xml', 'log', 'rst', 'yaml', 'yml'}
+
+
+async def read_pdf(file_path: str, metadata: dict, batch_size: int) -> AsyncIterator[List[Document]]:
+    """Yields the pages of a PDF `batch_size` at a time, keeping only the current pages in memory."""
+    for start in range(0, await cpu_pool.run(count_pdf_pages, file_path), batch_size):
+        pages = await cpu_pool.run(read_pdf_pages, file_path, start, start + batch_size)
+
+        yield [Document(text=text, metadata={'page_label': label, **metadata}) for label, text in pages]
+
+
+async def read_text(file_path: str, metadata: dict, batch_size: int,
+                    section_size: int) -> AsyncIterator[List[Document]]:
+    """Yields a text file in sections of about `section_size` characters, cut at blank lines where possible."""
+    batch = []
+    section = []
+    length = 0
+
+    with open(file_path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            section.append(line)
+            length += len(line)
+
+            if length >= section_size and (not line.strip() or length >= 2 * section_size):
+                batch.append(Document(text=''.join(section), metadata=metadata))
+                section, length = [], 0
+
+                if len(batch) >= batch_size:
+                    yield batch
+                    batch = []
+                    # let other requests run between sections of a large file
+                    await asyncio.sleep(0)
+
+    if section:
+        batch.append(Document(text=''.join(section), metadata=metadata))
+    if batch:
+        yield batch
+
+
+async def read_document_batches(file_path: str, file_name: str, mtype: Optional[str], extension: str,
+                                batch_size: int = 8, section_size: int = 16000) -> AsyncIterator[List[Document]]:
+    """Extracts a downloaded file as batches of page or section documents.
+
+    PDFs and plain text are read incrementally. Source code stays a single
+    document so the code splitter sees the whole file, and other formats go
+    through SimpleDirectoryReader. Parsing runs in the CPU pool.
+    """
+    metadata = {'file_name': file_name, 'file_type': mtype}
+    extension = extension.lstrip('.').lower()
+
+    if extension == 'pdf':
+        async for batch in read_pdf(file_path, metadata, batch_size):
+            yield batch
+    elif extension in TEXT_EXTENSIONS:
+        async for batch in read_text(file_path, metadata, batch_size, section_size):
+            yield batch
+    else:
+        yield await cpu_pool.run(load_file, file_path, metadata)
@@ -0,0 +1,226 @@
+import asyncio
+import hashlib
+import logging
+import mimetypes
+import os
+import posixpath
+from tempfile import NamedTemporaryFile
+from typing import Awaitable, Callable, List, Optional
+from urllib.parse import urlparse
+
+import httpx
+from fastapi import UploadFile
+from llama_index.core import Document
+
+from pipelines.base.db import docstore, vector_store
+from pipelines.base.link_registry import LinkRecord, hash_link, link_registry
+from pipelines.base.metrics import metrics, timed
+from pipelines.ingestion_pipeline import (FileIngestionPipeline, arun_ingestion, get_code_ingestion_pipeline,
+                                         notify_ingested)
+from services.document_reader import read_document_batches
+from utils.ext_to_lang import EXTENSION_TO_LANGUAGE
+
+
+downloaded_bytes = metrics.counter('agent_downloaded_bytes_total', 'Bytes of files downloaded from links')
+
+
+class FileTooLargeError(Exception):
+    pass
+
+
+def hash_file(file_path: str) -> str:
+    content_hash = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        while chunk := f.read(1024 * 1024):
+            content_hash.update(chunk)
+
+    return content_hash.hexdigest()
+
+
+Progress = Optional[Callable[[dict], Awaitable[None]]]
+
+
+class FileService:
+    def __init__(self, max_file_size: int = 100 * 1024 * 1024, concurrency: int = 2, batch_size: int = 8,
+                 section_size: int = 16000):
+        self.client = httpx.AsyncClient(follow_redirects=True, timeout=httpx.Timeout(30, read=120))
+        self.max_file_size = max_file_size
+        self.batch_size = batch_size
+        self.section_size = section_size
+        # bounds the temp files on disk and the pages being embedded at once
+        self.semaphore = asyncio.Semaphore(concurrency)
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def add_file_via_link(self, link: str, companyId: int, meta: dict, progress: Progress = None) -> str:
+        async with self.semaphore:
+            return await self._add_file_via_link(link, companyId, meta, progress)
+
+    async def _add_file_via_link(self, link: str, companyId: int, meta: dict, progress: Progress) -> str:
+        record = await link_registry.get(companyId, link) or LinkRecord(company_id=companyId,
+                                                                       link_hash=hash_link(link))
+
+        headers = {}
+        if record.doc_ids and record.etag:
+            headers['If-None-Match'] = record.etag
+        if record.doc_ids and record.last_modified:
+            headers['If-Modified-Since'] = record.last_modified
+
+        [mtype, _] = mimetypes.guess_type(urlparse(link).path)
+        extension = mimetypes.guess_extension(mtype) if mtype else None
+        extension = extension or posixpath.splitext(urlparse(link).path)[1]
+
+        with NamedTemporaryFile(delete=False, dir='uploads', suffix=extension) as temp_file:
+            file_path = temp_file.name
+
+        try:
+            async with self.client.stream('GET', link, headers=headers) as response:
+                if response.status_code == httpx.codes.NOT_MODIFIED:
+                    return 'unchanged'
+
+                response.raise_for_status()
+
+                content_hash = await self.download(response, file_path)
+
+            record.etag = response.headers.get('ETag')
+            record.last_modified = response.headers.get('Last-Modified')
+
+            if record.doc_ids and record.content_hash == content_hash:
+                await link_registry.save(record)
+                return 'unchanged'
+
+            # temp file names and timestamps would change the document hash on every download
+            doc_ids = await self.ingest_file(file_path, posixpath.basename(urlparse(link).path), record.link_hash,
+                                             mtype, extension, companyId, meta, progress)
+        finally:
+            os.remove(file_path)
+
+        await self.replace_documents(record, doc_ids, content_hash)
+
+        return 'ok'
+
+    async def add_file(self, file_path: str, file_name: str, companyId: int, meta: dict,
+                       progress: Progress = None) -> str:
+        """Ingests an uploaded file. Re-uploading a file with the same name replaces its documents."""
+        async with self.semaphore:
+            link = f"upload:{file_name}"
+            record = await link_registry.get(companyId, link) or LinkRecord(company_id=companyId,
+                                                                           link_hash=hash_link(link))
+
+            [mtype, _] = mimetypes.guess_type(file_name)
+            extension = posixpath.splitext(file_name)[1]
+
+            content_hash = await asyncio.to_thread(hash_file, file_path)
+            if record.doc_ids and record.content_hash == content_hash:
+                return 'unchanged'
+
+            doc_ids = await self.ingest_file(file_path, file_name, record.link_hash, mtype, extension, companyId,
+                                             meta, progress)
+            await self.replace_documents(record, doc_ids, content_hash)
+
+            return 'ok'
+
+    async def save_upload(self, file: UploadFile) -> str:
+        """Writes an uploaded file to the uploads directory shared with the workers, enforcing `max_file_size`."""
+        with NamedTemporaryFile(delete=False, dir='uploads', suffix=posixpath.splitext(file.filename or '')[1]) \
+                as temp_file:
+            size = 0
+            try:
+                while chunk := await file.read(1024 * 1024):
+                    size += len(chunk)
+                    if size > self.max_file_size:
+                        raise FileTooLargeError(f'File is larger than {self.max_file_size} bytes')
+
+                    temp_file.write(chunk)
+            except FileTooLargeError:
+                os.remove(temp_file.name)
+                raise
+
+        return temp_file.name
+
+    async def replace_documents(self, record: LinkRecord, doc_ids: List[str], content_hash: str):
+        stale_doc_ids = [doc_id for doc_id in record.doc_ids if doc_id not in doc_ids]
+        if stale_doc_ids:
+            await self.delete_documents(stale_doc_ids)
+            notify_ingested([record.company_id])
+
+        record.content_hash = content_hash
+        record.doc_ids = doc_ids
+        await link_registry.save(record)
+
+    async def download(self, response: httpx.Response, file_path: str) -> str:
+        """Streams the response body to `file_path` and returns its sha256, enforcing `max_file_size`."""
+        content_length = response.headers.get('Content-Length')
+        if content_length and content_length.isdecimal() and int(content_length) > self.max_file_size:
+            raise FileTooLargeError(f'File is larger than {self.max_file_size} bytes')
+
+        content_hash = hashlib.sha256()
+        size = 0
+
+        with timed('download'), open(file_path, 'wb') as f:
+            async for chunk in response.aiter_bytes():
+                size += len(chunk)
+                if size > self.max_file_size:
+                    raise FileTooLargeError(f'File is larger than {self.max_file_size} bytes')
+
+                content_hash.update(chunk)
+                f.write(chunk)
+
+        downloaded_bytes.inc(amount=size)
+
+        return content_hash.hexdigest()
+
+    async def ingest_file(self, file_path: str, file_name: str, link_hash: str, mtype: Optional[str],
+                          extension: Optional[str], companyId: int, meta: dict, progress: Progress = None) -> List[str]:
+        """Extracts and ingests the file batch by batch, so only one batch of pages is in memory at a time."""
+        doc_ids = []
+        nodes = 0
+        async for docs in read_document_batches(file_path, file_name, mtype, extension or '',
+                                                batch_size=self.batch_size, section_size=self.section_size):
+            for doc in docs:
+                doc.id_ = f"{companyId}:{link_hash}:{len(doc_ids)}"
+                doc.metadata = {
+                    **meta,
+                    'companyId': companyId,
+                    **doc.metadata
+                }
+                doc_ids.append(doc.doc_id)
+
+            nodes += await self.ingest(docs, extension)
+
+            if progress:
+                await progress({'pagesParsed': len(doc_ids), 'nodesEmbedded': nodes})
+
+        return doc_ids
+
+    async def ingest(self, docs: List[Document], extension: Optional[str]) -> int:
+        """Ingests the documents and returns the number of new or changed nodes."""
+        validated_extension = (extension or '').lstrip('.')
+
+        if validated_extension in EXTENSION_TO_LANGUAGE:
+            try:
+                pipeline = get_code_ingestion_pipeline(EXTENSION_TO_LANGUAGE[validated_extension][0])
+                return len(await arun_ingestion(pipeline, docs, store_doc_text=False))
+            except Exception as e:
+                logging.warning(e)
+                # the failed run may already have recorded the document hashes
+                for doc in docs:
+                    await docstore.adelete_document(doc.doc_id, raise_error=False)
+
+        return len(await arun_ingestion(FileIngestionPipeline, docs, store_doc_text=False))
+
+    async def delete_documents(self, doc_ids: List[str]):
+        for doc_id in doc_ids:
+            await vector_store.adelete(doc_id)
+            await docstore.adelete_ref_doc(doc_id, raise_error=False)
+            await docstore.adelete_document(doc_id, raise_error=False)
+
+
+file_service = FileService(
+    max_file_size=int(os.environ.get('FILE_MAX_SIZE', 100 * 1024 * 1024)),
+    concurrency=int(os.environ.get('FILE_INGESTION_CONCURRENCY', 2)),
+    batch_size=int(os.environ.get('FILE_INGESTION_BATCH_SIZE', 8)),
+    section_size=int(os.environ.get('FILE_SECTION_SIZE', 16000)),
+)
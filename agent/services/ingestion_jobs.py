@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import os
+import socket
+from typing import Awaitable, Callable, Dict
+
+from llama_index.core import Document
+
+from pipelines.base.chat_messages import MESSAGE_TYPE, chat_message_store
+from pipelines.base.jobs import Job, JobStore
+from pipelines.ingestion_pipeline import TextIngestionPipeline, arun_ingestion
+from services.chat_compaction import ChatCompactor
+from services.chat_import import ChatExportError, ChatImporter
+from services.file_service import FileService, FileTooLargeError
+from services.repo_service import InvalidRepoError, RepoService
+
+logger = logging.getLogger(__name__)
+
+
+class InvalidJobPayload(ValueError):
+    pass
+
+
+def required(payload: dict, *keys: str) -> list:
+    """The values of `keys` in a job payload, which can't be run without them."""
+    missing = [key for key in keys if key not in payload]
+    if missing:
+        raise InvalidJobPayload(f"Job payload misses {', '.join(missing)}")
+
+    return [payload[key] for key in keys]
+
+# errors that will fail the same way on every attempt
+PERMANENT_ERRORS = (FileTooLargeError, FileNotFoundError, ChatExportError, UnicodeDecodeError, InvalidRepoError,
+                    InvalidJobPayload)
+
+
+class IngestionJobRunner:
+    """Runs ingestion jobs in a worker process, `concurrency` at a time."""
+
+    def __init__(self, store: JobStore, file_service: FileService, repo_service: RepoService,
+                 chat_importer: ChatImporter, chat_compactor: ChatCompactor, concurrency: int = 2,
+                 poll_interval: float = 1, documents_batch_size: int = 64):
+        self.store = store
+        self.file_service = file_service
+        self.repo_service = repo_service
+        self.chat_importer = chat_importer
+        self.chat_compactor = chat_compactor
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.documents_batch_size = documents_batch_size
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+
+        self.handlers: Dict[str, Callable[[Job], Awaitable[dict]]] = {
+            'link': self.run_link,
+            'file': self.run_file,
+            'documents': self.run_documents,
+            'repo': self.run_repo,
+            'chat_import': self.run_chat_import,
+            'chat_compaction': self.run_chat_compaction,
+        }
+
+        self._stopping = asyncio.Event()
+
+    async def run(self):
+        if not self.concurrency:
+            return
+
+        logger.info('Ingestion worker %s started with concurrency %d', self.name, self.concurrency)
+
+        await asyncio.gather(*(self._loop() for _ in range(self.concurrency)))
+
+    def stop(self):
+        self._stopping.set()
+
+    async def _loop(self):
+        while not self._stopping.is_set():
+            job = await self.store.claim()
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._stopping.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            await self.process(job)
+
+    async def process(self, job: Job):
+        heartbeat = asyncio.create_task(self._heartbeat(job))
+
+        try:
+            handler = self.handlers.get(job.kind)
+            if handler is None:
+                raise InvalidJobPayload(f'Unknown job kind: {job.kind}')
+
+            result = await handler(job)
+        except PERMANENT_ERRORS as e:
+            logger.exception('Job %d (%s) failed', job.id, job.kind)
+            await self.store.fail(job, repr(e), retry=False)
+        except Exception as e:
+            logger.exception('Job %d (%s) failed on attempt %d', job.id, job.kind, job.attempts)
+            await self.store.fail(job, repr(e))
+        else:
+            await self.store.complete(job, result)
+        finally:
+            heartbeat.cancel()
+
+    async def _heartbeat(self, job: Job):
+        while True:
+            await asyncio.sleep(self.store.lease / 3)
+            await self.store.heartbeat(job)
+
+    def _progress(self, job: Job):
+        async def progress(values: dict):
+            await self.store.update_progress(job, values)
+
+        return progress
+
+    async def run_link(self, job: Job) -> dict:
+        link, = required(job.payload, 'link')
+        status = await self.file_service.add_file_via_link(link, job.company_id, job.payload.get('meta', {}),
+                                                           self._progress(job))
+        return {'status': status}
+
+    async def run_file(self, job: Job) -> dict:
+        path, file_name = required(job.payload, 'path', 'fileName')
+        return {'status': await self._with_upload(job, self.file_service.add_file(
+            path, file_name, job.company_id, job.payload.get('meta', {}), self._progress(job)))}
+
+    async def run_chat_import(self, job: Job) -> dict:
+        path, export_format = required(job.payload, 'path', 'format')
+        return await self._with_upload(job, self.chat_importer.run(
+            path, export_format, job.company_id, chat_id=job.payload.get('chatId'),
+            meta=job.payload.get('meta', {}), progress=self._progress(job), resume=job.progress,
+            retry=job.attempts > 1))
+
+    async def _with_upload(self, job: Job, run: Awaitable):
+        """Removes the uploaded file once the job is done, or won't be attempted again."""
+        path, = required(job.payload, 'path')
+
+        try:
+            result = await run
+        except Exception as e:
+            # keep the upload for the next attempt
+            if (isinstance(e, PERMANENT_ERRORS) or job.attempts >= job.max_attempts) and os.path.exists(path):
+                os.remove(path)
+            raise
+
+        os.remove(path)
+
+        return result
+
+    async def run_chat_compaction(self, job: Job) -> dict:
+        # a repeated run picks up the messages a failed one left
+        return await self.chat_compactor.run(job.company_id, dry_run=job.payload.get('dryRun', False),
+                                             rebuild_index=job.payload.get('rebuildIndex', False),
+                                             progress=self._progress(job))
+
+    async def run_repo(self, job: Job) -> dict:
+        # local paths are only synced from the command line, never from a job someone posted
+        repo, = required(job.payload, 'repo')
+        return await self.repo_service.sync(job.company_id, repo, url=job.payload.get('url'),
+                                            ref=job.payload.get('ref'), meta=job.payload.get('meta', {}),
+                                            progress=self._progress(job))
+
+    async def run_documents(self, job: Job) -> dict:
+        """Ingests a list of texts, resuming after the last batch a previous attempt finished."""
+        documents, = required(job.payload, 'documents')
+        for document in documents:
+            required(document, 'content')
+        done = job.progress.get('documentsIngested', 0)
+        nodes = job.progress.get('nodesEmbedded', 0)
+
+        for start in range(done, len(documents), self.documents_batch_size):
+            batch = []
+            for document in documents[start:start + self.documents_batch_size]:
+                metadata = {**document.get('meta', {}), 'companyId': job.company_id}
+
+                if metadata.get('type') == MESSAGE_TYPE:
+                    await chat_message_store.add(job.company_id, document['content'], metadata)
+
+                batch.append(Document(text=document['content'], metadata=metadata))
+
+            nodes += len(await arun_ingestion(TextIngestionPipeline, batch))
+            await self.store.update_progress(job, {'documentsIngested': start + len(batch), 'nodesEmbedded': nodes})
+
+        return {'status': 'ok', 'documents': len(documents)}
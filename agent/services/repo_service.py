@@ -0,0 +1,241 @@
+import asyncio
+import fcntl
+import hashlib
+import logging
+import os
+import posixpath
+import re
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+
+from llama_index.core import Document
+
+from pipelines.base.metrics import timed
+from pipelines.base.repo_registry import RepoRegistry, repo_registry
+from pipelines.ingestion_pipeline import notify_ingested
+from services.document_reader import TEXT_EXTENSIONS
+from services.file_service import FileService, Progress, file_service
+from utils.ext_to_lang import EXTENSION_TO_LANGUAGE
+
+logger = logging.getLogger(__name__)
+
+REPO_FILE_TYPE = 'github-file'
+
+REPO_NAME = re.compile(r'^[A-Za-z0-9_.-]+/[A-Za-z0-9_.-]+$')
+# credentials are allowed in the user part, for private repositories
+GITHUB_URL = re.compile(r'^https://([^@/\s]+@)?github\.com/[A-Za-z0-9_.-]+/[A-Za-z0-9_.-]+/?$')
+# a subset of `git check-ref-format`: nothing that starts with a dash, contains `..` or ends with `.lock`
+REF_NAME = re.compile(r'^(?!-)(?!.*\.\.)(?!.*//)(?!.*@\{)[A-Za-z0-9_./@{}-]+(?<!\.lock)(?<![./])$')
+
+
+class GitError(Exception):
+    pass
+
+
+class InvalidRepoError(ValueError):
+    pass
+
+
+def validate_repo(repo: str, url: Optional[str] = None, ref: Optional[str] = None):
+    """Rejects values that git would read as options or that point outside GitHub."""
+    if not REPO_NAME.match(repo) or repo.startswith(('-', '.')):
+        raise InvalidRepoError(f"Invalid repository name: {repo}")
+    if url is not None and not GITHUB_URL.match(url):
+        raise InvalidRepoError("Only https://github.com/ URLs are supported")
+    if ref is not None and not REF_NAME.match(ref):
+        raise InvalidRepoError(f"Invalid ref: {ref}")
+
+
+@dataclass
+class TreeEntry:
+    path: str
+    blob_sha: str
+    size: int
+
+
+async def git(*args: str) -> bytes:
+    process = await asyncio.create_subprocess_exec('git', *args, stdout=asyncio.subprocess.PIPE,
+                                                   stderr=asyncio.subprocess.PIPE)
+    stdout, stderr = await process.communicate()
+
+    if process.returncode != 0:
+        # arguments may contain a clone URL with credentials
+        command = args[2] if args[0] == '-C' else args[0]
+        raise GitError(f"git {command} failed: {stderr.decode(errors='replace')}")
+
+    return stdout
+
+
+def parse_tree(output: bytes) -> List[TreeEntry]:
+    entries = []
+
+    # `git ls-tree -r -l -z`: "<mode> <type> <sha> <size>\t<path>\0"
+    for line in output.split(b'\0'):
+        if not line:
+            continue
+
+        info, path = line.split(b'\t', 1)
+        _, object_type, blob_sha, size = info.split()
+        if object_type != b'blob':
+            continue
+
+        entries.append(TreeEntry(path.decode(errors='replace'), blob_sha.decode(), int(size)))
+
+    return entries
+
+
+class RepoService:
+    """Keeps the documents of a repository in sync with one of its revisions.
+
+    Only files whose blob SHA differs from the last sync are read, split and
+    embedded, and documents of files that disappeared are deleted.
+    """
+
+    def __init__(self, registry: RepoRegistry, file_service: FileService, cache_dir: str = 'repos',
+                 concurrency: int = 8, max_file_size: int = 1024 * 1024):
+        self.registry = registry
+        self.file_service = file_service
+        self.cache_dir = cache_dir
+        self.max_file_size = max_file_size
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # git directory -> lock held while it is synced
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def doc_id(self, company_id: int, repo: str, path: str) -> str:
+        return f"{company_id}:{hashlib.sha256(repo.encode()).hexdigest()}:{path}"
+
+    def is_supported(self, entry: TreeEntry) -> bool:
+        extension = posixpath.splitext(entry.path)[1].lstrip('.').lower()
+
+        return entry.size <= self.max_file_size and (extension in EXTENSION_TO_LANGUAGE
+                                                     or extension in TEXT_EXTENSIONS)
+
+    async def checkout(self, company_id: int, repo: str, url: Optional[str], path: Optional[str],
+                       ref: Optional[str]) -> Tuple[str, str]:
+        """Returns the git directory and revision to sync from.
+
+        Remote repositories are kept as bare partial clones, so only the blobs
+        of changed files are ever downloaded.
+        """
+        if path:
+            return path, ref or 'HEAD'
+
+        git_dir = self.git_dir(company_id, repo)
+        with timed('download'):
+            if not os.path.exists(git_dir):
+                await git('clone', '--bare', '--filter=blob:none', '--',
+                          url or f"https://github.com/{repo}.git", git_dir)
+
+            await git('-C', git_dir, 'fetch', '--filter=blob:none', '--', url or 'origin', ref or 'HEAD')
+
+        # FETCH_HEAD moves with the next fetch, the commit doesn't
+        return git_dir, (await git('-C', git_dir, 'rev-parse', '--verify', 'FETCH_HEAD^{commit}')).decode().strip()
+
+    def git_dir(self, company_id: int, repo: str) -> str:
+        return os.path.join(self.cache_dir, str(company_id), hashlib.sha256(repo.encode()).hexdigest())
+
+    async def _lock(self, git_dir: str):
+        """Holds the directory for this task and, through a lock file, for other workers on the host."""
+        lock = self._locks.setdefault(git_dir, asyncio.Lock())
+        await lock.acquire()
+
+        lock_file = None
+        try:
+            os.makedirs(os.path.dirname(git_dir), exist_ok=True)
+            lock_file = open(f"{git_dir}.lock", 'w')
+            await asyncio.to_thread(fcntl.flock, lock_file, fcntl.LOCK_EX)
+        except BaseException:
+            if lock_file is not None:
+                lock_file.close()
+            lock.release()
+            raise
+
+        return lock, lock_file
+
+    async def sync(self, company_id: int, repo: str, url: Optional[str] = None, path: Optional[str] = None,
+                   ref: Optional[str] = None, meta: Optional[dict] = None, progress: Progress = None) -> dict:
+        validate_repo(repo, url, ref)
+
+        # two syncs of a repository would fetch over each other and race on the registry
+        lock, lock_file = await self._lock(self.git_dir(company_id, repo))
+        try:
+            return await self._sync(company_id, repo, url, path, ref, meta, progress)
+        finally:
+            # closing the file releases the flock
+            lock_file.close()
+            lock.release()
+
+    async def _sync(self, company_id: int, repo: str, url: Optional[str], path: Optional[str], ref: Optional[str],
+                    meta: Optional[dict], progress: Progress) -> dict:
+        git_dir, revision = await self.checkout(company_id, repo, url, path, ref)
+
+        entries = [entry for entry in parse_tree(await git('-C', git_dir, 'ls-tree', '-r', '-l', '-z', revision))
+                   if self.is_supported(entry)]
+        ingested = await self.registry.get_files(company_id, repo)
+
+        changed = [entry for entry in entries if ingested.get(entry.path) != entry.blob_sha]
+        removed = set(ingested) - {entry.path for entry in entries}
+
+        counts = {'filesTotal': len(entries), 'filesChanged': len(changed), 'filesProcessed': 0,
+                  'filesFailed': 0, 'filesDeleted': 0}
+
+        async def report():
+            if progress:
+                await progress(counts)
+
+        async def process(entry: TreeEntry):
+            async with self.semaphore:
+                try:
+                    await self.ingest_file(git_dir, company_id, repo, entry, meta or {})
+                    counts['filesProcessed'] += 1
+                except Exception:
+                    # the SHA isn't recorded, so the next sync retries the file
+                    logger.exception('Failed to ingest %s from %s', entry.path, repo)
+                    counts['filesFailed'] += 1
+
+                await report()
+
+        await asyncio.gather(*(process(entry) for entry in changed))
+
+        if removed:
+            await self.file_service.delete_documents([self.doc_id(company_id, repo, path) for path in removed])
+            for path in removed:
+                await self.registry.delete_file(company_id, repo, path)
+
+            counts['filesDeleted'] = len(removed)
+            notify_ingested([company_id])
+            await report()
+
+        return counts
+
+    async def ingest_file(self, git_dir: str, company_id: int, repo: str, entry: TreeEntry, meta: dict):
+        content = await git('-C', git_dir, 'cat-file', 'blob', entry.blob_sha)
+        doc_id = self.doc_id(company_id, repo, entry.path)
+
+        if b'\0' in content:
+            # binary files aren't ingested, but may replace a text file of the same name
+            await self.file_service.delete_documents([doc_id])
+        else:
+            document = Document(text=content.decode(errors='replace'), metadata={
+                **meta,
+                'companyId': company_id,
+                'type': REPO_FILE_TYPE,
+                'repo': repo,
+                'path': entry.path,
+                'file_name': posixpath.basename(entry.path),
+                'sha': entry.blob_sha,
+            }, excluded_embed_metadata_keys=['sha'], excluded_llm_metadata_keys=['sha'])
+            document.id_ = doc_id
+
+            await self.file_service.ingest([document], posixpath.splitext(entry.path)[1])
+
+        await self.registry.save_file(company_id, repo, entry.path, entry.blob_sha)
+
+
+repo_service = RepoService(
+    repo_registry,
+    file_service,
+    cache_dir=os.environ.get('REPO_CACHE_DIR', 'repos'),
+    concurrency=int(os.environ.get('REPO_SYNC_CONCURRENCY', 8)),
+    max_file_size=int(os.environ.get('REPO_MAX_FILE_SIZE', 1024 * 1024)),
+)
@@ -0,0 +1,49 @@
+import logging
+import time
+
+from pipelines.base.metrics import Trace, current_trace, metrics
+
+logger = logging.getLogger(__name__)
+
+request_seconds = metrics.histogram('agent_http_request_seconds', 'Time to handle a request, to its last byte',
+                                    ('method', 'route', 'status'))
+
+
+class MetricsMiddleware:
+    """Times every request and the stages it went through, and logs the breakdown of slow ones.
+
+    Routes are labelled with their path template, so ids in paths don't
+    create a series per request.
+    """
+
+    def __init__(self, app, slow_request_seconds: float = 5.0):
+        self.app = app
+        self.slow_request_seconds = slow_request_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = current_trace.set(trace)
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            current_trace.reset(token)
+
+            duration = time.perf_counter() - trace.started
+            route = getattr(scope.get('route'), 'path', 'unmatched')
+            request_seconds.observe(duration, scope['method'], route, str(status))
+
+            if duration >= self.slow_request_seconds:
+                logger.warning('Slow request %s %s %d took %.3fs: %s', scope['method'], route, status, duration,
+                               trace.summary())
@@ -0,0 +1,85 @@
+import logging
+import os
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from pipelines.base.metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def process_age() -> Optional[float]:
+    """Seconds since the process was started, before the interpreter ran any code."""
+    try:
+        with open('/proc/self/stat') as f:
+            # the command name may contain spaces, fields are counted from its closing parenthesis
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+    except (OSError, IndexError, ValueError):
+        return None
+
+    return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+class Startup:
+    """Times the phases from process start to serving at full speed.
+
+    The app answers as soon as the pool is open and tables are set up, the
+    warm-up then loads what the first requests would otherwise wait for, and
+    the process reports ready once it is done.
+    """
+
+    def __init__(self):
+        self.ready = False
+        self.imported: Optional[float] = None
+        self.phases: Dict[str, float] = {}
+        self.failed: List[str] = []
+        self._started = time.perf_counter()
+        self._age = process_age()
+
+    def elapsed(self) -> float:
+        """Seconds since the process started, or since this module was imported where /proc is missing."""
+        return (self._age or 0.0) + time.perf_counter() - self._started
+
+    def mark_imported(self):
+        self.imported = self.elapsed()
+
+    async def phase(self, name: str, run: Callable[[], Awaitable], required: bool = False):
+        started = time.perf_counter()
+        try:
+            await run()
+        except Exception:
+            if required:
+                raise
+            # a cold component is slower, not broken
+            logger.exception('Warm-up of %s failed', name)
+            self.failed.append(name)
+        finally:
+            self.phases[name] = time.perf_counter() - started
+
+    async def warm_up(self, phases: List[Tuple[str, Callable[[], Awaitable]]]):
+        for name, run in phases:
+            await self.phase(name, run)
+
+        self.ready = True
+        self.phases['ready'] = self.elapsed()
+        logger.info('Ready %.3fs after process start: %s', self.phases['ready'],
+                    ' '.join(f'{name}={seconds:.3f}s' for name, seconds in self.phases.items()))
+
+    def stats(self) -> dict:
+        return {
+            'ready': self.ready,
+            'importSeconds': self.imported,
+            'phases': self.phases,
+            'failed': self.failed,
+        }
+
+
+startup = Startup()
+
+metrics.gauge('agent_ready', 'Whether the warm-up finished', lambda: 1.0 if startup.ready else 0.0)
+metrics.gauge('agent_import_seconds', 'Time from process start to the app module being imported',
+              lambda: startup.imported or 0.0)
+metrics.gauge('agent_ready_seconds', 'Time from process start to the end of the warm-up',
+              lambda: startup.phases.get('ready', 0.0))
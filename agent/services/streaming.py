@@ -0,0 +1,63 @@
+import json
+import logging
+import time
+from typing import Any, AsyncIterator, Awaitable
+
+from fastapi.encoders import jsonable_encoder
+
+from services.agent_service import QueryAnswer
+
+logger = logging.getLogger(__name__)
+
+
+def format_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(jsonable_encoder(data), ensure_ascii=False)}\n\n"
+
+
+async def stream_answer(chunks: AsyncIterator[QueryAnswer]) -> AsyncIterator[str]:
+    """Server-sent events for a streamed answer: a `token` per delta, then `done` with the whole answer.
+
+    When the client disconnects the response task is cancelled, which cancels
+    the upstream LLM request the chunks are read from.
+    """
+    started = time.perf_counter()
+    first_token = None
+    cached = False
+    answer = ''
+
+    try:
+        async for chunk in chunks:
+            if first_token is None:
+                first_token = time.perf_counter() - started
+                yield format_event('ttft', {'ttft': first_token})
+
+            cached = chunk.cached
+            answer += chunk.response
+            yield format_event('token', {'delta': chunk.response})
+    except Exception as e:
+        logger.exception('Streaming answer failed')
+        yield format_event('error', {'detail': str(e)})
+        return
+
+    duration = time.perf_counter() - started
+    logger.info('Streamed answer: ttft=%s duration=%.3fs cached=%s', first_token, duration, cached)
+
+    yield format_event('done', {'response': answer, 'cached': cached, 'ttft': first_token, 'duration': duration})
+
+
+async def stream_result(result: Awaitable[Any]) -> AsyncIterator[str]:
+    """Server-sent events for a structured result that can't be streamed token by token."""
+    started = time.perf_counter()
+
+    yield format_event('accepted', {})
+
+    try:
+        response = await result
+    except Exception as e:
+        logger.exception('Streaming result failed')
+        yield format_event('error', {'detail': str(e)})
+        return
+
+    duration = time.perf_counter() - started
+
+    yield format_event('done', {'response': response, 'ttft': duration, 'duration': duration})
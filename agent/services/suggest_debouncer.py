@@ -0,0 +1,108 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+# earlier messages of the burst, oldest first, with their meta
+Burst = List[Tuple[str, dict]]
+
+
+class ChatBurst:
+    def __init__(self):
+        self.messages: Burst = []
+        # set when a newer message arrives while the request waits out the window
+        self.superseded: Optional[asyncio.Event] = None
+        self.running: Optional[asyncio.Task] = None
+        # what the running evaluation was given, back to the burst if it gets cancelled
+        self.running_messages: Burst = []
+        self.requests = 0
+
+
+class SuggestDebouncer:
+    """Evaluates only the last message of a burst in a chat.
+
+    Every suggest request waits `window` seconds. A newer message in the same
+    chat answers the waiting one with no suggestion and cancels an evaluation
+    that is already running, so LLM calls follow conversation turns instead of
+    messages. The last message is evaluated with the rest of the burst, which
+    may not have reached the chat history yet.
+    """
+
+    def __init__(self, window: float = 1.0, max_burst: int = 20):
+        self.window = window
+        self.max_burst = max_burst
+        self._chats: Dict[Tuple[int, str], ChatBurst] = {}
+
+        self.requests = 0
+        self.evaluated = 0
+        self.superseded = 0
+        self.cancelled = 0
+
+    async def run(self, company_id: int, chat_id, message: str, meta: dict,
+                  evaluate: Callable[[str, dict, Burst], Awaitable[Any]]) -> Any:
+        self.requests += 1
+        if self.window <= 0 or chat_id is None:
+            self.evaluated += 1
+            return await evaluate(message, meta, [])
+
+        key = (company_id, str(chat_id))
+        chat = self._chats.setdefault(key, ChatBurst())
+        chat.requests += 1
+
+        if chat.superseded is not None:
+            chat.superseded.set()
+        if chat.running is not None and chat.running.cancel():
+            self.cancelled += 1
+            chat.messages = chat.running_messages + chat.messages
+
+        superseded = chat.superseded = asyncio.Event()
+        chat.messages.append((message, meta))
+        del chat.messages[:-self.max_burst]
+
+        try:
+            try:
+                await asyncio.wait_for(superseded.wait(), self.window)
+                self.superseded += 1
+                return None
+            except asyncio.TimeoutError:
+                pass
+
+            burst = chat.messages[:-1]
+            chat.running_messages = chat.messages
+            chat.messages = []
+            chat.superseded = None
+
+            self.evaluated += 1
+            running = chat.running = asyncio.create_task(evaluate(message, meta, burst))
+            try:
+                await asyncio.wait([running])
+            except asyncio.CancelledError:
+                running.cancel()
+                raise
+            finally:
+                # a finished evaluation has nothing left to cancel or give back to the burst
+                if chat.running is running:
+                    chat.running = None
+                    chat.running_messages = []
+
+            # a newer message cancelled it
+            return None if running.cancelled() else running.result()
+        finally:
+            chat.requests -= 1
+            if not chat.requests:
+                del self._chats[key]
+
+    def stats(self) -> dict:
+        return {
+            'window': self.window,
+            'requests': self.requests,
+            'evaluated': self.evaluated,
+            'superseded': self.superseded,
+            'cancelled': self.cancelled,
+            'activeChats': len(self._chats),
+        }
+
+
+suggest_debouncer = SuggestDebouncer(
+    window=float(os.environ.get('SUGGEST_DEBOUNCE_SECONDS', 1.0)),
+    max_burst=int(os.environ.get('SUGGEST_DEBOUNCE_MAX_BURST', 20)),
+)
@@ -0,0 +1,164 @@
+import json
+import logging
+import os
+import re
+from dataclasses import dataclass
+from typing import List, Optional
+
+import numpy as np
+from llama_index.core.base.embeddings.base import BaseEmbedding
+
+from pipelines.base.embedding import embed_model
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PROTOTYPES = [
+    "CoWorker, can you help me with this?",
+    "Hey bot, what do you think?",
+    "Does anyone know when the release is planned?",
+    "Where can I find the documentation for this?",
+    "Who is responsible for this task?",
+    "Can someone remind me what we decided yesterday?",
+    "What is the link to the staging server?",
+    "Коворкер, подскажи, пожалуйста",
+    "Кто-нибудь знает, когда релиз?",
+    "Где найти документацию?",
+]
+
+QUESTION_WORDS = re.compile(
+    r"^\s*(what|when|where|who|whom|whose|why|which|how|can|could|would|should|is|are|do|does|did|will|"
+    r"что|когда|где|кто|почему|зачем|какой|какая|какие|каком|сколько|как|можно|подскажите|подскажи)\b",
+    re.IGNORECASE,
+)
+
+
+@dataclass
+class GateDecision:
+    passed: bool
+    reason: str
+    similarity: Optional[float] = None
+
+
+class SuggestGate:
+    """Cheap local check of whether a message could be addressed to CoWorker.
+
+    In `enforce` mode rejected messages never reach retrieval and the LLM. In
+    `shadow` mode every message still goes to the LLM and the gate only
+    records how often it agrees with the LLM score.
+    """
+
+    def __init__(self, embed_model: BaseEmbedding, mode: str = 'shadow', names: Optional[List[str]] = None,
+                 bot_username: Optional[str] = None, prototypes: Optional[List[str]] = None,
+                 similarity_threshold: float = 0.5, question_similarity_threshold: float = 0.35):
+        if mode not in ('enforce', 'shadow', 'off'):
+            raise ValueError(f'Unknown suggest gate mode: {mode}')
+
+        self.embed_model = embed_model
+        self.mode = mode
+        self.bot_username = bot_username
+        self.prototypes = prototypes or DEFAULT_PROTOTYPES
+        self.similarity_threshold = similarity_threshold
+        self.question_similarity_threshold = question_similarity_threshold
+
+        names = [name for name in (names or []) + [bot_username] if name]
+        self.names_re = re.compile('|'.join(re.escape(name) for name in names), re.IGNORECASE) if names else None
+
+        self._prototype_embeddings: Optional[np.ndarray] = None
+
+        self.passed = 0
+        self.rejected = 0
+        # gate decision vs. LLM decision, only known in shadow mode
+        self.agreement = {'passedAccepted': 0, 'passedDeclined': 0, 'rejectedAccepted': 0, 'rejectedDeclined': 0}
+
+    @property
+    def enforced(self) -> bool:
+        return self.mode == 'enforce'
+
+    async def _prototype_matrix(self) -> np.ndarray:
+        if self._prototype_embeddings is None:
+            embeddings = np.asarray(await self.embed_model.aget_text_embedding_batch(self.prototypes))
+            self._prototype_embeddings = embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)
+
+        return self._prototype_embeddings
+
+    async def warm_up(self):
+        """Embeds the prototypes ahead of the first message."""
+        if self.mode != 'off':
+            await self._prototype_matrix()
+
+    async def similarity(self, message: str) -> float:
+        embedding = np.asarray(await self.embed_model.aget_query_embedding(message))
+        embedding = embedding / (np.linalg.norm(embedding) or 1.0)
+
+        return float(np.max(await self._prototype_matrix() @ embedding))
+
+    async def evaluate(self, message: str, meta: dict) -> GateDecision:
+        decision = await self._evaluate(message, meta)
+
+        if decision.passed:
+            self.passed += 1
+        else:
+            self.rejected += 1
+
+        return decision
+
+    async def _evaluate(self, message: str, meta: dict) -> GateDecision:
+        if self.mode == 'off':
+            return GateDecision(True, 'off')
+
+        if self.bot_username and meta.get('replyToUsername') == self.bot_username:
+            return GateDecision(True, 'reply')
+
+        if self.names_re and self.names_re.search(message):
+            return GateDecision(True, 'mention')
+
+        similarity = await self.similarity(message)
+        is_question = '?' in message or bool(QUESTION_WORDS.match(message))
+
+        if similarity >= self.similarity_threshold:
+            return GateDecision(True, 'similarity', similarity)
+
+        if is_question and similarity >= self.question_similarity_threshold:
+            return GateDecision(True, 'question', similarity)
+
+        return GateDecision(False, 'question' if is_question else 'statement', similarity)
+
+    def record(self, decision: GateDecision, accepted: bool):
+        key = ('passed' if decision.passed else 'rejected') + ('Accepted' if accepted else 'Declined')
+        self.agreement[key] += 1
+
+        if not decision.passed and accepted:
+            logger.info('Suggest gate rejected a message the LLM answered (%s, similarity=%s)',
+                        decision.reason, decision.similarity)
+
+    def stats(self) -> dict:
+        judged = sum(self.agreement.values())
+        agreed = self.agreement['passedAccepted'] + self.agreement['rejectedDeclined']
+
+        return {
+            'mode': self.mode,
+            'passed': self.passed,
+            'rejected': self.rejected,
+            'agreement': self.agreement,
+            'agreementRate': agreed / judged if judged else None,
+        }
+
+
+def load_prototypes() -> Optional[List[str]]:
+    path = os.environ.get('SUGGEST_GATE_PROTOTYPES')
+    if not path:
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+suggest_gate = SuggestGate(
+    embed_model,
+    mode=os.environ.get('SUGGEST_GATE_MODE', 'shadow'),
+    names=[name for name in os.environ.get('SUGGEST_GATE_NAMES', 'coworker,коворкер').split(',') if name],
+    bot_username=os.environ.get('TELEGRAM_BOT_USERNAME'),
+    prototypes=load_prototypes(),
+    similarity_threshold=float(os.environ.get('SUGGEST_GATE_SIMILARITY', 0.5)),
+    question_similarity_threshold=float(os.environ.get('SUGGEST_GATE_QUESTION_SIMILARITY', 0.35)),
+)
@@ -222,6 +222,12 @@ EXTENSION_TO_LANGUAGE = {
     "php": [
         "php"
     ],
+    "py": [
+        "python"
+    ],
+    "pyi": [
+        "python"
+    ],
     "rs": [
         "rust"
     ],
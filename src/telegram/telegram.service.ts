@@ -406,6 +406,7 @@ export class TelegramService {
       chatTitle: ctx.chat.title,
       authorUsername: ctx.message.from.username,
       authorFirstName: ctx.message.from.first_name,
+      replyToUsername: ctx.message.reply_to_message?.from?.username,
     };
   }
 